@@ -1,105 +1,153 @@
 import gradio as gr
-import ollama
-import json
+import os
+import time
 from datetime import datetime 
 
-from src.main import process_pdf
-from src.config import MODEL, SYSTEM_PROMPT
+from src.config import MODEL, OLLAMA_MAX_CONCURRENCY, METRICS_PORT, JOB_POLL_INTERVAL
+from src.refinement import RefinementSession, changed_fields
+from src.tracing import start_metrics_server
+from src.job_queue import get_job_queue, QueueFullError
 
 
-def clean_and_parse_json(raw_content: str) -> dict:
-    """Extracts the first valid JSON object from a string."""
-    json_start_index = raw_content.find('{')
-    json_end_index = raw_content.rfind('}')
-    if json_start_index == -1 or json_end_index == -1:
-        raise ValueError("No valid JSON object found in the model's response.")
-    json_string = raw_content[json_start_index : json_end_index + 1]
-    try:
-        return json.loads(json_string)
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Failed to decode JSON. Error: {e}. Content: {json_string}")
+# Top-level fields shown in each part of the formatted view, so a chat edit only re-renders the parts it touched
+SECTION_FIELDS = {
+    "parties": ("customer_name", "customer_address", "vendor_name", "vendor_id", "vendor_address"),
+    "details": ("invoice_number", "invoice_date"),
+    "line_items": ("line_items",),
+    "summary": ("subtotal", "tax", "total_amount", "currency"),
+}
 
-def format_json_display(json_data: dict) -> str:
-    """Formats JSON data into a clean, readable HTML view (this part remains light-themed)."""
-    if not isinstance(json_data, dict) or not json_data:
-        return "<div class='invoice-container no-data'>Awaiting Invoice Data...</div>"
-    
-    def fnum(n, precision=2):
-        return f"{n:.{precision}f}" if isinstance(n, (int, float)) else ""
 
-    html = "<div class='invoice-container'>" # Main container for the light-mode island
-    html += f"<h1>Invoice</h1><p class='generation-date'>Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>"
+def fnum(n, precision=2):
+    return f"{n:.{precision}f}" if isinstance(n, (int, float)) else ""
 
-    html += "<div class='grid-container'>"
-    html += f"<div class='grid-item'><h3>Billed To</h3><p><strong>{json_data.get('customer_name', 'N/A')}</strong></p><p>{json_data.get('customer_address', '')}</p></div>"
-    html += f"<div class='grid-item'><h3>From</h3><p><strong>{json_data.get('vendor_name', 'N/A')}</strong></p><p>{json_data.get('vendor_id', 'id')}</p><p>{json_data.get('vendor_address', '')}</p></div>"
-    html += "</div>"
-    
-    html += "<div class='details-grid'>"
-    html += f"<p><strong>Invoice #:</strong> {json_data.get('invoice_number', 'N/A')}</p>"
-    html += f"<p><strong>Date:</strong> {json_data.get('invoice_date', 'N/A')}</p>"
-    html += "</div>"
-    
-    if json_data.get('line_items'):
-        html += "<h3>Line Items</h3><table class='styled-table'><thead><tr><th>Description</th><th>Qty</th><th>Unit Price</th><th>Total</th></tr></thead><tbody>"
+
+def render_section(name: str, json_data: dict) -> str:
+    if name == "parties":
+        html = "<div class='grid-container'>"
+        html += f"<div class='grid-item'><h3>Billed To</h3><p><strong>{json_data.get('customer_name', 'N/A')}</strong></p><p>{json_data.get('customer_address', '')}</p></div>"
+        html += f"<div class='grid-item'><h3>From</h3><p><strong>{json_data.get('vendor_name', 'N/A')}</strong></p><p>{json_data.get('vendor_id', 'id')}</p><p>{json_data.get('vendor_address', '')}</p></div>"
+        return html + "</div>"
+
+    if name == "details":
+        html = "<div class='details-grid'>"
+        html += f"<p><strong>Invoice #:</strong> {json_data.get('invoice_number', 'N/A')}</p>"
+        html += f"<p><strong>Date:</strong> {json_data.get('invoice_date', 'N/A')}</p>"
+        return html + "</div>"
+
+    if name == "line_items":
+        if not json_data.get('line_items'):
+            return ""
+        html = "<h3>Line Items</h3><table class='styled-table'><thead><tr><th>Description</th><th>Qty</th><th>Unit Price</th><th>Total</th></tr></thead><tbody>"
         for item in json_data.get('line_items', []):
             qty = item.get('quantity')
             price = item.get('unit_price')
             total = (qty * price) if qty is not None and price is not None else 0
             html += f"<tr><td>{item.get('description', '')}</td><td>{qty if qty is not None else ''}</td><td>{fnum(price)}</td><td>{fnum(total)}</td></tr>"
-        html += "</tbody></table>"
-        
-    html += "<div class='summary-box'>"
+        return html + "</tbody></table>"
+
+    html = "<div class='summary-box'>"
     html += f"<div><span>Subtotal</span><span>{fnum(json_data.get('subtotal'))}</span></div>"
     html += f"<div><span>Tax</span><span>{fnum(json_data.get('tax'))}</span></div>"
     html += f"<div class='total'><span>Total ({json_data.get('currency', '')})</span><span>{fnum(json_data.get('total_amount'))}</span></div>"
-    html += "</div></div>"
-    return html
+    return html + "</div>"
+
+
+def render_sections(json_data: dict, previous: dict = None, changed: set = None) -> dict:
+    """Renders each section's HTML, reusing `previous` for sections none of the `changed` fields belong to."""
+    if not previous or changed is None:
+        return {name: render_section(name, json_data) for name in SECTION_FIELDS}
+    return {
+        name: render_section(name, json_data) if changed.intersection(fields) else previous[name]
+        for name, fields in SECTION_FIELDS.items()
+    }
+
+
+def assemble_display(json_data: dict, sections: dict) -> str:
+    if not isinstance(json_data, dict) or not json_data:
+        return "<div class='invoice-container no-data'>Awaiting Invoice Data...</div>"
+    html = "<div class='invoice-container'>" # Main container for the light-mode island
+    html += f"<h1>Invoice</h1><p class='generation-date'>Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>"
+    html += "".join(sections[name] for name in SECTION_FIELDS)
+    return html + "</div>"
+
+
+def format_json_display(json_data: dict) -> str:
+    """Formats JSON data into a clean, readable HTML view (this part remains light-themed)."""
+    if not isinstance(json_data, dict) or not json_data:
+        return assemble_display(json_data, {})
+    return assemble_display(json_data, render_sections(json_data))
+
+def follow_job(job_id: str, progress):
+    """Polls a queued job, showing its stage and partial data until it finishes. Safe to re-attach after a refresh."""
+    queue = get_job_queue()
+    last_partial = None
+    while True:
+        job = queue.get(job_id)
+        if job is None:
+            raise gr.Error(f"No job with id {job_id}")
+
+        if job["status"] == "done":
+            payload = queue.result(job_id)
+            structured_data = payload["data"]
+            sections = render_sections(structured_data)
+            # Images and text go to the model once, in the first turn of the refinement session
+            session = RefinementSession(structured_data, payload["images"], payload.get("invoice_text", ""))
+            progress(1, desc="Parsing complete!")
+            greeting = "I've analyzed the document. You can now ask me to refine or query the results."
+            duplicate = payload.get("duplicate_of")
+            if duplicate and duplicate["reused"]:
+                greeting = (f"This looks like a near duplicate of {duplicate['source']} ({duplicate['similarity']:.0%} similar), "
+                            "so I've reused that extraction. You can ask me to check or refine it.")
+            elif duplicate:
+                greeting += f" Note: its pages look like {duplicate['source']}, which may be the same invoice."
+            initial_chatbot_message = [(None, greeting)]
+            yield structured_data, session, initial_chatbot_message, gr.update(visible=True), assemble_display(structured_data, sections), sections, job_id
+            return
+        if job["status"] in ("failed", "cancelled"):
+            raise gr.Error(f"Job {job['status']}: {job['error'] or 'no result'}")
+
+        position = f"{queue.stats()['queue_depth']} job(s) waiting" if job["status"] == "queued" else job["stage"]
+        progress(job["progress"], desc=position)
+        # Fields and line items show up in the formatted view as soon as the model closes them
+        if job.get("partial") and job["partial"] != last_partial:
+            last_partial = job["partial"]
+            yield last_partial, None, None, gr.update(visible=True), format_json_display(last_partial), {}, job_id
+        time.sleep(JOB_POLL_INTERVAL)
 
 def initial_process_pdf(pdf_file, progress=gr.Progress()):
     
     if pdf_file is None:
-        return None, [], None, gr.update(visible=True), format_json_display({})
+        yield None, None, None, gr.update(visible=True), format_json_display({}), {}, ""
+        return
     
     try:
-        structured_data, image_paths = process_pdf(pdf_file, progress)
-        formatted_display = format_json_display(structured_data)
-        progress(1, desc="Parsing complete!")
-        initial_chatbot_message = [(None, "I've analyzed the document. You can now ask me to refine or query the results.")]
-        return structured_data, image_paths, initial_chatbot_message, gr.update(visible=True), formatted_display
-    
-    except Exception as e:
-        raise gr.Error(f"Failed to call Ollama or parse its response: {e}")
+        job_id = get_job_queue().submit(pdf_file)
+    except QueueFullError as e:
+        raise gr.Error(f"The queue is full, please try again shortly: {e}")
+    yield None, None, None, gr.update(visible=True), format_json_display({}), {}, job_id
+    yield from follow_job(job_id, progress)
 
-def handle_chat_message(user_message: str, chat_history: list, image_paths: list, current_json: dict):
-    if not image_paths:
+def handle_chat_message(user_message: str, chat_history: list, session: RefinementSession, current_json: dict, sections: dict):
+    if session is None:
         chat_history.append((user_message, "Error: No document context. Please upload a PDF first."))
-        return "", chat_history, format_json_display(current_json), current_json
-
-    chat_history.append((user_message, None))
-    chat_prompt = "\n".join([
-        "You are a helpful assistant analyzing an invoice. You have already extracted this JSON:",
-        f"--- INITIAL JSON ---\n{json.dumps(current_json, indent=2)}--- END INITIAL JSON ---",
-        "The user has a follow-up question. Based on the attached invoice image(s) and the initial JSON, provide a concise answer.",
-        "IMPORTANT: If the user asks you to change, correct, or update the data, you MUST provide the complete, updated JSON structure within a ```json ... ``` code block in your response.",
-        f"User's question: '{user_message}'"
-    ])
+        return "", chat_history, format_json_display(current_json), current_json, sections
 
     try:
-        response = ollama.chat(model=MODEL, messages=[{'role': 'user', 'content': chat_prompt, 'images': image_paths}])
-        assistant_response = response['message']['content']
-        chat_history[-1] = (user_message, "Done")
-        
-        try:
-            updated_json_data = clean_and_parse_json(assistant_response)
-            return "", chat_history, format_json_display(updated_json_data), updated_json_data
-        
-        except (ValueError, json.JSONDecodeError):
-            return "", chat_history, format_json_display(current_json), current_json
-    
+        answer, applied, rejected = session.ask(user_message)
     except Exception as e:
-        chat_history[-1] = (user_message, f"Sorry, an error occurred: {e}")
-        return "", chat_history, format_json_display(current_json), current_json
+        chat_history.append((user_message, f"Sorry, an error occurred: {e}"))
+        return "", chat_history, assemble_display(current_json, sections), current_json, sections
+
+    if rejected:
+        print(f"Warning: Skipped {len(rejected)} chat edit(s) that did not apply: {rejected}")
+    chat_history.append((user_message, answer or "Done"))
+    if not applied:
+        return "", chat_history, assemble_display(current_json, sections), current_json, sections
+
+    updated_json = session.invoice
+    sections = render_sections(updated_json, sections, changed_fields(applied))
+    return "", chat_history, assemble_display(updated_json, sections), updated_json, sections
 
 
 night_mode_css = """
@@ -135,8 +183,9 @@ body, .gradio-container { background-color: #0d1117; color: #c9d1d9; }
 """
 
 with gr.Blocks(theme=gr.themes.Base(), css=night_mode_css, title="Interactive Invoice Parser") as demo: #  
-    image_paths_state = gr.State([])
+    session_state = gr.State(None)
     json_state = gr.State({})
+    sections_state = gr.State({})
 
     with gr.Column(elem_classes="main-column"):
         gr.Markdown(f"# Interactive Invoice Parser\nUpload a PDF to start a conversation with **{MODEL}**.")
@@ -144,6 +193,10 @@ with gr.Blocks(theme=gr.themes.Base(), css=night_mode_css, title="Interactive In
         with gr.Group(elem_classes="dark-group"):
             pdf_upload = gr.File(label="Upload PDF Invoice", file_types=[".pdf"])
             process_button = gr.Button("Process Invoice", variant="primary")
+            with gr.Row():
+                job_id_box = gr.Textbox(label="Job ID", placeholder="Paste a job ID to pick up a job after a refresh")
+                resume_button = gr.Button("Load Job")
+                cancel_button = gr.Button("Cancel Job")
 
         with gr.Row(visible=True, elem_classes="results-chat-area") as results_and_chat_area:
             with gr.Column(scale=2, elem_classes="view-column dark-group"):
@@ -161,35 +214,59 @@ with gr.Blocks(theme=gr.themes.Base(), css=night_mode_css, title="Interactive In
                 chat_textbox = gr.Textbox(placeholder="e.g., Change the vendor name...", show_label=False)
 
     def process_pdf_and_update_ui(pdf_file, progress=gr.Progress()):
-        json_data, image_paths, initial_chat, visibility_update, formatted_html = initial_process_pdf(pdf_file, progress)
-        return json_data, image_paths, initial_chat, visibility_update, formatted_html, json_data
-    
-    process_button.click(
-        fn=process_pdf_and_update_ui,
-        inputs=[pdf_upload],
-        outputs=[json_state, image_paths_state, chatbot, results_and_chat_area, formatted_output, json_output_raw]
-    )
+        for json_data, session, initial_chat, visibility_update, formatted_html, sections, job_id in initial_process_pdf(pdf_file, progress):
+            yield json_data, session, initial_chat, visibility_update, formatted_html, json_data, sections, job_id
 
-    def chat_and_update_ui(msg, history, paths, current_json):
-        msg_out, updated_history, updated_html, updated_json = handle_chat_message(msg, history, paths, current_json)
-        return msg_out, updated_history, updated_html, updated_json, updated_json
+    def resume_job_and_update_ui(job_id, progress=gr.Progress()):
+        for json_data, session, initial_chat, visibility_update, formatted_html, sections, job_id in follow_job(job_id.strip(), progress):
+            yield json_data, session, initial_chat, visibility_update, formatted_html, json_data, sections, job_id
+
+    job_outputs = [json_state, session_state, chatbot, results_and_chat_area, formatted_output, json_output_raw, sections_state, job_id_box]
+    process_button.click(fn=process_pdf_and_update_ui, inputs=[pdf_upload], outputs=job_outputs)
+    resume_button.click(fn=resume_job_and_update_ui, inputs=[job_id_box], outputs=job_outputs)
+
+    def cancel_job(job_id):
+        if job_id and get_job_queue().cancel(job_id.strip()):
+            gr.Info("Cancellation requested")
+        else:
+            gr.Warning("Nothing to cancel: the job is not queued or running")
+
+    cancel_button.click(fn=cancel_job, inputs=[job_id_box], outputs=[])
+
+    def chat_and_update_ui(msg, history, session, current_json, sections):
+        msg_out, updated_history, updated_html, updated_json, updated_sections = handle_chat_message(msg, history, session, current_json, sections)
+        return msg_out, updated_history, updated_html, updated_json, updated_json, updated_sections
 
     chat_textbox.submit(
         fn=chat_and_update_ui,
-        inputs=[chat_textbox, chatbot, image_paths_state, json_state],
-        outputs=[chat_textbox, chatbot, formatted_output, json_state, json_output_raw]
+        inputs=[chat_textbox, chatbot, session_state, json_state, sections_state],
+        outputs=[chat_textbox, chatbot, formatted_output, json_state, json_output_raw, sections_state]
     )
     
     def clear_all_ui():
-        return None, gr.update(visible=True), None, format_json_display({}), {}, []
+        return None, gr.update(visible=True), None, format_json_display({}), {}, None, {}, ""
 
     pdf_upload.clear(
         fn=clear_all_ui,
         inputs=[],
-        outputs=[pdf_upload, results_and_chat_area, chatbot, formatted_output, json_state, image_paths_state]
+        outputs=[pdf_upload, results_and_chat_area, chatbot, formatted_output, json_state, session_state, sections_state, job_id_box]
     )
 
 
 if __name__ == "__main__":
     print(f"Launching Gradio App with model: {MODEL}")
-    demo.launch()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+        print(f"Serving Prometheus metrics on :{METRICS_PORT}/metrics")
+    import uvicorn
+    from fastapi import FastAPI
+    from src.job_api import create_job_router
+
+    # Starting the queue resumes any jobs interrupted by the last shutdown
+    api = FastAPI()
+    api.include_router(create_job_router(get_job_queue()))
+
+    # Handlers only enqueue and poll; the job workers and the shared Ollama client bound the real work
+    demo.queue(default_concurrency_limit=OLLAMA_MAX_CONCURRENCY * 2)
+    app = gr.mount_gradio_app(api, demo, path="/")
+    uvicorn.run(app, host=os.environ.get("GRADIO_SERVER_NAME", "127.0.0.1"), port=int(os.environ.get("GRADIO_SERVER_PORT", 7860)))
@@ -0,0 +1,178 @@
+"""
+Cold-start benchmark: how long a fresh interpreter takes to import each entry point, how much
+memory it holds afterwards, and which heavy dependencies came along.
+
+    python -m benchmarks.cold_start --repeats 5
+    python -m benchmarks.cold_start --check     # exit 1 if a headless module pulls in the UI stack
+    python -m benchmarks.cold_start --compare benchmarks/results/A.json benchmarks/results/B.json
+
+Every measurement runs in its own subprocess so nothing is already imported or cached in
+memory. Import time and RSS are reported as the median over --repeats runs, next to a bare
+interpreter's baseline. Results are saved under benchmarks/results/ like benchmarks.run's.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+
+from benchmarks.run import ROOT_DIR, git_revision, save
+
+# Entry points and whether they must stay importable without the UI stack
+TARGETS = {
+    "src.main": True,
+    "src.batch": True,
+    "src.job_queue": True,
+    "src.refinement": True,
+    "app": False,
+}
+# Commands timed end to end, interpreter start to exit
+COMMANDS = {
+    "batch --help": ["-m", "src.batch", "--help"],
+}
+HEAVY_MODULES = ("gradio", "fastapi", "torch", "torchvision", "llama_index", "pdf2image", "pypdf", "PIL", "ollama", "httpx", "numpy", "pydantic")
+UI_MODULES = ("gradio", "fastapi", "torch", "torchvision")
+
+PROBE = """
+import sys, time, json, resource
+start = time.perf_counter()
+error = None
+if sys.argv[1]:
+    try:
+        __import__(sys.argv[1])
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+seconds = time.perf_counter() - start
+print(json.dumps({
+    "seconds": seconds,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "modules": [name for name in sys.argv[2].split(",") if name in sys.modules],
+    "error": error,
+}))
+"""
+
+
+def probe(module: str) -> dict:
+    """Imports `module` ("" for none) in a fresh interpreter and returns its measurements."""
+    completed = subprocess.run(
+        [sys.executable, "-c", PROBE, module, ",".join(HEAVY_MODULES)],
+        cwd=ROOT_DIR, capture_output=True, text=True, timeout=300,
+    )
+    if completed.returncode != 0:
+        return {"seconds": 0.0, "rss_mb": 0.0, "modules": [], "error": (completed.stderr.strip().splitlines() or [f"exited with status {completed.returncode}"])[-1]}
+    # The module may print on import; the measurements are the last line
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def measure(module: str, repeats: int) -> dict:
+    runs = [probe(module) for _ in range(repeats)]
+    return {
+        "import_seconds": round(statistics.median(run["seconds"] for run in runs), 4),
+        "rss_mb": round(statistics.median(run["rss_mb"] for run in runs), 1),
+        "modules": runs[-1]["modules"],
+        "error": runs[-1]["error"],
+    }
+
+
+def time_command(args: list, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], cwd=ROOT_DIR, capture_output=True, timeout=300)
+        timings.append(time.perf_counter() - start)
+    return round(statistics.median(timings), 4)
+
+
+def run(args) -> dict:
+    baseline = measure("", args.repeats)
+    targets = {}
+    for module, headless in TARGETS.items():
+        result = measure(module, args.repeats)
+        result["headless"] = headless
+        # What the module itself costs on top of a bare interpreter
+        result["import_rss_mb"] = round(result["rss_mb"] - baseline["rss_mb"], 1)
+        targets[module] = result
+    return {
+        "kind": "cold_start",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "label": args.label or "cold-start",
+        "git": git_revision(),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {"repeats": args.repeats},
+        "baseline": baseline,
+        "targets": targets,
+        "commands": {name: time_command(command, args.repeats) for name, command in COMMANDS.items()},
+    }
+
+
+def ui_leaks(report: dict) -> dict:
+    """Headless targets that imported part of the UI stack, with the offending modules."""
+    return {
+        module: [name for name in result["modules"] if name in UI_MODULES]
+        for module, result in report["targets"].items()
+        if result["headless"] and any(name in UI_MODULES for name in result["modules"])
+    }
+
+
+def print_report(report: dict):
+    baseline = report["baseline"]
+    print(f"baseline interpreter: {baseline['import_seconds']:.3f}s, {baseline['rss_mb']} MB RSS")
+    print(f"\n{'target':<18}{'import s':>10}{'RSS MB':>10}{'+RSS MB':>10}  heavy modules loaded")
+    for module, result in report["targets"].items():
+        if result["error"]:
+            print(f"{module:<18}  failed to import: {result['error']}")
+            continue
+        print(f"{module:<18}{result['import_seconds']:>10.3f}{result['rss_mb']:>10.1f}{result['import_rss_mb']:>10.1f}  {', '.join(result['modules']) or '-'}")
+    print(f"\n{'command':<18}{'wall s':>10}")
+    for name, seconds in report["commands"].items():
+        print(f"{name:<18}{seconds:>10.3f}")
+    for module, modules in ui_leaks(report).items():
+        print(f"Warning: headless {module} imports {', '.join(modules)}")
+
+
+def compare(old_path: str, new_path: str):
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"old: {old['git']['commit'][:8]} {old['git']['subject']}\nnew: {new['git']['commit'][:8]} {new['git']['subject']}")
+    print(f"\n{'metric':<40}{'old':>12}{'new':>12}{'change':>11}")
+
+    def row(name, a, b):
+        change = (b - a) / a * 100 if a else 0.0
+        flag = "  <-- regression" if change >= 10 else ""
+        print(f"{name:<40}{a:>12.3f}{b:>12.3f}{change:>+10.1f}%{flag}")
+
+    for module in sorted(set(old["targets"]) & set(new["targets"])):
+        row(f"{module} import_seconds", old["targets"][module]["import_seconds"], new["targets"][module]["import_seconds"])
+        row(f"{module} rss_mb", old["targets"][module]["rss_mb"], new["targets"][module]["rss_mb"])
+    for name in sorted(set(old["commands"]) & set(new["commands"])):
+        row(f"{name} wall_seconds", old["commands"][name], new["commands"][name])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure import time and baseline memory of each entry point.")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--label", default="", help="suffix for the saved result file (default: cold-start)")
+    parser.add_argument("--check", action="store_true", help="exit with status 1 if a headless module imports the UI stack")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two saved result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args)
+    print_report(report)
+    if not args.no_save:
+        print(f"\nSaved {save(report)}")
+    if args.check and ui_leaks(report):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
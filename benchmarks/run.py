@@ -0,0 +1,325 @@
+"""
+Offline benchmark of the extraction pipeline against synthetic invoices and a stub model.
+
+    python -m benchmarks.run --docs 20 --max-pages 50 --latency 0.3 --token-rate 40
+    python -m benchmarks.run --compare benchmarks/results/A.json benchmarks/results/B.json
+
+Runs every document through the single-document pipeline, then the same corpus through the
+batch path, and reports per-stage latency percentiles, docs/min, peak RSS and peak temp-disk
+usage. Each run is saved under benchmarks/results/ tagged with the git commit so runs on
+different commits can be compared with --compare.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT_DIR, "benchmarks", "results")
+PERCENTILES = (50, 90, 95, 99)
+SAMPLE_INTERVAL = 0.1
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(values: list) -> dict:
+    values = sorted(values)
+    summary = {f"p{p}": round(percentile(values, p), 4) for p in PERCENTILES}
+    summary["mean"] = round(sum(values) / len(values), 4) if values else 0.0
+    summary["max"] = round(values[-1], 4) if values else 0.0
+    summary["count"] = len(values)
+    return summary
+
+
+def stage_percentiles(records: list) -> dict:
+    stages = {}
+    for record in records:
+        for stage, seconds in record.get("timings", {}).items():
+            stages.setdefault(stage, []).append(seconds)
+    return {stage: summarize(values) for stage, values in stages.items()}
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # Temp files come and go while we walk
+                pass
+    return total
+
+
+def current_rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ResourceSampler:
+    """Samples this process's RSS and the growth of the temp directory while a phase runs."""
+
+    def __init__(self, temp_dir: str = tempfile.gettempdir(), interval: float = SAMPLE_INTERVAL):
+        self.temp_dir = temp_dir
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_temp_bytes = 0
+        self._stop = threading.Event()
+
+    def _run(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, current_rss())
+            self.peak_temp_bytes = max(self.peak_temp_bytes, dir_size(self.temp_dir) - self._baseline)
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self._baseline = dir_size(self.temp_dir)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def result(self) -> dict:
+        return {
+            "peak_rss_mb": round(self.peak_rss / 1024 ** 2, 1),
+            "peak_temp_disk_mb": round(max(0, self.peak_temp_bytes) / 1024 ** 2, 2),
+        }
+
+
+def git_revision() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=ROOT_DIR, capture_output=True, text=True, timeout=30).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ""
+    return {"commit": git("rev-parse", "HEAD"), "subject": git("log", "-1", "--format=%s"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_single(paths: list) -> dict:
+    """Each document through the same pipeline process_pdf runs, one at a time."""
+    from src.main import run_pipeline
+
+    records, errors = [], []
+    started = time.perf_counter()
+    with ResourceSampler() as sampler:
+        for path in paths:
+            doc_start = time.perf_counter()
+            try:
+                result = run_pipeline(path, progress=lambda *args, **kwargs: None, use_cache=False)
+            except Exception as e:
+                errors.append({"source": path, "error": f"{type(e).__name__}: {e}"})
+                continue
+            timings = dict(result["timings"])
+            timings["total"] = round(time.perf_counter() - doc_start, 4)
+            records.append({"source": path, "timings": timings, "route": result["route"]})
+    elapsed = time.perf_counter() - started
+    return {
+        "docs": len(paths),
+        "ok": len(records),
+        "errors": errors,
+        "elapsed_seconds": round(elapsed, 3),
+        "docs_per_minute": round(len(records) / elapsed * 60, 2) if elapsed > 0 else 0.0,
+        "stages": stage_percentiles(records),
+        **sampler.result(),
+    }
+
+
+def run_batch_path(paths: list, work_dir: str, cpu_workers: int, model_workers: int) -> dict:
+    from src.batch import run_batch
+
+    output_path = os.path.join(work_dir, "batch.jsonl")
+    with ResourceSampler() as sampler:
+        summary = run_batch(paths, output_path, cpu_workers=cpu_workers, model_workers=model_workers,
+                            use_cache=False, resume=False)
+    with open(output_path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    return {
+        "docs": summary["total"],
+        "ok": summary["ok"],
+        "errors": [{"source": r["source"], "stage": r["stage"], "error": r["error"]} for r in records if r["status"] != "ok"],
+        "elapsed_seconds": summary["elapsed_seconds"],
+        "docs_per_minute": summary["docs_per_minute"],
+        "pages_per_second": summary["pages_per_second"],
+        "stages": stage_percentiles([r for r in records if r["status"] == "ok"]),
+        **sampler.result(),
+        # Worker processes are reaped when the pool shuts down, so their peak is known by now
+        "peak_worker_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def run(args) -> dict:
+    work_dir = tempfile.mkdtemp(prefix="receipt-bench-", dir=args.work_dir)
+    ports = [args.port + i for i in range(args.backends)] if args.port else [free_port() for _ in range(args.backends)]
+
+    # Point the pipeline at the stubs and at throwaway caches before any src module reads its config
+    os.environ["OLLAMA_HOST"] = f"http://127.0.0.1:{ports[0]}"
+    os.environ["OLLAMA_HOSTS"] = ",".join(f"http://127.0.0.1:{port}" for port in ports)
+    os.environ["RESULT_CACHE_DIR"] = os.path.join(work_dir, "cache")
+    os.environ["TEXT_CACHE_DIR"] = os.path.join(work_dir, "text")
+    os.environ["DEDUPE_INDEX_PATH"] = os.path.join(work_dir, "dedupe", "index.db")
+    os.environ["EMBEDDING_INDEX_DIR"] = os.path.join(work_dir, "embeddings")
+    os.environ["TRACE_PATH"] = os.path.join(work_dir, "traces.jsonl")
+    sys.path.insert(0, ROOT_DIR)
+
+    from benchmarks.synth import generate_corpus
+    from benchmarks.stub_server import StubOllamaServer
+    from src.context_builder import get_page_text_cache
+
+    try:
+        manifest = generate_corpus(os.path.join(work_dir, "corpus"), args.docs, args.min_pages, args.max_pages,
+                                   args.scanned_ratio, args.seed)
+        paths = [entry["path"] for entry in manifest]
+
+        stubs = [
+            StubOllamaServer(port=port, latency=args.latency, image_latency=args.image_latency, token_rate=args.token_rate).start()
+            for port in ports
+        ]
+        try:
+            results = {"single": run_single(paths)} if not args.batch_only else {}
+            if not args.single_only:
+                # Both phases bypass the result cache; the page-text cache has to start cold as well
+                # or the batch phase never parses a PDF
+                get_page_text_cache().clear()
+                results["batch"] = run_batch_path(paths, work_dir, args.cpu_workers, args.model_workers)
+            stub_stats = stubs[0].stats if len(stubs) == 1 else [stub.stats for stub in stubs]
+        finally:
+            for stub in stubs:
+                stub.stop()
+    finally:
+        if not args.keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "label": args.label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git": git_revision(),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {
+            "docs": args.docs, "min_pages": args.min_pages, "max_pages": args.max_pages,
+            "scanned_ratio": args.scanned_ratio, "seed": args.seed, "latency": args.latency,
+            "image_latency": args.image_latency, "token_rate": args.token_rate,
+            "cpu_workers": args.cpu_workers, "model_workers": args.model_workers, "backends": args.backends,
+        },
+        "corpus": {
+            "docs": len(manifest),
+            "pages": sum(entry["pages"] for entry in manifest),
+            "scanned": sum(entry["kind"] == "scanned" for entry in manifest),
+            "line_items": sum(entry["line_items"] for entry in manifest),
+        },
+        "stub": stub_stats,
+        **results,
+    }
+
+
+def save(report: dict, results_dir: str = RESULTS_DIR) -> str:
+    os.makedirs(results_dir, exist_ok=True)
+    commit = (report["git"]["commit"] or "nogit")[:8] + ("-dirty" if report["git"]["dirty"] else "")
+    name = f"{report['timestamp'].replace(':', '')}-{commit}" + (f"-{report['label']}" if report["label"] else "")
+    path = os.path.join(results_dir, name + ".json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return path
+
+
+def print_report(report: dict):
+    for phase in ("single", "batch"):
+        if phase not in report:
+            continue
+        result = report[phase]
+        print(f"\n== {phase}: {result['ok']}/{result['docs']} ok, {result['docs_per_minute']} docs/min, "
+              f"peak RSS {result['peak_rss_mb']} MB, peak temp disk {result['peak_temp_disk_mb']} MB")
+        print(f"{'stage':<24}" + "".join(f"{'p' + str(p):>10}" for p in PERCENTILES) + f"{'max':>10}")
+        for stage, stats in result["stages"].items():
+            print(f"{stage:<24}" + "".join(f"{stats['p' + str(p)]:>10.3f}" for p in PERCENTILES) + f"{stats['max']:>10.3f}")
+        for error in result["errors"][:5]:
+            print(f"  error: {os.path.basename(error['source'])}: {error['error']}")
+
+
+def compare(old_path: str, new_path: str):
+    """Prints how the headline numbers moved between two saved runs."""
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"old: {old['git']['commit'][:8]} {old['git']['subject']}\nnew: {new['git']['commit'][:8]} {new['git']['subject']}")
+    if old["config"] != new["config"]:
+        print("Warning: runs used different benchmark settings; differences may not be regressions")
+
+    def row(name, a, b, lower_is_better=True):
+        change = (b - a) / a * 100 if a else 0.0
+        worse = change > 0 if lower_is_better else change < 0
+        flag = "  <-- regression" if worse and abs(change) >= 10 else ""
+        print(f"{name:<40}{a:>12.3f}{b:>12.3f}{change:>+10.1f}%{flag}")
+
+    for phase in ("single", "batch"):
+        if phase not in old or phase not in new:
+            continue
+        print(f"\n== {phase}\n{'metric':<40}{'old':>12}{'new':>12}{'change':>11}")
+        row("docs_per_minute", old[phase]["docs_per_minute"], new[phase]["docs_per_minute"], lower_is_better=False)
+        row("peak_rss_mb", old[phase]["peak_rss_mb"], new[phase]["peak_rss_mb"])
+        row("peak_temp_disk_mb", old[phase]["peak_temp_disk_mb"], new[phase]["peak_temp_disk_mb"])
+        for stage in sorted(set(old[phase]["stages"]) & set(new[phase]["stages"])):
+            for p in ("p50", "p90"):
+                row(f"{stage} {p}", old[phase]["stages"][stage][p], new[phase]["stages"][stage][p])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline offline against a stub model server.")
+    parser.add_argument("--docs", type=int, default=20)
+    parser.add_argument("--min-pages", type=int, default=1)
+    parser.add_argument("--max-pages", type=int, default=50)
+    parser.add_argument("--scanned-ratio", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.3, help="stub seconds before the first token")
+    parser.add_argument("--image-latency", type=float, default=0.05, help="stub extra seconds per image")
+    parser.add_argument("--token-rate", type=float, default=40.0, help="stub tokens per second")
+    parser.add_argument("--port", type=int, default=0, help="first stub server port (default: any free ports)")
+    parser.add_argument("--backends", type=int, default=1, help="stub servers to spread model calls over")
+    parser.add_argument("--cpu-workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--model-workers", type=int, default=2)
+    parser.add_argument("--single-only", action="store_true", help="skip the batch path")
+    parser.add_argument("--batch-only", action="store_true", help="skip the single-document path")
+    parser.add_argument("--label", default="", help="suffix for the saved result file")
+    parser.add_argument("--work-dir", default=None, help="where the corpus and caches are created")
+    parser.add_argument("--keep-work-dir", action="store_true")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two saved result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args)
+    print_report(report)
+    print(f"\nSaved {save(report)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+Stub server speaking enough of the Ollama HTTP API (/api/chat, /api/embed, /api/tags) to
+run the pipeline offline with controllable timing.
+
+Each chat request waits `latency` seconds plus `image_latency` per attached image (standing
+in for prompt evaluation), then emits its answer at `token_rate` tokens per second. Answers
+are generated from the request's `format` schema so structured calls validate, and the final
+chunk carries Ollama's usual token counts and durations.
+
+    python -m benchmarks.stub_server --port 11500 --latency 0.3 --token-rate 40
+    python -m benchmarks.stub_server --port 11500 --count 3   # ports 11500-11502, for OLLAMA_HOSTS
+"""
+import json
+import time
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMBEDDING_DIM = 64
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1000
+STUB_LINE_ITEMS = 3
+
+
+def sample_from_schema(schema: dict, defs: dict = None, name: str = ""):
+    """A plausible value for a JSON schema, e.g. the Invoice schema sent as `format`."""
+    defs = defs if defs is not None else schema.get("$defs", {})
+    if "$ref" in schema:
+        return sample_from_schema(defs[schema["$ref"].rsplit("/", 1)[-1]], defs, name)
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            options = [option for option in schema[key] if option.get("type") != "null"]
+            return sample_from_schema(options[0] if options else {}, defs, name)
+    if "enum" in schema:
+        return schema["enum"][0]
+
+    kind = schema.get("type")
+    if kind == "object" or "properties" in schema:
+        return {key: sample_from_schema(value, defs, key) for key, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        count = STUB_LINE_ITEMS if name == "line_items" else 0
+        return [sample_from_schema(schema.get("items", {}), defs, name) for _ in range(count)]
+    if kind == "integer":
+        return 2
+    if kind == "number":
+        return 12.5
+    if kind == "boolean":
+        return False
+    if "date" in name:
+        return "2024-01-31"
+    if name == "currency":
+        return "USD"
+    return f"stub {name}".strip() if name else ""
+
+
+def answer_for(request: dict) -> str:
+    fmt = request.get("format")
+    if isinstance(fmt, dict):
+        return json.dumps(sample_from_schema(fmt))
+    system = " ".join(m.get("content", "") for m in request.get("messages", []) if m.get("role") == "system")
+    if '"vendor_name"' in system and "status" not in system:
+        return json.dumps({"vendor_name": ""})
+    if "NOT_FOUND" in system:
+        return json.dumps({"status": "NOT_FOUND", "searched_term": ""})
+    return json.dumps({"answer": "stub"})
+
+
+def embedding_for(text: str) -> list:
+    """Deterministic unit vector per text, so identical names embed identically."""
+    digest = hashlib.sha256(text.encode()).digest() * (EMBEDDING_DIM // 32)
+    vector = [b - 127.5 for b in digest[:EMBEDDING_DIM]]
+    norm = sum(v * v for v in vector) ** 0.5
+    return [v / norm for v in vector]
+
+
+class StubStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.images = 0
+        self.cancelled = 0
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "images": self.images,
+                "cancelled": self.cancelled,
+            }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, body: dict, status: int = 200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, body: dict):
+        data = json.dumps(body).encode() + b"\n"
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/version":
+            self._send_json({"version": "0.0.0-stub"})
+        elif self.path == "/api/tags":
+            self._send_json({"models": []})
+        elif self.path == "/api/stub/stats":
+            self._send_json(self.server.stats.snapshot())
+        else:
+            self._send_json({"status": "Ollama is running"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path == "/api/chat":
+            self._chat(request)
+        elif self.path == "/api/embed":
+            inputs = request.get("input", [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self._send_json({"model": request.get("model"), "embeddings": [embedding_for(text) for text in inputs]})
+        elif self.path == "/api/embeddings":
+            self._send_json({"embedding": embedding_for(request.get("prompt", ""))})
+        else:
+            self._send_json({"error": f"unknown endpoint {self.path}"}, status=404)
+
+    def _chat(self, request: dict):
+        server = self.server
+        stats = server.stats
+        messages = request.get("messages", [])
+        images = sum(len(m.get("images") or []) for m in messages)
+        with stats.lock:
+            stats.requests += 1
+            stats.images += images
+            stats.in_flight += 1
+            stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+
+        try:
+            started = time.perf_counter()
+            prompt_tokens = sum(len(m.get("content", "")) for m in messages) // CHARS_PER_TOKEN + images * IMAGE_TOKENS
+            time.sleep(server.latency + server.image_latency * images)
+            prompt_done = time.perf_counter()
+
+            content = answer_for(request)
+            tokens = [content[i:i + CHARS_PER_TOKEN] for i in range(0, len(content), CHARS_PER_TOKEN)]
+            model = request.get("model", "stub")
+
+            def final_chunk():
+                now = time.perf_counter()
+                return {
+                    "model": model,
+                    "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    "message": {"role": "assistant", "content": ""},
+                    "done": True,
+                    "done_reason": "stop",
+                    "total_duration": int((now - started) * 1e9),
+                    "load_duration": 0,
+                    "prompt_eval_count": prompt_tokens,
+                    "prompt_eval_duration": int((prompt_done - started) * 1e9),
+                    "eval_count": len(tokens),
+                    "eval_duration": int((now - prompt_done) * 1e9),
+                }
+
+            if not request.get("stream", True):
+                time.sleep(len(tokens) / server.token_rate)
+                body = final_chunk()
+                body["message"]["content"] = content
+                self._send_json(body)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for token in tokens:
+                    time.sleep(1 / server.token_rate)
+                    self._write_chunk({
+                        "model": model,
+                        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                        "message": {"role": "assistant", "content": token},
+                        "done": False,
+                    })
+                self._write_chunk(final_chunk())
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client stopped reading, e.g. once the JSON object was complete
+                with stats.lock:
+                    stats.cancelled += 1
+                self.close_connection = True
+        finally:
+            with stats.lock:
+                stats.in_flight -= 1
+
+
+class StubOllamaServer:
+    """A stub Ollama server on a background thread; `url` is what OLLAMA_HOST should point at."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.3,
+                 image_latency: float = 0.05, token_rate: float = 40.0):
+        self.httpd = ThreadingHTTPServer((host, port), StubHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.image_latency = image_latency
+        self.httpd.token_rate = token_rate
+        self.httpd.stats = StubStats()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def stats(self) -> dict:
+        return self.httpd.stats.snapshot()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="stub-ollama", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a stub Ollama server for offline benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--image-latency", type=float, default=0.05, help="extra seconds per attached image")
+    parser.add_argument("--token-rate", type=float, default=40.0, help="generated tokens per second")
+    parser.add_argument("--count", type=int, default=1, help="servers to run, on consecutive ports")
+    args = parser.parse_args(argv)
+
+    servers = [
+        StubOllamaServer(args.host, args.port + i, args.latency, args.image_latency, args.token_rate).start()
+        for i in range(args.count)
+    ]
+    print(f"Stub Ollama listening on {', '.join(server.url for server in servers)}")
+    if len(servers) > 1:
+        print(f"OLLAMA_HOSTS={','.join(server.url for server in servers)}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""
+Synthetic invoice PDFs for benchmarking.
+
+Digital invoices are written directly as PDF text operators, so they have a clean text
+layer. Scanned-looking invoices are drawn onto slightly rotated, noisy page images and
+saved as image-only PDFs, so they exercise the rendering and vision path.
+
+    python -m benchmarks.synth out_dir --docs 20 --max-pages 50
+"""
+import os
+import json
+import math
+import random
+import argparse
+
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+from src.config import VENDOR_DB_PATH
+
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792  # US Letter in points
+MARGIN = 50
+LINE_HEIGHT = 14
+SCAN_DPI = 150
+
+FALLBACK_VENDORS = ["Acme Industrial Supply LLC", "Northwind Traders Inc.", "Blue Harbor Logistics Ltd"]
+CUSTOMERS = ["Globex Corporation", "Initech Inc.", "Umbrella Retail Group", "Stark Components GmbH"]
+PRODUCTS = [
+    "Steel bracket", "Packing tape 48mm", "Pallet wrap", "Freight handling", "Consulting hours",
+    "Safety gloves (box)", "Label printer ribbon", "Cardboard box 40x30x30", "Forklift rental (day)",
+    "Cloud storage (month)", "Replacement filter", "Shipping insurance",
+]
+
+
+def _vendor_names():
+    try:
+        with open(VENDOR_DB_PATH, "r", encoding="utf-8") as f:
+            return [v["canonical_name"] for v in json.load(f).values()] or FALLBACK_VENDORS
+    except (OSError, ValueError, KeyError, AttributeError):
+        return FALLBACK_VENDORS
+
+
+def make_invoice(rng: random.Random, pages: int, line_items: int) -> dict:
+    """Random invoice data whose totals add up, laid out as one list of text lines per page."""
+    items = []
+    for _ in range(line_items):
+        quantity = rng.randint(1, 40)
+        unit_price = round(rng.uniform(1, 500), 2)
+        items.append({"description": rng.choice(PRODUCTS), "quantity": quantity, "unit_price": unit_price})
+    subtotal = round(sum(i["quantity"] * i["unit_price"] for i in items), 2)
+    tax = round(subtotal * 0.08, 2)
+    invoice = {
+        "invoice_number": f"INV-{rng.randint(10000, 99999)}",
+        "invoice_date": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        "vendor_name": rng.choice(_vendor_names()),
+        "vendor_address": f"{rng.randint(1, 999)} Commerce Way, Springfield",
+        "customer_name": rng.choice(CUSTOMERS),
+        "customer_address": f"{rng.randint(1, 999)} Market Street, Riverside",
+        "currency": "USD",
+        "line_items": items,
+        "subtotal": subtotal,
+        "tax": tax,
+        "total_amount": round(subtotal + tax, 2),
+    }
+
+    per_page = max(1, math.ceil(line_items / pages))
+    layout = []
+    for page in range(pages):
+        lines = [f"{invoice['vendor_name']}    Invoice {invoice['invoice_number']}    Page {page + 1} of {pages}", ""]
+        if page == 0:
+            lines += [
+                invoice["vendor_name"], invoice["vendor_address"], "",
+                f"Invoice Number: {invoice['invoice_number']}",
+                f"Invoice Date: {invoice['invoice_date']}", "",
+                "Bill To:", invoice["customer_name"], invoice["customer_address"], "",
+            ]
+        lines.append("Description                         Qty      Unit Price        Amount")
+        for item in items[page * per_page:(page + 1) * per_page]:
+            amount = item["quantity"] * item["unit_price"]
+            lines.append(f"{item['description']:<34}{item['quantity']:>5}{item['unit_price']:>16,.2f}{amount:>14,.2f}")
+        if page == pages - 1:
+            lines += [
+                "",
+                f"{'Subtotal':<55}{subtotal:>14,.2f}",
+                f"{'Tax (8%)':<55}{tax:>14,.2f}",
+                f"{'Total (USD)':<55}{invoice['total_amount']:>14,.2f}",
+            ]
+        layout.append(lines)
+    return {"invoice": invoice, "pages": layout}
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_digital_pdf(path: str, pages: list):
+    """Writes pages of text lines as a minimal PDF with a real text layer (Courier, so columns line up)."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>"]
+    kids = []
+    for lines in pages:
+        font_size = min(9, (PAGE_WIDTH - 2 * MARGIN) / (0.6 * max(len(line) for line in lines)))
+        ops = [f"BT /F1 {font_size:.2f} Tf {LINE_HEIGHT} TL {MARGIN} {PAGE_HEIGHT - MARGIN} Td"]
+        ops += [f"({_pdf_escape(line)}) Tj T*" for line in lines]
+        ops.append("ET")
+        stream = "\n".join(ops).encode("latin-1", "replace")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n".encode() + stream + b"\nendstream")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>"
+        )
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + (body if isinstance(body, bytes) else body.encode()) + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def write_scanned_pdf(path: str, pages: list, rng: random.Random):
+    """Draws the pages as noisy, slightly skewed greyscale scans and saves an image-only PDF."""
+    scale = SCAN_DPI / 72
+    size = (int(PAGE_WIDTH * scale), int(PAGE_HEIGHT * scale))
+    font = ImageFont.load_default(size=int(8 * scale))
+    images = []
+    for lines in pages:
+        page = Image.new("L", size, 255)
+        draw = ImageDraw.Draw(page)
+        y = MARGIN * scale
+        for line in lines:
+            draw.text((MARGIN * scale, y), line, fill=rng.randint(0, 60), font=font)
+            y += LINE_HEIGHT * scale
+        page = page.rotate(rng.uniform(-1.5, 1.5), resample=Image.BICUBIC, fillcolor=255)
+        noise = Image.effect_noise(size, 40)
+        page = Image.blend(page, noise, 0.12).filter(ImageFilter.GaussianBlur(0.6))
+        images.append(page)
+    images[0].save(path, save_all=True, append_images=images[1:], resolution=SCAN_DPI)
+
+
+def generate_corpus(out_dir: str, docs: int = 20, min_pages: int = 1, max_pages: int = 50,
+                    scanned_ratio: float = 0.3, seed: int = 0) -> list:
+    """
+    Writes `docs` invoices to `out_dir` and returns a manifest entry per file with its kind,
+    page and line-item counts and the ground-truth invoice. Page counts are skewed towards
+    short documents, as real invoices are, but always include one `max_pages` document.
+    """
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = []
+    for n in range(docs):
+        pages = max_pages if n == docs - 1 else min(max_pages, max(min_pages, int(rng.expovariate(1 / 4)) + 1))
+        line_items = rng.randint(pages * 3, pages * 30)
+        scanned = rng.random() < scanned_ratio
+        generated = make_invoice(rng, pages, line_items)
+        path = os.path.join(out_dir, f"invoice_{n:03d}_{'scanned' if scanned else 'digital'}_{pages}p.pdf")
+        if scanned:
+            write_scanned_pdf(path, generated["pages"], rng)
+        else:
+            write_digital_pdf(path, generated["pages"])
+        manifest.append({
+            "path": path,
+            "kind": "scanned" if scanned else "digital",
+            "pages": pages,
+            "line_items": line_items,
+            "bytes": os.path.getsize(path),
+            "invoice": generated["invoice"],
+        })
+
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic invoice PDFs.")
+    parser.add_argument("out_dir")
+    parser.add_argument("--docs", type=int, default=20)
+    parser.add_argument("--min-pages", type=int, default=1)
+    parser.add_argument("--max-pages", type=int, default=50)
+    parser.add_argument("--scanned-ratio", type=float, default=0.3, help="fraction of scanned-looking documents")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    manifest = generate_corpus(args.out_dir, args.docs, args.min_pages, args.max_pages, args.scanned_ratio, args.seed)
+    print(f"Wrote {len(manifest)} invoices ({sum(m['pages'] for m in manifest)} pages) to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Vendor resolution at scale: index build time and per-document lookup latency against a
+synthetic vendor master of --vendors entries, without the model.
+
+    python -m benchmarks.vendor_scale --vendors 100000 --lookups 200
+    python -m benchmarks.vendor_scale --compare benchmarks/results/A.json benchmarks/results/B.json
+
+Each lookup runs resolve_text on an invoice-like header naming a random vendor (its canonical
+name, an alias, or a misspelling), and a share of lookups name no vendor at all. Accuracy is
+the share of vendor-naming lookups resolved FOUND to the right vendor. Results are saved
+under benchmarks/results/ like benchmarks.run's.
+"""
+import os
+import json
+import time
+import random
+import argparse
+import platform
+
+from benchmarks.run import git_revision, save, summarize
+from src.vendor_resolver import VendorResolver
+
+SYLLABLES = [
+    "ka", "lor", "vel", "dra", "mon", "tis", "bre", "xan", "qui", "sol", "ner", "pha", "gro", "vin",
+    "tal", "mer", "zor", "cas", "lin", "dor", "ves", "tru", "bel", "nox", "ari", "fen", "hal", "orm",
+]
+TRADES = [
+    "logistics", "supply", "industrial", "technologies", "consulting", "freight", "foods", "packaging",
+    "electric", "medical", "systems", "trading", "services", "manufacturing", "software", "partners",
+]
+SUFFIXES = ["Inc.", "LLC", "Ltd", "GmbH", "Corp.", "Pvt. Ltd.", ""]
+HEADER_LINES = [
+    "INVOICE", "Invoice number: INV-{n}", "Invoice date: 2024-03-{d:02d}", "Bill to: Globex Corporation",
+    "123 Market Street, Riverside", "Payment terms: Net 30", "Description Qty Unit price Amount",
+    "Freight handling 3 120.00 360.00", "Subtotal 360.00", "Tax 28.80", "Total amount due 388.80",
+]
+
+
+def make_vendors(rng: random.Random, count: int) -> dict:
+    """Made-up company names: two invented words and a trade, with a few aliases."""
+    vendors = {}
+    while len(vendors) < count:
+        words = ["".join(rng.choices(SYLLABLES, k=3)) for _ in range(2)]
+        core = " ".join(w.capitalize() for w in words)
+        name = f"{core} {rng.choice(TRADES).capitalize()}"
+        aliases = [core] if rng.random() < 0.5 else []
+        if rng.random() < 0.3:
+            aliases.append("".join(w[0] for w in name.split()).upper())
+        vendors[f"V{len(vendors):07d}"] = {"canonical_name": f"{name} {rng.choice(SUFFIXES)}".strip(), "aliases": aliases}
+    return vendors
+
+
+def misspell(rng: random.Random, name: str) -> str:
+    i = rng.randrange(1, len(name) - 1)
+    return name[:i] + name[i + 1:]
+
+
+def make_document(rng: random.Random, vendors: dict, ids: list) -> tuple:
+    lines = [line.format(n=rng.randint(10000, 99999), d=rng.randint(1, 28)) for line in HEADER_LINES]
+    if rng.random() < 0.2:
+        return None, "\n".join(lines)
+    vendor_id = rng.choice(ids)
+    name = vendors[vendor_id]["canonical_name"]
+    mention = rng.choice([name, name, misspell(rng, name)])
+    lines.insert(rng.randint(0, 2), mention)
+    return vendor_id, "\n".join(lines)
+
+
+def run(args) -> dict:
+    rng = random.Random(args.seed)
+    vendors = make_vendors(rng, args.vendors)
+
+    started = time.perf_counter()
+    resolver = VendorResolver(vendors)
+    build_seconds = time.perf_counter() - started
+
+    ids = list(vendors)
+    documents = [make_document(rng, vendors, ids) for _ in range(args.lookups)]
+    timings, statuses, named, correct = [], {}, 0, 0
+    for vendor_id, text in documents:
+        started = time.perf_counter()
+        verdict = resolver.resolve_text(text)
+        timings.append(time.perf_counter() - started)
+        statuses[verdict["status"]] = statuses.get(verdict["status"], 0) + 1
+        if vendor_id is not None:
+            named += 1
+            correct += int(verdict["status"] == "FOUND" and verdict["id"] == vendor_id)
+
+    return {
+        "kind": "vendor_scale",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "label": args.label or f"vendors-{args.vendors}",
+        "git": git_revision(),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {"vendors": args.vendors, "lookups": args.lookups, "seed": args.seed},
+        "index": {"entries": len(resolver.entries), "grams": len(resolver.index), "build_seconds": round(build_seconds, 3)},
+        "resolve_text_seconds": summarize(timings),
+        "statuses": statuses,
+        "accuracy": round(correct / named, 4) if named else 0.0,
+    }
+
+
+def print_report(report: dict):
+    index, latency = report["index"], report["resolve_text_seconds"]
+    print(f"{report['config']['vendors']} vendors, {index['entries']} names, {index['grams']} trigrams: built in {index['build_seconds']:.2f}s")
+    print(f"resolve_text: p50 {latency['p50'] * 1000:.1f} ms, p95 {latency['p95'] * 1000:.1f} ms, max {latency['max'] * 1000:.1f} ms")
+    print(f"verdicts: {report['statuses']}, accuracy on named vendors: {report['accuracy']:.1%}")
+
+
+def compare(old_path: str, new_path: str):
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"old: {old['git']['commit'][:8]} {old['git']['subject']}\nnew: {new['git']['commit'][:8]} {new['git']['subject']}")
+    if old["config"] != new["config"]:
+        print("Warning: runs used different benchmark settings; differences may not be regressions")
+    print(f"\n{'metric':<40}{'old':>12}{'new':>12}{'change':>11}")
+
+    def row(name, a, b, lower_is_better=True):
+        change = (b - a) / a * 100 if a else 0.0
+        worse = change > 0 if lower_is_better else change < 0
+        flag = "  <-- regression" if worse and abs(change) >= 10 else ""
+        print(f"{name:<40}{a:>12.4f}{b:>12.4f}{change:>+10.1f}%{flag}")
+
+    row("build_seconds", old["index"]["build_seconds"], new["index"]["build_seconds"])
+    for p in ("p50", "p95", "max"):
+        row(f"resolve_text {p}", old["resolve_text_seconds"][p], new["resolve_text_seconds"][p])
+    row("accuracy", old["accuracy"], new["accuracy"], lower_is_better=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure vendor index build time and lookup latency at scale.")
+    parser.add_argument("--vendors", type=int, default=100000)
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label", default="", help="suffix for the saved result file (default: vendors-N)")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two saved result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args)
+    print_report(report)
+    if not args.no_save:
+        print(f"\nSaved {save(report)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Batch extraction over directories or globs of invoice PDFs.
+
+    python -m src.batch invoices/ "archive/2024-*/*.pdf" -o results.jsonl
+
+Rendering and text extraction run in a process pool while model calls run in a bounded
+thread pool, with rendered documents prefetched ahead of the model so it never waits on
+PDF work. Each finished file is appended to the JSONL output as soon as it completes, and
+files already recorded as "ok" in that output are skipped on restart.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .config import OLLAMA_HOSTS
+from .main import prepare_document, extract_document, pipeline_cache_key, mark_cache_hit
+from .result_cache import get_result_cache
+from .schema import get_validation_stats
+from .tracing import start_metrics_server
+from .ollama_client import get_client
+
+DEFAULT_CPU_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+# Two documents in flight per model server keeps each busy while the other's result is parsed
+DEFAULT_MODEL_WORKERS = 2 * len(OLLAMA_HOSTS)
+
+
+def iter_pdfs(inputs):
+    """Expands directories (recursively) and glob patterns into a sorted, de-duplicated list of PDFs."""
+    found = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = glob.glob(os.path.join(item, "**", "*.pdf"), recursive=True)
+            matches += glob.glob(os.path.join(item, "**", "*.PDF"), recursive=True)
+        else:
+            matches = glob.glob(item, recursive=True)
+        found.update(os.path.abspath(m) for m in matches if os.path.isfile(m))
+    return sorted(found)
+
+
+def load_finished(output_path):
+    """Source paths that already have a successful record in the output file."""
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A partially written last line from an interrupted run
+                continue
+            if record.get("status") == "ok":
+                finished.add(record["source"])
+    return finished
+
+
+def _error_record(pdf_path, stage, error):
+    return {
+        "source": pdf_path,
+        "status": "error",
+        "stage": stage,
+        "error": f"{type(error).__name__}: {error}",
+        "traceback": "".join(traceback.format_exception(type(error), error, error.__traceback__)),
+    }
+
+
+def run_batch(pdf_paths, output_path, cpu_workers=DEFAULT_CPU_WORKERS, model_workers=DEFAULT_MODEL_WORKERS,
+              use_cache=True, resume=True):
+    """Processes `pdf_paths`, streaming one JSON record per file to `output_path`, and returns a summary."""
+    finished = load_finished(output_path) if resume else set()
+    pending = [p for p in pdf_paths if p not in finished]
+    cache = get_result_cache() if use_cache else None
+
+    summary = {
+        "total": len(pdf_paths),
+        "skipped": len(pdf_paths) - len(pending),
+        "ok": 0,
+        "errors": 0,
+        "cached": 0,
+        "duplicates": 0,
+        "pages": 0,
+        "pages_rasterized": 0,
+        "routes": {"text": 0, "mixed": 0, "vision": 0},
+        "stage_seconds": {},
+    }
+
+    # Rendered documents allowed to wait for the model; enough to keep every model slot busy
+    max_prefetch = model_workers * 2 + cpu_workers
+    started = time.perf_counter()
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "a" if resume else "w", encoding="utf-8") as out, \
+            ProcessPoolExecutor(max_workers=cpu_workers) as cpu_pool, \
+            ThreadPoolExecutor(max_workers=model_workers) as model_pool:
+
+        def emit(record):
+            # Page images and text stay in memory (and in the result cache); the route records how many were sent
+            record.pop("images", None)
+            record.pop("invoice_text", None)
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            if record["status"] == "ok":
+                summary["ok"] += 1
+                summary["cached"] += int(record.get("cached", False))
+                summary["duplicates"] += int(bool((record.get("duplicate_of") or {}).get("reused")))
+                route = record.get("route") or {}
+                summary["pages"] += route.get("pages_total", 0)
+                summary["pages_rasterized"] += route.get("images_sent", 0)
+                if route.get("mode") in summary["routes"]:
+                    summary["routes"][route["mode"]] += 1
+                for stage, seconds in ({} if record.get("cached") else record.get("timings", {})).items():
+                    summary["stage_seconds"][stage] = summary["stage_seconds"].get(stage, 0.0) + seconds
+            else:
+                summary["errors"] += 1
+                print(f"Warning: {record['source']} failed during {record['stage']}: {record['error']}", file=sys.stderr)
+
+        queue = iter(pending)
+        in_flight = {}
+        cache_keys = {}
+
+        def submit_next():
+            for pdf_path in queue:
+                if cache is not None:
+                    try:
+                        cache_keys[pdf_path] = pipeline_cache_key(pdf_path)
+                        cached = cache.get(cache_keys[pdf_path])
+                    except Exception as e:
+                        emit(_error_record(pdf_path, "cache", e))
+                        continue
+                    if cached is not None:
+                        emit({"source": pdf_path, "status": "ok", **mark_cache_hit(pdf_path, cached)})
+                        continue
+                future = cpu_pool.submit(prepare_document, pdf_path)
+                in_flight[future] = ("prepare", pdf_path)
+                return True
+            return False
+
+        while len(in_flight) < max_prefetch and submit_next():
+            pass
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, pdf_path = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    emit(_error_record(pdf_path, stage, e))
+                else:
+                    if stage == "prepare":
+                        in_flight[model_pool.submit(extract_document, result, None, use_cache)] = ("extract", pdf_path)
+                    else:
+                        if pdf_path in cache_keys:
+                            try:
+                                cache.put(cache_keys.pop(pdf_path), result)
+                            except Exception as e:
+                                print(f"Warning: Could not cache result for {pdf_path}. Error: {e}", file=sys.stderr)
+                        emit({"source": pdf_path, "status": "ok", **result})
+
+                while len(in_flight) < max_prefetch and submit_next():
+                    pass
+
+    elapsed = time.perf_counter() - started
+    processed = summary["ok"] + summary["errors"]
+    summary["elapsed_seconds"] = round(elapsed, 3)
+    summary["docs_per_minute"] = round(processed / elapsed * 60, 2) if elapsed > 0 else 0.0
+    summary["pages_per_second"] = round(summary["pages"] / elapsed, 3) if elapsed > 0 else 0.0
+    fresh = summary["ok"] - summary["cached"]
+    summary["mean_stage_seconds"] = {
+        stage: round(total / fresh, 4) for stage, total in summary["stage_seconds"].items()
+    } if fresh else {}
+    del summary["stage_seconds"]
+    summary["validation"] = get_validation_stats()
+    if cache is not None:
+        summary["cache"] = cache.stats()
+    summary["model_endpoints"] = get_client().stats()
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract structured data from many invoice PDFs.")
+    parser.add_argument("inputs", nargs="+", help="PDF files, directories (searched recursively) or glob patterns")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--cpu-workers", type=int, default=DEFAULT_CPU_WORKERS, help="processes for rendering and text extraction")
+    parser.add_argument("--model-workers", type=int, default=DEFAULT_MODEL_WORKERS, help="concurrent model requests")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the result cache")
+    parser.add_argument("--no-resume", action="store_true", help="overwrite the output instead of skipping finished files")
+    parser.add_argument("--metrics-port", type=int, default=0, help="serve Prometheus metrics on this port while running")
+    args = parser.parse_args(argv)
+
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    pdf_paths = iter_pdfs(args.inputs)
+    if not pdf_paths:
+        parser.error("no PDF files matched the given inputs")
+
+    summary = run_batch(
+        pdf_paths,
+        args.output,
+        cpu_workers=args.cpu_workers,
+        model_workers=args.model_workers,
+        use_cache=not args.no_cache,
+        resume=not args.no_resume,
+    )
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
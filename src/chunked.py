@@ -0,0 +1,201 @@
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .config import SYSTEM_PROMPT, CHUNK_WINDOW_PAGES, CHUNK_MAX_WORKERS, RECONCILE_TOLERANCE
+from .invoice_processor import execute_prompt, clean_and_parse_json
+from .schema import INVOICE_JSON_SCHEMA, Invoice, coerce_number
+
+HEADER_FIELDS = [name for name in Invoice.model_fields if name != "line_items"]
+
+HEADER_INSTRUCTION = "These are only the first and last pages of a longer invoice. Extract the header and summary fields (parties, invoice number and date, currency, subtotal, tax and total); the line items are extracted separately."
+LINE_ITEMS_INSTRUCTION = "\n".join([
+    "These are pages {first} to {last} of a {total}-page invoice.",
+    "Return ONLY the line items printed on these pages, in the order they appear, as {{\"line_items\": [...]}}.",
+    "Do not include subtotal, tax, total or carried-forward rows. If a row is cut off at the top or bottom of a page, include the part that is visible.",
+    "--- EXTRACTED TEXT ---\n{text}\n--- END TEXT ---",
+])
+
+
+def header_schema() -> dict:
+    return {
+        "type": "object",
+        "properties": {name: INVOICE_JSON_SCHEMA["properties"][name] for name in HEADER_FIELDS},
+        "required": HEADER_FIELDS,
+    }
+
+
+def line_items_schema() -> dict:
+    return {
+        "type": "object",
+        "properties": {"line_items": {"type": "array", "items": INVOICE_JSON_SCHEMA["$defs"]["LineItem"]}},
+        "required": ["line_items"],
+    }
+
+
+def page_windows(pages_total: int, window: int = CHUNK_WINDOW_PAGES) -> list:
+    """Non-overlapping (first, last) 1-based page ranges covering the document."""
+    return [(first, min(first + window - 1, pages_total)) for first in range(1, pages_total + 1, window)]
+
+
+def window_inputs(prepared: dict, pages) -> tuple:
+    """The clean text and the rendered images for the given 1-based pages of a prepared document."""
+    page_texts = prepared.get("page_texts") or []
+    text = "\n".join(page_texts[page - 1] for page in pages if page <= len(page_texts) and page_texts[page - 1])
+    image_pages = (prepared.get("route") or {}).get("image_pages") or []
+    images = [image for page, image in zip(image_pages, prepared["images"]) if page in pages]
+    return text, images
+
+
+def _message(content: str, images: list) -> dict:
+    message = {'role': 'user', 'content': content}
+    if images:
+        message['images'] = images
+    return message
+
+
+def extract_header(parsing_query: str, images: list, usage=None) -> dict:
+    messages = [
+        {'role': 'system', 'content': SYSTEM_PROMPT},
+        _message(f"{parsing_query}\n{HEADER_INSTRUCTION}", images),
+    ]
+    return clean_and_parse_json(execute_prompt(messages, format=header_schema(), usage=usage))
+
+
+def extract_window(prepared: dict, first: int, last: int, usage=None) -> list:
+    text, images = window_inputs(prepared, range(first, last + 1))
+    total = (prepared.get("route") or {}).get("pages_total", last)
+    prompt = LINE_ITEMS_INSTRUCTION.format(first=first, last=last, total=total, text=text)
+    messages = [{'role': 'system', 'content': SYSTEM_PROMPT}, _message(prompt, images)]
+    answer = clean_and_parse_json(execute_prompt(messages, format=line_items_schema(), usage=usage))
+    items = answer.get("line_items")
+    return [item for item in items if isinstance(item, dict)] if isinstance(items, list) else []
+
+
+def _number(value):
+    try:
+        return coerce_number(value)
+    except ValueError:
+        return value
+
+
+def _normalize(text) -> str:
+    return re.sub(r"\W+", " ", str(text or "").lower()).strip()
+
+
+def _is_duplicate(a: dict, b: dict) -> bool:
+    return (
+        _normalize(a.get("description")) == _normalize(b.get("description"))
+        and _number(a.get("quantity")) == _number(b.get("quantity"))
+        and _number(a.get("unit_price")) == _number(b.get("unit_price"))
+    )
+
+
+def _is_split(a: dict, b: dict) -> bool:
+    """`a` ends one page and `b` starts the next, and one of them is only a description fragment."""
+    def numbers(item):
+        return sum(item.get(field) not in (None, "") for field in ("quantity", "unit_price"))
+    return sorted([numbers(a), numbers(b)]) == [0, 2]
+
+
+def merge_line_items(windows: list) -> tuple:
+    """
+    Concatenates per-window line items in page order. At each window boundary a row that
+    was read twice is kept once, and a row split across the page break (description on one
+    side, quantity or price on the other) is merged back together. Returns (items, merged_rows).
+    """
+    items, merged = [], 0
+    for window in windows:
+        window = list(window)
+        if items and window:
+            last, first = items[-1], window[0]
+            if _is_duplicate(last, first):
+                window.pop(0)
+                merged += 1
+            elif _is_split(last, first):
+                description = " ".join(part for part in (str(last.get("description") or "").strip(), str(first.get("description") or "").strip()) if part)
+                items[-1] = {
+                    "description": description,
+                    "quantity": last.get("quantity") if last.get("quantity") not in (None, "") else first.get("quantity"),
+                    "unit_price": last.get("unit_price") if last.get("unit_price") not in (None, "") else first.get("unit_price"),
+                }
+                window.pop(0)
+                merged += 1
+        items.extend(window)
+    return items, merged
+
+
+def _close(a: float, b: float) -> bool:
+    return abs(a - b) <= RECONCILE_TOLERANCE * max(1.0, abs(a), abs(b))
+
+
+def reconcile(invoice: dict) -> tuple:
+    """
+    Checks the validated invoice's subtotal and total against its line items. Missing totals
+    are filled in from the items; totals printed on the document are kept but flagged when
+    they disagree. Returns (invoice, report).
+    """
+    priced = [item for item in invoice.get("line_items", []) if item.get("quantity") is not None and item.get("unit_price") is not None]
+    items_subtotal = round(sum(item["quantity"] * item["unit_price"] for item in priced), 2)
+    report = {"items_subtotal": items_subtotal, "filled": [], "issues": []}
+    subtotal, tax, total = invoice.get("subtotal"), invoice.get("tax"), invoice.get("total_amount")
+
+    if subtotal is None and priced:
+        invoice["subtotal"] = subtotal = items_subtotal
+        report["filled"].append("subtotal")
+    elif subtotal is not None and priced and not _close(subtotal, items_subtotal):
+        report["issues"].append(f"subtotal {subtotal} differs from the line items' sum {items_subtotal}")
+
+    if total is None and subtotal is not None:
+        invoice["total_amount"] = round(subtotal + (tax or 0.0), 2)
+        report["filled"].append("total_amount")
+    elif total is not None and subtotal is not None and not _close(total, subtotal + (tax or 0.0)):
+        report["issues"].append(f"total_amount {total} differs from subtotal + tax {round(subtotal + (tax or 0.0), 2)}")
+
+    report["consistent"] = not report["issues"]
+    return invoice, report
+
+
+def stream_chunked_extraction(prepared: dict, parsing_query: str, header_images: list, trace):
+    """
+    Map-reduce extraction for long documents: one call for the header and summary fields
+    (`parsing_query` and `header_images` cover only the first and last pages) and one per
+    page window for the line items, all running concurrently, so latency follows the slowest
+    window rather than the page count. Yields ("partial", data) as calls finish, then
+    ("final", info) where info holds the merged `data` and `failed_windows` whose call failed.
+    """
+    pages_total = prepared["route"]["pages_total"]
+    windows = page_windows(pages_total)
+
+    results = {}
+    failed = []
+    header = None
+    with ThreadPoolExecutor(max_workers=CHUNK_MAX_WORKERS) as pool:
+        def run(name, fn, *args, **attributes):
+            def call():
+                with trace.span(name, **attributes) as span:
+                    return fn(*args, usage=span)
+            return pool.submit(call)
+
+        futures = {run("extract_header", extract_header, parsing_query, header_images, images=len(header_images)): "header"}
+        for first, last in windows:
+            futures[run("extract_line_items", extract_window, prepared, first, last, pages=[first, last])] = (first, last)
+
+        for future in as_completed(futures):
+            key = futures[future]
+            if key == "header":
+                # Without the header there is no invoice; let the caller's error handling take it
+                header = future.result()
+            else:
+                try:
+                    results[key] = future.result()
+                except Exception as e:
+                    print(f"Warning: Line items for pages {key[0]}-{key[1]} failed, continuing without them. Error: {e}")
+                    failed.append(list(key))
+                    results[key] = []
+            partial = dict(header or {})
+            partial["line_items"] = [item for window in sorted(results) for item in results[window]]
+            yield "partial", partial
+
+    items, merged_rows = merge_line_items(results[window] for window in windows)
+    data = {**header, "line_items": items}
+    yield "final", {"data": data, "windows": len(windows), "failed_windows": sorted(failed), "merged_rows": merged_rows}
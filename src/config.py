@@ -1,50 +1,138 @@
+import os
+
+from .schema import schema_outline
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 MODEL = "qwen2.5vl:7b"
 EMBEDDING_MODEL = "nomic-embed-text"
 
-SYSTEM_PROMPT = """
+# The structure itself is defined once, by the Invoice model in src/schema.py
+SYSTEM_PROMPT = f"""
 You are an expert at processing invoices. Your task is to extract information from the
 invoice text provided and return it ONLY as a valid JSON object. Do not add any
 introductory text, explanations, or markdown formatting around the JSON.
 
 The required JSON structure is, make sure to ignore any filed which is not available, for those the content should be empty string:
-{
-    "invoice_number": "string",  
-    "invoice_date": "string",
-    "vendor_name": "string",
-    "vendor_id": "string",
-    "vendor_address": "string",
-    "customer_name": "string",
-    "customer_address": "string",
-    "currency": "string",
-    "line_items": [
-        {
-        "description": "string",
-        "quantity": "integer",
-        "unit_price": "float"
-        }
-    ],
-    "subtotal": "float",
-    "tax": "float",
-    "total_amount": "float"
-}
+{schema_outline()}
+Amounts and quantities are plain numbers without currency symbols, and dates use YYYY-MM-DD.
 """
 
-MOCK_DATABASE = {
-    "123-ABC": {
-        "canonical_name": "XPO Logistics, Inc.",
-        "aliases": ["XPO Logistics", "RXO Logistics"]
-    },
-    "456-DEF": {
-        "canonical_name": "Kirby and Partners LLC",
-        "aliases": ["Kirby and Valdez", "K&V"]
-    },
-    "789-GHI": {
-        "canonical_name": "Stellapps",
-        "aliases": ["Stellapps Technologies", "Stellapps Technologies pvt. ltd."] 
-    },
-    "111-JKL": {
-        "canonical_name": "Georgia Institute of Technology",
-        "aliases": ["GeorgiaTech", "GT", "GaTech"] 
-    }   
-}
\ No newline at end of file
+# Vendor master used for entity resolution. Either a JSON file shaped like
+# {"<id>": {"canonical_name": ..., "aliases": [...]}} or a SQLite database with a
+# `vendors(id, canonical_name, aliases)` table (aliases stored as a JSON list).
+VENDOR_DB_PATH = os.environ.get("VENDOR_DB_PATH", os.path.join(BASE_DIR, "data", "vendors.json"))
+
+# A local match is accepted without asking the model when the best candidate scores at
+# least VENDOR_MATCH_THRESHOLD and beats the runner-up by VENDOR_AMBIGUITY_MARGIN.
+VENDOR_MATCH_THRESHOLD = 0.75
+VENDOR_AMBIGUITY_MARGIN = 0.15
+# Anything below this is treated as "no plausible candidate".
+VENDOR_MIN_SCORE = 0.35
+# Aliases of at most VENDOR_SHORT_ALIAS_CHARS characters, or single capitalised words such as
+# "GT" or "K&V", turn up by accident in free text. Unless they stand alone on a line or next to
+# a legal suffix or vendor label, they score at most VENDOR_SHORT_ALIAS_SCORE (below the match
+# threshold), so the model decides.
+VENDOR_SHORT_ALIAS_CHARS = 3
+VENDOR_SHORT_ALIAS_SCORE = 0.6
+# How many candidates the model gets to see when a match is too close to call.
+VENDOR_LLM_CANDIDATES = 5
+# Trigrams shared by more names than this (" in", "ing") narrow nothing down, and walking
+# their postings dominates lookups on large vendor masters, so the shortlist skips them.
+VENDOR_MAX_GRAM_POSTINGS = 2000
+
+# Embedding retrieval over the vendor master. Vectors are persisted here as a NumPy matrix
+# and only the rows for new or changed names are re-embedded when the vendor store changes.
+EMBEDDING_INDEX_DIR = os.environ.get("EMBEDDING_INDEX_DIR", os.path.join(BASE_DIR, "data", "vendor_embeddings"))
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_TOP_K = 5
+EMBEDDING_MIN_SCORE = 0.75
+
+# Content-addressed cache of finished extractions (keyed on PDF bytes, model, prompts and
+# vendor-DB version), evicted least-recently-used once it grows past the size limit.
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", os.path.join(BASE_DIR, "cache", "results"))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+# Shared Ollama client: one pooled connection set, a cap on in-flight requests, a per-attempt
+# timeout (seconds) and jittered exponential backoff for transient failures.
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_MAX_CONCURRENCY = int(os.environ.get("OLLAMA_MAX_CONCURRENCY", 4))
+OLLAMA_TIMEOUT = float(os.environ.get("OLLAMA_TIMEOUT", 300))
+OLLAMA_MAX_RETRIES = int(os.environ.get("OLLAMA_MAX_RETRIES", 3))
+OLLAMA_BACKOFF_BASE = 0.5
+OLLAMA_BACKOFF_MAX = 10.0
+
+# Several Ollama servers can share the load: OLLAMA_HOSTS is a comma-separated list (default:
+# just OLLAMA_HOST), each allowed OLLAMA_MAX_CONCURRENCY requests at once. Calls go to the
+# healthy server with the fewest outstanding requests; a server is taken out after
+# OLLAMA_UNHEALTHY_AFTER consecutive failures and probed every OLLAMA_HEALTH_INTERVAL seconds.
+OLLAMA_HOSTS = [host.strip() for host in os.environ.get("OLLAMA_HOSTS", OLLAMA_HOST).split(",") if host.strip()]
+OLLAMA_HEALTH_INTERVAL = float(os.environ.get("OLLAMA_HEALTH_INTERVAL", 10))
+OLLAMA_UNHEALTHY_AFTER = 2
+# Chat sessions remembered for endpoint affinity (least recently used are forgotten first)
+OLLAMA_MAX_SESSIONS = 10000
+
+# Text-layer fast path: pages whose extracted text scores at least TEXT_ROUTE_MIN_SCORE are
+# sent as text instead of being rasterized; only scanned or low-quality pages become images.
+# The threshold is above what length and clean characters score without any amount on the page.
+TEXT_FAST_PATH = os.environ.get("TEXT_FAST_PATH", "1") not in ("0", "false", "False")
+TEXT_ROUTE_MIN_CHARS = 200
+TEXT_ROUTE_MAX_GARBAGE = 0.02
+TEXT_ROUTE_MIN_SCORE = 0.7
+
+# Page rendering for the vision model. Pages are rendered in memory at RENDER_DPI, scaled so
+# the longest edge is at most RENDER_MAX_EDGE (roughly the model's native input resolution)
+# and encoded compactly; nothing is written to disk.
+RENDER_DPI = 110
+RENDER_MAX_EDGE = 1280
+RENDER_FORMAT = "JPEG"  # or "WEBP"
+RENDER_QUALITY = 85
+RENDER_THREADS = 4
+
+# Chat refinement sessions: the model is kept loaded between turns and the conversation is
+# capped at this many follow-up turns (the document context in the first turn is always kept).
+REFINEMENT_KEEP_ALIVE = os.environ.get("REFINEMENT_KEEP_ALIVE", "30m")
+REFINEMENT_MAX_TURNS = 20
+
+# Instrumentation: one JSONL trace line per processed document (empty disables) and a
+# Prometheus text endpoint served next to the app on METRICS_PORT (0 disables).
+TRACE_PATH = os.environ.get("TRACE_PATH", os.path.join(BASE_DIR, "logs", "traces.jsonl"))
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9108))
+# Once the extraction object is complete, the stream is read for up to this many seconds
+# more so Ollama's closing stats (prompt tokens, load and prompt-eval time) are recorded.
+STREAM_DRAIN_SECONDS = 2.0
+
+# Chunked (map-reduce) extraction for long documents: header and summary fields come from the
+# first and last pages, line items from windows of CHUNK_WINDOW_PAGES pages extracted
+# concurrently. Totals that disagree with the line items by more than RECONCILE_TOLERANCE
+# (relative) are flagged.
+CHUNKED_MIN_PAGES = int(os.environ.get("CHUNKED_MIN_PAGES", 8))  # 0 disables
+CHUNK_WINDOW_PAGES = 2
+CHUNK_MAX_WORKERS = OLLAMA_MAX_CONCURRENCY * len(OLLAMA_HOSTS)
+RECONCILE_TOLERANCE = 0.01
+
+# Durable job queue behind the UI and HTTP API: jobs live in a SQLite database, their PDFs
+# are copied to JOBS_DIR until they finish, and JOB_WORKERS threads work the queue.
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", os.path.join(BASE_DIR, "cache", "jobs", "jobs.db"))
+JOBS_DIR = os.environ.get("JOBS_DIR", os.path.join(BASE_DIR, "cache", "jobs", "files"))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_MAX_QUEUED = int(os.environ.get("JOB_MAX_QUEUED", 100))
+JOB_MAX_ATTEMPTS = 3
+JOB_POLL_INTERVAL = 0.5
+
+# Text context handed to the model: page text is cached per PDF under TEXT_CACHE_DIR, header
+# and footer lines repeated across pages and boilerplate pages (terms and conditions) are
+# dropped, and the most invoice-relevant sections are kept within CONTEXT_TOKEN_BUDGET tokens.
+TEXT_CACHE_DIR = os.environ.get("TEXT_CACHE_DIR", os.path.join(BASE_DIR, "cache", "text"))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 6000))  # 0 disables trimming
+CONTEXT_SECTION_LINES = 12
+CONTEXT_REPEAT_MIN_SHARE = 0.6
+
+# Near-duplicate detection: rendered pages get a perceptual hash and the text a fingerprint,
+# both kept in a SQLite index (empty path disables). A new upload whose hashes are at least
+# DEDUPE_MIN_SIMILARITY similar (1 - Hamming distance / bits) reuses the earlier extraction.
+DEDUPE_INDEX_PATH = os.environ.get("DEDUPE_INDEX_PATH", os.path.join(BASE_DIR, "cache", "dedupe", "index.db"))
+DEDUPE_MIN_SIMILARITY = float(os.environ.get("DEDUPE_MIN_SIMILARITY", 0.92))
+DEDUPE_HASH_SIZE = 16  # the page hash has DEDUPE_HASH_SIZE ** 2 bits
+# Only the newest DEDUPE_MAX_ENTRIES documents are kept and searched
+DEDUPE_MAX_ENTRIES = int(os.environ.get("DEDUPE_MAX_ENTRIES", 100000))
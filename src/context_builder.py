@@ -0,0 +1,256 @@
+import os
+import re
+import json
+import math
+import shutil
+import threading
+from collections import OrderedDict
+
+from .config import TEXT_CACHE_DIR, CONTEXT_TOKEN_BUDGET, CONTEXT_SECTION_LINES, CONTEXT_REPEAT_MIN_SHARE
+from .invoice_processor import extract_pages_text
+from .result_cache import file_sha256
+from .routing import AMOUNT_PATTERN, DATE_PATTERN
+
+# Lines this far from the top or bottom of a page are header/footer candidates
+EDGE_LINES = 3
+# Pages with this many boilerplate terms and (almost) no amounts are dropped
+BOILERPLATE_MIN_HITS = 4
+BOILERPLATE_MAX_AMOUNTS = 2
+BOILERPLATE_PATTERN = re.compile(
+    r"\b(terms and conditions|terms of (?:sale|service|use)|governing law|jurisdiction|liabilit(?:y|ies)|"
+    r"indemnif\w*|warrant(?:y|ies)|force majeure|arbitration|privacy|confidential\w*|hereby|herein|"
+    r"thereof|whereas|shall|notwithstanding|disclaim\w*)\b",
+    re.IGNORECASE,
+)
+FIELD_PATTERN = re.compile(
+    r"\b(invoice|inv|bill to|ship to|sold to|vendor|supplier|customer|date|due|po|order|number|"
+    r"qty|quantity|unit|price|rate|amount|description|item|subtotal|sub-total|tax|vat|gst|total|"
+    r"balance|currency|usd|eur|gbp|payment)\b",
+    re.IGNORECASE,
+)
+# Amounts count towards a section's score up to this many, so long item tables don't crowd out
+# the labelled fields
+MAX_SCORED_AMOUNTS = 4
+# Always keep the opening and closing sections; they carry the invoice header and the totals
+EDGE_SECTION_BONUS = 100
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token count for budgeting (about four characters per token), no tokenizer needed."""
+    return (len(text) + 3) // 4
+
+
+class PageTextCache:
+    """
+    Per-page text of each PDF keyed by its content hash, so re-runs and follow-ups never
+    re-parse a document. Recent documents stay in memory; all of them are kept as small JSON
+    files under `cache_dir` so worker processes and restarts share them.
+    """
+
+    def __init__(self, cache_dir: str = TEXT_CACHE_DIR, max_memory_entries: int = 64):
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _remember(self, key: str, pages: list):
+        with self._lock:
+            self._memory[key] = pages
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return list(self._memory[key])
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                pages = json.load(f)["pages"]
+        except (OSError, ValueError, KeyError):
+            return None
+        self._remember(key, pages)
+        return list(pages)
+
+    def put(self, key: str, pages: list):
+        self._remember(key, list(pages))
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"pages": pages}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Warning: Could not write the text cache to {path}. Error: {e}")
+
+    def clear(self):
+        """Forgets every cached document, in memory and on disk."""
+        with self._lock:
+            self._memory.clear()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def pages_text(self, pdf_path: str) -> tuple:
+        """(pages, cached): the text layer of each page, from the cache when this PDF was read before."""
+        if not os.path.exists(pdf_path):
+            return [], False
+        key = file_sha256(pdf_path)
+        pages = self.get(key)
+        if pages is not None:
+            return pages, True
+        pages = extract_pages_text(pdf_path)
+        # An empty list means pypdf failed; try again next time rather than caching the failure
+        if pages:
+            self.put(key, pages)
+        return pages, False
+
+
+_page_cache = None
+
+
+def get_page_text_cache() -> PageTextCache:
+    global _page_cache
+    if _page_cache is None:
+        _page_cache = PageTextCache()
+    return _page_cache
+
+
+def _normalize_line(line: str) -> str:
+    # Page numbers and dates change from page to page; the rest of a running header does not
+    return re.sub(r"\s+", " ", re.sub(r"\d+", "#", line.lower())).strip()
+
+
+def _edge_indices(lines: list) -> list:
+    filled = [i for i, line in enumerate(lines) if line.strip()]
+    return sorted(set(filled[:EDGE_LINES] + filled[-EDGE_LINES:]))
+
+
+def strip_repeated_lines(pages: list) -> tuple:
+    """
+    Removes header and footer lines that repeat near the top or bottom of most pages, keeping
+    their first occurrence. Returns (pages, lines_removed).
+    """
+    page_lines = [text.splitlines() for text in pages]
+    with_text = sum(1 for lines in page_lines if any(line.strip() for line in lines))
+    if with_text < 2:
+        return list(pages), 0
+
+    seen_on = {}
+    for lines in page_lines:
+        # Lines with amounts on them are line items or totals, whatever their position
+        for key in {_normalize_line(lines[i]) for i in _edge_indices(lines) if not AMOUNT_PATTERN.search(lines[i])}:
+            seen_on[key] = seen_on.get(key, 0) + 1
+    threshold = max(2, math.ceil(CONTEXT_REPEAT_MIN_SHARE * with_text))
+    repeated = {key for key, count in seen_on.items() if count >= threshold}
+    if not repeated:
+        return list(pages), 0
+
+    kept_once = set()
+    removed = 0
+    stripped = []
+    for lines in page_lines:
+        drop = set()
+        for i in _edge_indices(lines):
+            key = _normalize_line(lines[i])
+            if key in repeated:
+                if key in kept_once:
+                    drop.add(i)
+                kept_once.add(key)
+        removed += len(drop)
+        stripped.append("\n".join(line for i, line in enumerate(lines) if i not in drop))
+    return stripped, removed
+
+
+def is_boilerplate(text: str) -> bool:
+    """Legal or terms-and-conditions text with next to no amounts on it."""
+    return (
+        len(BOILERPLATE_PATTERN.findall(text)) >= BOILERPLATE_MIN_HITS
+        and len(AMOUNT_PATTERN.findall(text)) <= BOILERPLATE_MAX_AMOUNTS
+    )
+
+
+def split_sections(text: str, max_lines: int = CONTEXT_SECTION_LINES) -> list:
+    """Blank-line separated blocks of a page, cut to at most `max_lines` lines each."""
+    sections, block = [], []
+    for line in text.splitlines() + [""]:
+        if line.strip():
+            block.append(line)
+        if block and (not line.strip() or len(block) == max_lines):
+            sections.append("\n".join(block))
+            block = []
+    return sections
+
+
+def score_section(text: str) -> int:
+    """How much of what the invoice schema asks for a section seems to hold."""
+    return (
+        2 * len(FIELD_PATTERN.findall(text))
+        + min(len(AMOUNT_PATTERN.findall(text)), MAX_SCORED_AMOUNTS)
+        + 2 * len(DATE_PATTERN.findall(text))
+    )
+
+
+def build_context(page_texts: list, budget: int = CONTEXT_TOKEN_BUDGET, keep_pages=()) -> dict:
+    """
+    Turns per-page text into the context for the extraction prompt: repeated headers and
+    footers are stripped, boilerplate pages dropped, and when the rest exceeds `budget` tokens
+    the least invoice-relevant sections are left out (the others stay in reading order).
+    Sections on `keep_pages` (1-based; pages the model gets no image of) are never left out,
+    even if that goes over the budget.
+
+    Returns {"text", "pages", "report"}; `pages` is the cleaned text of each page ("" for
+    dropped pages) for callers that work page by page. The report lists the `pages_trimmed`.
+    """
+    tokens_in = estimate_tokens("\n".join(text for text in page_texts if text))
+    pages, lines_removed = strip_repeated_lines(page_texts)
+
+    dropped = []
+    for i, text in enumerate(pages):
+        # Never drop the first page with text; short invoices can carry their terms there too
+        if text and any(pages[:i]) and is_boilerplate(text):
+            dropped.append(i + 1)
+            pages[i] = ""
+
+    sections = []
+    for page, text in enumerate(pages, start=1):
+        for section in split_sections(text):
+            sections.append({"page": page, "text": section, "tokens": estimate_tokens(section) + 1, "score": score_section(section)})
+    if sections:
+        sections[0]["score"] += EDGE_SECTION_BONUS
+        sections[-1]["score"] += EDGE_SECTION_BONUS
+
+    total = sum(section["tokens"] for section in sections)
+    if budget and total > budget:
+        # Text-only pages have nothing else to fall back on, so only imaged pages are trimmed
+        keep = {i for i, section in enumerate(sections) if section["page"] in keep_pages}
+        used = sum(sections[i]["tokens"] for i in keep)
+        ranked = sorted(range(len(sections)), key=lambda i: (-sections[i]["score"], i))
+        for i in ranked:
+            if i not in keep and used + sections[i]["tokens"] <= budget:
+                keep.add(i)
+                used += sections[i]["tokens"]
+        selected = [section for i, section in enumerate(sections) if i in keep]
+        trimmed = sorted({section["page"] for i, section in enumerate(sections) if i not in keep})
+    else:
+        selected, trimmed = sections, []
+
+    text = "\n".join(section["text"] for section in selected)
+    return {
+        "text": text,
+        "pages": pages,
+        "report": {
+            "tokens_in": tokens_in,
+            "tokens_out": estimate_tokens(text),
+            "budget": budget,
+            "repeated_lines_removed": lines_removed,
+            "boilerplate_pages": dropped,
+            "sections": len(sections),
+            "sections_kept": len(selected),
+            "pages_trimmed": trimmed,
+            "over_budget": bool(budget) and estimate_tokens(text) > budget,
+        },
+    }
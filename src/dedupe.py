@@ -0,0 +1,295 @@
+import io
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+
+from .config import DEDUPE_INDEX_PATH, DEDUPE_MIN_SIMILARITY, DEDUPE_HASH_SIZE, DEDUPE_MAX_ENTRIES
+from .tracing import metrics
+
+# Below this many words a page's text is too thin to fingerprint; only the images count then
+MIN_TEXT_WORDS = 20
+TEXT_HASH_BITS = 64
+SHINGLE_WORDS = 3
+# Any token with a digit in it: amounts, dates, invoice, order and account numbers
+NUMBER_TOKEN = re.compile(r"[a-z]*\d[\w.,/-]*")
+# Result keys kept with each indexed document, reused as-is for its near duplicates
+INDEXED_RESULT_KEYS = ("data", "vendor", "validation", "chunked")
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _hamming(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Bit differences between packed hashes, along the last axis (uint8 bytes)."""
+    return _POPCOUNT[np.bitwise_xor(a, b)].sum(axis=-1, dtype=np.int64)
+
+
+def page_hash(image: bytes, size: int = DEDUPE_HASH_SIZE) -> bytes:
+    """
+    Difference hash of an encoded page image: the page shrunk to size x (size + 1) grey pixels,
+    one bit per horizontal neighbour pair. Survives rescans, re-encoding and small shifts.
+    """
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(image))
+    # Lets the JPEG decoder skip most of the work; a no-op for other formats
+    img.draft("L", (size * 8, size * 8))
+    pixels = np.asarray(img.convert("L").resize((size + 1, size), Image.BILINEAR), dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes()
+
+
+def text_fingerprint(text: str) -> tuple:
+    """
+    (simhash, numbers) of the text: a 64-bit SimHash of its word shingles, tolerant of spacing
+    and small extraction differences, and a digest of every token with a digit in it (amounts,
+    dates, invoice and PO numbers), which a near duplicate has to match exactly. A re-issued
+    invoice or an identical order on the same day differs in its number, so it is not reused.
+    (None, None) when there is too little text.
+    """
+    words = re.findall(r"[a-z0-9]+", (text or "").lower())
+    if len(words) < MIN_TEXT_WORDS:
+        return None, None
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "little") for shingle in shingles],
+        dtype=np.uint64,
+    )
+    bits = (hashes[:, None] >> np.arange(TEXT_HASH_BITS, dtype=np.uint64)) & np.uint64(1)
+    votes = bits.sum(axis=0) * 2 > len(hashes)
+    simhash = sum(1 << i for i, vote in enumerate(votes) if vote)
+
+    numbers = sorted(token.rstrip(".,").replace(",", "") for token in NUMBER_TOKEN.findall(text.lower()))
+    return f"{simhash:016x}", hashlib.sha256("|".join(numbers).encode()).hexdigest()[:32]
+
+
+def fingerprint_document(images: list, image_pages: list, page_texts: list, pages_total: int) -> dict:
+    """Perceptual hashes of the rendered pages and a fingerprint of the text layer. Plain data, so it pickles."""
+    text_hash, numbers = text_fingerprint("\n".join(text for text in page_texts if text))
+    return {
+        "pages_total": pages_total,
+        "image_pages": list(image_pages),
+        "page_hashes": [page_hash(image).hex() for image in images],
+        "text_hash": text_hash,
+        "numbers": numbers,
+    }
+
+
+def _text_bytes(text_hash: str) -> np.ndarray:
+    return np.frombuffer(bytes.fromhex(text_hash), dtype=np.uint8)
+
+
+class DuplicateIndex:
+    """
+    Persistent index of document fingerprints and their extractions, searched by Hamming
+    distance.
+
+    Rows live in SQLite so every process sees the same index; each process keeps the
+    fingerprints for the current extraction `version` (model, prompts and vendor data) in
+    NumPy arrays, appending rows added elsewhere before each lookup, and searches only the
+    newest `max_entries` documents; older rows are deleted as new ones come in. A lookup scans the
+    first-page hashes and text hashes of every indexed document in one vectorised pass, then
+    checks the few candidates page by page.
+    """
+
+    def __init__(self, db_path: str = DEDUPE_INDEX_PATH, min_similarity: float = DEDUPE_MIN_SIMILARITY,
+                 max_entries: int = DEDUPE_MAX_ENTRIES):
+        self.db_path = db_path
+        self.min_similarity = min_similarity
+        self.max_entries = max_entries
+        self.hits = 0  # lookups that reused an extraction
+        self.lookups = 0
+        self._lock = threading.Lock()
+        self._version = None
+        self._last_id = 0
+        self._rows = []
+        self._arrays = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "id INTEGER PRIMARY KEY, version TEXT NOT NULL, source TEXT, trace_id TEXT, created REAL NOT NULL, "
+                "pages_total INTEGER NOT NULL, image_pages TEXT NOT NULL, page_hashes BLOB NOT NULL, "
+                "text_hash TEXT, numbers TEXT, result TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS documents_version ON documents (version, id)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _refresh(self, version: str):
+        if version != self._version:
+            self._version, self._last_id, self._rows, self._arrays = version, 0, [], None
+        with self._connect() as conn:
+            new_rows = conn.execute(
+                "SELECT id, source, trace_id, pages_total, image_pages, page_hashes, text_hash, numbers "
+                "FROM documents WHERE version = ? AND id > ? ORDER BY id",
+                (version, self._last_id),
+            ).fetchall()
+        if not new_rows:
+            return
+        rows = []
+        for row_id, source, trace_id, pages_total, image_pages, page_hashes, text_hash, numbers in new_rows:
+            image_pages = json.loads(image_pages)
+            rows.append({
+                "id": row_id, "source": source, "trace_id": trace_id, "pages_total": pages_total,
+                "image_pages": image_pages,
+                "page_hashes": np.frombuffer(page_hashes, dtype=np.uint8).reshape(len(image_pages), -1) if page_hashes else None,
+                "text_hash": text_hash, "numbers": numbers,
+            })
+        self._last_id = rows[-1]["id"]
+        # Only the new rows are converted; the search arrays grow by appending them
+        added = self._rows_arrays(rows)
+        self._rows += rows
+        if self._arrays is None:
+            self._arrays = added
+        else:
+            self._arrays = {key: np.concatenate([self._arrays[key], added[key]]) for key in added}
+        # The oldest rows age out of the search once there are more than max_entries
+        excess = len(self._rows) - self.max_entries
+        if excess > 0:
+            del self._rows[:excess]
+            self._arrays = {key: array[excess:] for key, array in self._arrays.items()}
+
+    @staticmethod
+    def _rows_arrays(rows: list) -> dict:
+        """Search arrays for `rows`: first-page hashes and text hashes, packed, plus flags."""
+        first = np.zeros((len(rows), DEDUPE_HASH_SIZE * DEDUPE_HASH_SIZE // 8), dtype=np.uint8)
+        text = np.zeros((len(rows), TEXT_HASH_BITS // 8), dtype=np.uint8)
+        for i, row in enumerate(rows):
+            if row["page_hashes"] is not None:
+                first[i] = row["page_hashes"][0]
+            if row["text_hash"]:
+                text[i] = _text_bytes(row["text_hash"])
+        return {
+            "pages_total": np.array([row["pages_total"] for row in rows], dtype=np.int64),
+            "has_image": np.array([row["page_hashes"] is not None for row in rows], dtype=bool),
+            "has_text": np.array([bool(row["text_hash"]) for row in rows], dtype=bool),
+            "first": first,
+            "text": text,
+        }
+
+    def _compare(self, fingerprint: dict, page_hashes, row: dict):
+        """(confirmed, similarity, signals) between a fingerprint and an indexed row, or None if they differ."""
+        similarities, signals = [], []
+        if fingerprint["text_hash"] and row["text_hash"]:
+            if fingerprint["numbers"] != row["numbers"]:
+                return None
+            distance = int(_hamming(_text_bytes(fingerprint["text_hash"]), _text_bytes(row["text_hash"])))
+            similarities.append(1 - distance / TEXT_HASH_BITS)
+            signals.append("text")
+        if page_hashes is not None and row["page_hashes"] is not None and fingerprint["image_pages"] == row["image_pages"]:
+            distances = _hamming(page_hashes, row["page_hashes"])
+            similarities.append(1 - int(distances.max()) / (page_hashes.shape[1] * 8))
+            signals.append("image")
+        if not similarities or min(similarities) < self.min_similarity:
+            return None
+        # Page hashes capture the layout, and invoices printed from one template share it; only
+        # the text (with every amount and date equal) shows it is the same invoice
+        return "text" in signals, round(min(similarities), 4), signals
+
+    def find(self, fingerprint: dict, version: str):
+        """
+        The most similar indexed document at or above `min_similarity` as {"id", "source",
+        "trace_id", "similarity", "signals", "confirmed", "result"}, or None. Every signal both
+        documents have (page images, text) must clear the threshold, and their amounts and dates
+        must match. A match on the page images alone is returned with `confirmed` False: safe
+        to flag, not to reuse.
+        """
+        page_hashes = None
+        if fingerprint["page_hashes"]:
+            page_hashes = np.array([np.frombuffer(bytes.fromhex(h), dtype=np.uint8) for h in fingerprint["page_hashes"]])
+        if page_hashes is None and not fingerprint["text_hash"]:
+            return None
+
+        with self._lock:
+            self.lookups += 1
+            self._refresh(version)
+            if not self._rows:
+                return None
+            arrays = self._arrays
+            candidates = np.zeros(len(self._rows), dtype=bool)
+            if page_hashes is not None:
+                max_bits = (1 - self.min_similarity) * page_hashes.shape[1] * 8
+                candidates |= arrays["has_image"] & (_hamming(arrays["first"], page_hashes[0]) <= max_bits)
+            if fingerprint["text_hash"]:
+                max_bits = (1 - self.min_similarity) * TEXT_HASH_BITS
+                candidates |= arrays["has_text"] & (_hamming(arrays["text"], _text_bytes(fingerprint["text_hash"])) <= max_bits)
+            candidates &= arrays["pages_total"] == fingerprint["pages_total"]
+
+            best = None
+            for i in np.flatnonzero(candidates):
+                compared = self._compare(fingerprint, page_hashes, self._rows[i])
+                if compared is not None and (best is None or compared[:2] > best[1][:2]):
+                    best = (self._rows[i], compared)
+            if best is None:
+                return None
+            self.hits += int(best[1][0])
+
+        row, (confirmed, similarity, signals) = best
+        with self._connect() as conn:
+            result = conn.execute("SELECT result FROM documents WHERE id = ?", (row["id"],)).fetchone()
+        if result is None:
+            return None
+        return {
+            "id": row["id"], "source": row["source"], "trace_id": row["trace_id"],
+            "similarity": similarity, "signals": signals, "confirmed": confirmed, "result": json.loads(result[0]),
+        }
+
+    def add(self, fingerprint: dict, version: str, result: dict, source: str = None):
+        """Indexes a freshly extracted document so later near duplicates can reuse `result`."""
+        if not fingerprint["page_hashes"] and not fingerprint["text_hash"]:
+            return
+        page_hashes = b"".join(bytes.fromhex(h) for h in fingerprint["page_hashes"])
+        stored = {key: result.get(key) for key in INDEXED_RESULT_KEYS}
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO documents (version, source, trace_id, created, pages_total, image_pages, page_hashes, "
+                "text_hash, numbers, result) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (version, os.path.basename(source) if source else None, result.get("trace_id"), time.time(),
+                 fingerprint["pages_total"], json.dumps(fingerprint["image_pages"]), page_hashes,
+                 fingerprint["text_hash"], fingerprint["numbers"], json.dumps(stored)),
+            )
+            # Keep the newest max_entries rows; anything older has aged out of the search anyway
+            conn.execute(
+                "DELETE FROM documents WHERE id <= (SELECT id FROM documents ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        return {
+            "entries": entries,
+            "lookups": self.lookups,
+            "reused": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+        }
+
+    def _metrics(self):
+        stats = self.stats()
+        yield "receipt_dedupe_entries", "Documents in the near-duplicate index", stats["entries"], {}
+        yield "receipt_dedupe_lookups", "Near-duplicate lookups", stats["lookups"], {}
+        yield "receipt_dedupe_reused", "Lookups that reused an earlier extraction", stats["reused"], {}
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_duplicate_index():
+    """The process-wide index, or None when DEDUPE_INDEX_PATH is empty."""
+    global _index
+    if not DEDUPE_INDEX_PATH:
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = DuplicateIndex()
+            metrics.add_collector(_index._metrics)
+        return _index
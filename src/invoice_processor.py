@@ -1,67 +1,92 @@
-import gradio as gr
-import ollama
-import pypdf
 import os
 import json
 import re
-from PIL import Image
-from pdf2image import convert_from_path
-import tempfile
-import shutil
-from datetime import datetime 
 import time
-from pprint import pprint
+from types import SimpleNamespace
 
 from .config import MODEL, SYSTEM_PROMPT
+from .ollama_client import chat, stream_chat
+from .tracing import record_usage
 
 def clean_and_parse_json(raw_content: str) -> dict:
-    # Remove potential markdown code blocks
-    cleaned_content = re.sub(r" ```json\n?", "", raw_content)
-    cleaned_content = re.sub(r" ```", "", cleaned_content)
-    cleaned_content = cleaned_content.strip()  
+    """Fallback parser for free-form model output: the first JSON object found in the text."""
+    # Remove potential markdown code fences
+    cleaned_content = re.sub(r"```(?:json)?", "", raw_content).strip()
     
     # Find the start of the JSON object
     json_start_index = cleaned_content.find('{')
-    json_end_index   = cleaned_content.rfind('}')
     if json_start_index == -1:
         raise json.JSONDecodeError("No JSON object found in the model's response.", cleaned_content, 0)
 
-    # Extract the JSON part of the string
-    json_string = cleaned_content[json_start_index:json_end_index+1]
+    # Decode exactly one object so braces in trailing chatter don't get swallowed
     try:
-        return json.loads(json_string)
+        return json.JSONDecoder().raw_decode(cleaned_content, json_start_index)[0]
     except json.JSONDecodeError as e:
         raise json.JSONDecodeError(f"Failed to decode JSON: {e}", cleaned_content, e.pos)
 
 
-def extract_text_from_pdf(pdf_path: str) -> str:
+def iter_pages_text(pdf_path: str):
+    """Yields the text layer of each page in page order (empty strings for pages without one)."""
+    import pypdf
+
+    reader = pypdf.PdfReader(pdf_path)
+    for page in reader.pages:
+        yield page.extract_text() or ""
+
+
+def extract_pages_text(pdf_path: str) -> list:
+    """Text layer of each page, in page order (empty strings for pages without one)."""
     if not os.path.exists(pdf_path):
-        return ""
+        return []
     try:
-        reader = pypdf.PdfReader(pdf_path)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() or ""
-        return text
+        return list(iter_pages_text(pdf_path))
     
     except Exception as e:
         print(f"Warning: Could not extract text from PDF. Error: {e}")
-        return ""
-    
+        return []
+
+
+def extract_text_from_pdf(pdf_path: str) -> str:
+    return "".join(extract_pages_text(pdf_path))
     
-def execute_prompt(messages: list, model: str=MODEL, system_prompt: str=SYSTEM_PROMPT):
     
+def execute_prompt(messages: list, model: str=MODEL, system_prompt: str=SYSTEM_PROMPT, usage: dict=None, **kwargs) -> str:
+    """
+    Runs a chat completion through the shared client and returns the message content. Raises
+    ModelCallError on failure. Token counts and timings are added to the `usage` span, if given.
+    """
+    response = chat(messages, model=model, **kwargs)
+    record_usage(usage, response)
+
+    # The response content might be a string or already a dict depending on the model/Ollama version
+    content = response['message']['content']
+    return content if isinstance(content, str) else json.dumps(content)
+
+
+def stream_prompt(messages: list, model: str=MODEL, usage: dict=None, **kwargs):
+    """
+    Like execute_prompt, but yields the content as it is generated. Close the generator to
+    stop generation. When it is closed before Ollama's final stats arrive, the `usage` span
+    gets an estimate instead: one token per streamed chunk, timed from the first chunk.
+    """
+    started = time.perf_counter()
+    first = last = None
+    chunks = 0
+    finished = False
     try:
-        # Call Ollama, providing both the text prompt and the list of image paths
-        response = ollama.chat(
-            model=model,
-            messages=messages
-        )
-        
-        # The response content might be a string or already a dict depending on the model/Ollama version
-        raw_content = response['message']['content'] if isinstance(response['message']['content'], str) else json.dumps(response['message']['content'])
-        
-        return raw_content
-        
-    except Exception as e:
-        return {"error": f"Failed to call Ollama or parse its response: {e}"}
+        for part in stream_chat(messages, model=model, **kwargs):
+            if part.get('done'):
+                finished = True
+                record_usage(usage, part)
+            content = part['message']['content']
+            if content:
+                last = time.perf_counter()
+                first = first or last
+                chunks += 1
+                yield content
+    finally:
+        if usage is not None and first is not None:
+            usage["first_token_seconds"] = round(first - started, 4)
+            if not finished:
+                record_usage(usage, SimpleNamespace(eval_count=chunks, eval_duration=(last - first) * 1e9))
+                usage["model"]["estimated"] = True
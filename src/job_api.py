@@ -0,0 +1,65 @@
+"""
+HTTP endpoints for the job queue, mounted next to the Gradio UI by app.py:
+
+    POST   /api/jobs              upload a PDF (multipart field "file"); returns {"id": ...}
+    GET    /api/jobs/{id}         status, current stage, stage history, partial data
+    GET    /api/jobs/{id}/result  the finished result (without page images)
+    DELETE /api/jobs/{id}         cancel
+    GET    /api/queue             queue depth and worker utilization
+    GET    /api/backends          health, load and latency of each model endpoint
+"""
+import os
+import shutil
+import tempfile
+
+from fastapi import APIRouter, File, HTTPException, UploadFile
+
+from .job_queue import JobQueue, QueueFullError
+from .ollama_client import get_client
+
+
+def create_job_router(queue: JobQueue) -> APIRouter:
+    router = APIRouter(prefix="/api")
+
+    @router.post("/jobs", status_code=202)
+    def submit_job(file: UploadFile = File(...)):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, os.path.basename(file.filename or "upload.pdf"))
+            with open(path, "wb") as f:
+                shutil.copyfileobj(file.file, f)
+            try:
+                job_id = queue.submit(path)
+            except QueueFullError as e:
+                raise HTTPException(status_code=429, detail=str(e))
+        return {"id": job_id}
+
+    @router.get("/jobs/{job_id}")
+    def get_job(job_id: str):
+        job = queue.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="No such job")
+        return job
+
+    @router.get("/jobs/{job_id}/result")
+    def get_result(job_id: str):
+        result = queue.result(job_id, with_images=False)
+        if result is None:
+            raise HTTPException(status_code=404, detail="No finished result for this job")
+        result.pop("images", None)
+        return result
+
+    @router.delete("/jobs/{job_id}")
+    def cancel_job(job_id: str):
+        if not queue.cancel(job_id):
+            raise HTTPException(status_code=409, detail="Job is not queued or running")
+        return {"id": job_id, "cancel_requested": True}
+
+    @router.get("/queue")
+    def queue_stats():
+        return queue.stats()
+
+    @router.get("/backends")
+    def backend_stats():
+        return get_client().stats()
+
+    return router
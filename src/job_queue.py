@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import threading
+
+from .config import JOBS_DB_PATH, JOBS_DIR, JOB_WORKERS, JOB_MAX_QUEUED, JOB_MAX_ATTEMPTS
+from .main import stream_pipeline, pipeline_cache_key
+from .result_cache import get_result_cache
+from .tracing import metrics
+
+TERMINAL_STATUSES = ("done", "failed", "cancelled")
+# Result keys kept in the jobs table; page images stay in the result cache
+STORED_RESULT_KEYS = ("data", "vendor", "route", "validation", "chunked", "cached", "duplicate_of", "trace_id", "timings", "invoice_text")
+
+
+class QueueFullError(RuntimeError):
+    """Raised by submit() when JOB_MAX_QUEUED jobs are already waiting."""
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobQueue:
+    """
+    Durable queue of PDF extraction jobs backed by SQLite, worked by a pool of threads.
+
+    Submitted PDFs are copied under `files_dir` so a job survives the upload's temp file
+    going away. Workers claim the oldest queued job in a write transaction, report the
+    current stage as the pipeline progresses, and store the result (page images go to the
+    result cache). Jobs left "running" by a crash or restart are re-queued on start, up to
+    JOB_MAX_ATTEMPTS attempts in total.
+    """
+
+    def __init__(self, db_path: str = JOBS_DB_PATH, files_dir: str = JOBS_DIR, workers: int = JOB_WORKERS,
+                 max_queued: int = JOB_MAX_QUEUED, max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.files_dir = files_dir
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts
+        self.started_at = None
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        # Latest partial extraction per running job; only useful while the job runs, so not persisted
+        self._partials = {}
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        os.makedirs(files_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, source TEXT NOT NULL, path TEXT NOT NULL, status TEXT NOT NULL, "
+                "stage TEXT, progress REAL NOT NULL DEFAULT 0, stage_history TEXT NOT NULL DEFAULT '[]', "
+                "attempts INTEGER NOT NULL DEFAULT 0, cancel_requested INTEGER NOT NULL DEFAULT 0, "
+                "created REAL NOT NULL, started REAL, finished REAL, error TEXT, cache_key TEXT, result TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def start(self):
+        """Re-queues jobs interrupted by the last shutdown and starts the workers."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', finished = ?, error = 'Interrupted too many times' "
+                "WHERE status = 'running' AND attempts >= ?",
+                (time.time(), self.max_attempts),
+            )
+            resumed = conn.execute("UPDATE jobs SET status = 'queued', stage = 'queued' WHERE status = 'running'").rowcount
+        if resumed:
+            print(f"Resuming {resumed} job(s) interrupted by the last shutdown")
+
+        self.started_at = time.time()
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        metrics.add_collector(self._metrics)
+        return self
+
+    def stop(self, timeout: float = None):
+        """Stops claiming new jobs; running jobs finish, or are resumed on the next start if the process exits first."""
+        self._stopping.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, pdf_path: str) -> str:
+        with self._connect() as conn:
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFullError(f"{queued} jobs are already waiting; try again later")
+
+        job_id = uuid.uuid4().hex
+        path = os.path.join(self.files_dir, f"{job_id}.pdf")
+        shutil.copyfile(pdf_path, path)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, source, path, status, stage, stage_history, created) VALUES (?, ?, ?, 'queued', 'queued', ?, ?)",
+                (job_id, os.path.basename(pdf_path), path, json.dumps([{"stage": "queued", "at": now}]), now),
+            )
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id: str):
+        """Job status: stage, progress, stage history and timestamps, plus the latest `partial` data while running."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, source, status, stage, progress, stage_history, attempts, created, started, finished, error "
+                "FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["stage_history"] = json.loads(job["stage_history"])
+        if job["status"] == "running":
+            job["partial"] = self._partials.get(job_id)
+        return job
+
+    def result(self, job_id: str, with_images: bool = True):
+        """The finished job's result dict (with page `images` from the result cache when still cached), or None."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT result, cache_key FROM jobs WHERE id = ? AND status = 'done'", (job_id,)).fetchone()
+        if row is None:
+            return None
+        result = json.loads(row["result"])
+        result["images"] = []
+        if with_images and row["cache_key"]:
+            cached = get_result_cache().get(row["cache_key"])
+            if cached is not None:
+                result["images"] = cached["images"]
+        return result
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancels a queued job at once, or asks a running one to stop at its next stage. False if already finished."""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT status, stage_history FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row["status"] in TERMINAL_STATUSES:
+                return False
+            if row["status"] == "running":
+                conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+                conn.commit()
+                return True
+            now = time.time()
+            history = json.loads(row["stage_history"]) + [{"stage": "cancelled", "at": now}]
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', stage = 'cancelled', stage_history = ?, finished = ? WHERE id = ?",
+                (json.dumps(history), now, job_id),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        self._remove_file(job_id)
+        return True
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        with self._lock:
+            busy, busy_seconds = self.busy, self.busy_seconds
+        uptime = time.time() - self.started_at if self.started_at else 0.0
+        return {
+            "queue_depth": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "statuses": counts,
+            "workers": self.workers,
+            "busy_workers": busy,
+            "utilization": round(busy / self.workers, 4) if self.workers else 0.0,
+            "mean_utilization": round(busy_seconds / (self.workers * uptime), 4) if self.workers and uptime else 0.0,
+        }
+
+    def _metrics(self):
+        stats = self.stats()
+        yield "receipt_jobs_queue_depth", "Jobs waiting for a worker", stats["queue_depth"], {}
+        yield "receipt_jobs_busy_workers", "Workers currently running a job", stats["busy_workers"], {}
+        yield "receipt_jobs_workers", "Size of the job worker pool", stats["workers"], {}
+        for status, count in stats["statuses"].items():
+            yield "receipt_jobs", "Jobs by status", count, {"status": status}
+
+    def _claim(self):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT id, path FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', started = ?, attempts = attempts + 1 WHERE id = ?",
+                    (time.time(), row["id"]),
+                )
+            conn.commit()
+            return row
+        finally:
+            conn.close()
+
+    def _set_stage(self, job_id: str, stage: str, progress: float = None):
+        with self._connect() as conn:
+            row = conn.execute("SELECT stage, stage_history, cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row["cancel_requested"]:
+                raise JobCancelled()
+            if stage != row["stage"]:
+                history = json.loads(row["stage_history"]) + [{"stage": stage, "at": time.time()}]
+                conn.execute(
+                    "UPDATE jobs SET stage = ?, progress = COALESCE(?, progress), stage_history = ? WHERE id = ?",
+                    (stage, progress, json.dumps(history), job_id),
+                )
+
+    def _finish(self, job_id: str, status: str, stage: str = None, error: str = None, result: dict = None, cache_key: str = None):
+        with self._connect() as conn:
+            history = json.loads(conn.execute("SELECT stage_history FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+            history.append({"stage": stage or status, "at": time.time()})
+            conn.execute(
+                "UPDATE jobs SET status = ?, stage = ?, progress = COALESCE(?, progress), stage_history = ?, finished = ?, "
+                "error = ?, result = ?, cache_key = ? WHERE id = ?",
+                (status, stage or status, 1.0 if status == "done" else None, json.dumps(history), time.time(), error,
+                 json.dumps(result) if result is not None else None, cache_key, job_id),
+            )
+        self._partials.pop(job_id, None)
+        self._remove_file(job_id)
+
+    def _remove_file(self, job_id: str):
+        try:
+            os.remove(os.path.join(self.files_dir, f"{job_id}.pdf"))
+        except OSError:
+            pass
+
+    def _run(self, job_id: str, path: str):
+        self._set_stage(job_id, "Starting...", 0.0)
+
+        def progress(fraction, desc=None):
+            self._set_stage(job_id, desc or "Working...", fraction)
+
+        events = stream_pipeline(path, progress)
+        try:
+            for kind, payload in events:
+                if kind == "partial":
+                    self._partials[job_id] = payload
+                    # Also the cancellation check between streamed fields
+                    self._set_stage(job_id, "Parsing the document...")
+                else:
+                    result = {key: payload.get(key) for key in STORED_RESULT_KEYS}
+                    self._finish(job_id, "done", result=result, cache_key=pipeline_cache_key(path))
+        finally:
+            # Stops a streaming model call straight away when the job is cancelled mid-stream
+            events.close()
+
+    def _work(self):
+        while not self._stopping.is_set():
+            job = self._claim()
+            if job is None:
+                self._wake.wait(1.0)
+                self._wake.clear()
+                continue
+
+            started = time.perf_counter()
+            with self._lock:
+                self.busy += 1
+            try:
+                self._run(job["id"], job["path"])
+            except JobCancelled:
+                self._finish(job["id"], "cancelled")
+            except Exception as e:
+                print(f"Warning: Job {job['id']} failed. Error: {e}")
+                self._finish(job["id"], "failed", error=f"{type(e).__name__}: {e}")
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    self.busy_seconds += time.perf_counter() - started
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """The process-wide queue, started on first use."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue().start()
+        return _queue
@@ -0,0 +1,109 @@
+import json
+
+
+class IncrementalJSONParser:
+    """
+    Incremental parser for a model streaming one JSON object, possibly wrapped in chatter
+    or markdown fences.
+
+    `feed()` takes the next chunk of text and returns the events it completed:
+
+    * ("field", key, value) when a top-level field's value closes
+    * ("item", key, index, value) when an object inside a top-level array (e.g. one of the
+      `line_items`) closes, before the array itself is finished
+    * ("done", obj) when the top-level object closes; nothing after it is needed
+
+    Only the delimiters are tracked while scanning; values are decoded with `json.loads`
+    once they are known to be complete, so each character is scanned exactly once.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.start = None
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.expect = None
+        self.key = None
+        self.string_start = None
+        self.value_start = None
+        self.item_start = None
+        self.item_index = 0
+        self.array_open = False
+        self.result = None
+
+    @property
+    def done(self) -> bool:
+        return self.result is not None
+
+    def feed(self, chunk: str) -> list:
+        if self.done:
+            return []
+        self.buffer += chunk
+        events = []
+
+        while self.pos < len(self.buffer):
+            pos = self.pos
+            ch = self.buffer[pos]
+            self.pos += 1
+
+            if self.start is None:
+                if ch == "{":
+                    self.start = pos
+                    self.depth = 1
+                    self.expect = "key"
+                continue
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if self.depth == 1 and self.expect == "key":
+                        self.key = json.loads(self.buffer[self.string_start:pos + 1])
+                        self.expect = "colon"
+                continue
+
+            if ch == '"':
+                self.in_string = True
+                self.string_start = pos
+            elif ch in "{[":
+                self.depth += 1
+                # An object directly inside a top-level array
+                if self.depth == 3 and ch == "{" and self.array_open:
+                    self.item_start = pos
+                elif self.depth == 2:
+                    self.array_open = ch == "["
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 2 and ch == "}" and self.item_start is not None:
+                    item = json.loads(self.buffer[self.item_start:pos + 1])
+                    events.append(("item", self.key, self.item_index, item))
+                    self.item_index += 1
+                    self.item_start = None
+                elif self.depth == 0:
+                    self._close_value(pos, events)
+                    self.result = json.loads(self.buffer[self.start:pos + 1])
+                    events.append(("done", self.result))
+                    break
+            elif self.depth == 1:
+                if ch == ":" and self.expect == "colon":
+                    self.expect = "value"
+                    self.value_start = pos + 1
+                    self.item_index = 0
+                elif ch == ",":
+                    self._close_value(pos, events)
+
+        return events
+
+    def _close_value(self, pos, events):
+        if self.expect != "value":
+            return
+        raw = self.buffer[self.value_start:pos].strip()
+        if raw:
+            events.append(("field", self.key, json.loads(raw)))
+        self.expect = "key"
+        self.key = None
@@ -1,107 +1,455 @@
-from pdf2image import convert_from_path
-import gradio as gr
+import io
 import json
-import os 
-from .config import SYSTEM_PROMPT, MOCK_DATABASE
-from .invoice_processor import extract_text_from_pdf, clean_and_parse_json, execute_prompt
-
-
-def pdf_to_images(pdf_path, temp_dir):
-    image_paths = []
-    
-    images = convert_from_path(pdf_path)
-    
-    # Save each image to the temporary directory and collect their paths
-    for i, img in enumerate(images):
-        image_path = os.path.join(temp_dir, f"page_{i+1}.png")
-        img.save(image_path)
-        image_paths.append(image_path)
-            
-    return image_paths
+import hashlib
+import time
+from .config import (
+    MODEL, SYSTEM_PROMPT, TEXT_FAST_PATH, TEXT_ROUTE_MAX_GARBAGE, CHUNKED_MIN_PAGES,
+    RENDER_DPI, RENDER_MAX_EDGE, RENDER_FORMAT, RENDER_QUALITY, RENDER_THREADS, CONTEXT_TOKEN_BUDGET,
+    STREAM_DRAIN_SECONDS, TEXT_ROUTE_MIN_CHARS, TEXT_ROUTE_MIN_SCORE, CHUNK_WINDOW_PAGES,
+)
+from .invoice_processor import clean_and_parse_json, execute_prompt, stream_prompt
+from .json_stream import IncrementalJSONParser
+from .schema import INVOICE_JSON_SCHEMA, validate_invoice, repair_schema, set_path, record_validation, validation_metrics
+from .rag_pipeline import query_rag
+from .vendor_resolver import get_vendor_resolver
+from .routing import plan_route
+from .result_cache import get_result_cache, make_cache_key, file_sha256
+from .tracing import Trace, metrics
+from .context_builder import get_page_text_cache, build_context
+from .dedupe import fingerprint_document, get_duplicate_index
+from .chunked import HEADER_INSTRUCTION, LINE_ITEMS_INSTRUCTION, window_inputs, stream_chunked_extraction, reconcile
+
+# Repair and full-retry counts are served on /metrics next to the job and endpoint gauges
+metrics.add_collector(validation_metrics)
 
-def query_rag(image_paths, query_text=None):
 
-    db_string = json.dumps(MOCK_DATABASE, indent=2)
+def encode_page(img):
+    """Downscales a rendered page to the model's input size and encodes it compactly."""
+    img = img.convert("RGB")
+    img.thumbnail((RENDER_MAX_EDGE, RENDER_MAX_EDGE))
+    buffer = io.BytesIO()
+    img.save(buffer, format=RENDER_FORMAT, quality=RENDER_QUALITY)
+    return buffer.getvalue()
 
-    system_prompt = f"""
-    You are a specialized entity resolution system. 
-    Your sole task is to analyze a user's query, which may come from text or an image, and find the corresponding official entity in the provided JSON database.
-    Keep in mind, this is very mission critical, you have to carefully evaluate the match, and there might be no matches so be prepared for that. 
 
-    **Database of Known Entities:**
-    ```json
-    {db_string}
-    ```
+def pdf_to_images(pdf_path, pages=None):
+    """Renders the given 1-based page numbers (all pages when None) in memory and returns encoded image bytes."""
+    # Only needed (with poppler) when some page has to be rasterized
+    from pdf2image import convert_from_path
 
-    **Your Instructions:**
+    if pages is None:
+        runs = [(None, None)]
+    else:
+        # Render contiguous runs of pages with a single poppler call each
+        runs = []
+        for page in sorted(pages):
+            if runs and page == runs[-1][1] + 1:
+                runs[-1][1] = page
+            else:
+                runs.append([page, page])
 
-    1.  **Analyze the Query**: The user will provide a name or a document. Extract the most likely name of the organization they are referring to.
-    2.  **Search the Database**: Compare the extracted name against the "canonical_name" and "aliases" fields in the database. The match might not be perfect, so find the most plausible entry.
-    3.  **Format the Output**: You MUST respond with a single JSON object.
+    images = []
+    for first, last in runs:
+        # Without output_folder pdftoppm streams pages back over a pipe, so nothing touches disk
+        rendered = convert_from_path(
+            pdf_path, dpi=RENDER_DPI, first_page=first, last_page=last, thread_count=RENDER_THREADS
+        )
+        images.extend(encode_page(img) for img in rendered)
+            
+    return images
 
-        * **If a match is found**, the JSON object should contain:
-            - "status": "FOUND"
-            - "Confidante": float confidante value
-            - "id": The unique ID of the matched entity (e.g., "111-JKL").
-            - "canonical_name": The official name from the database.
-            - "searched_term": The term you extracted from the user's query.
 
-        * **If no match is found**, the JSON object should contain:
-            - "status": "NOT_FOUND"
-            - "searched_term": The term you extracted but could not match.
+PARSING_INSTRUCTIONS = [
+    "You are processing an invoice.",
+    "Using our internal database, we have verified the vendor information, always use canonical name if available. Here is the official data for this vendor (ignore if empty):",
+    "--- VERIFIED VENDOR DATA ---\n{vendor_data}\n--- END VERIFIED VENDOR DATA ---",
+    "The following is text extracted directly from the PDF, which you can use as context to improve accuracy:",
+    "--- EXTRACTED TEXT ---\n{invoice_text}\n--- END TEXT ---",
+]
+VISION_INSTRUCTION = "Now, using this verified data as the ground truth for the vendor, Analyze the attached invoice image(s) and extract all information as per the system prompt's JSON structure."
+TEXT_ONLY_INSTRUCTION = "Now, using this verified data as the ground truth for the vendor, Analyze the extracted invoice text above and extract all information as per the system prompt's JSON structure."
 
-    **IMPORTANT**: Use ONLY the information in the provided database. Do not use your own knowledge about any companies. Your entire world is the database above.
-    This is very critical, you have to match and align properly or return NOT_FOUND.
+
+def prompt_fingerprint():
+    """
+    Hash of every prompt and pipeline setting that shapes the output, so changing any of them
+    invalidates cached results.
     """
-    user_content = query_text if query_text else "Please identify the vendor in the attached image from internal database, if not found return not found."
-    
-    messages = [
-        {'role': 'system', 'content': system_prompt},
-        {'role': 'user', 'content': user_content, 'images': image_paths}
+    prompts = [SYSTEM_PROMPT] + PARSING_INSTRUCTIONS + [VISION_INSTRUCTION, TEXT_ONLY_INSTRUCTION, HEADER_INSTRUCTION, LINE_ITEMS_INSTRUCTION]
+    prompts.append(json.dumps(INVOICE_JSON_SCHEMA, sort_keys=True))
+    # Routing, rendering, chunking and the context budget decide what the model is shown
+    prompts.append(json.dumps({
+        "context_budget": CONTEXT_TOKEN_BUDGET,
+        "text_fast_path": TEXT_FAST_PATH,
+        "text_route": [TEXT_ROUTE_MIN_CHARS, TEXT_ROUTE_MAX_GARBAGE, TEXT_ROUTE_MIN_SCORE],
+        "render": [RENDER_DPI, RENDER_MAX_EDGE, RENDER_FORMAT, RENDER_QUALITY],
+        "chunked": [CHUNKED_MIN_PAGES, CHUNK_WINDOW_PAGES],
+    }, sort_keys=True))
+    return hashlib.sha256("\n".join(prompts).encode()).hexdigest()
+
+
+def build_parsing_query(vendor_info, invoice_text, with_images=True):
+    vendor_data = json.dumps({k: v for k, v in vendor_info.items() if k != 'candidates'}, indent=2)
+    instructions = PARSING_INSTRUCTIONS + [VISION_INSTRUCTION if with_images else TEXT_ONLY_INSTRUCTION]
+    return "\n".join(instructions).format(vendor_data=vendor_data, invoice_text=invoice_text)
+
+
+def prepare_document(pdf_file):
+    """
+    CPU-side stage: reads the text layer, routes each page to text or image, and renders
+    only the pages that need it. Safe to run in a worker process.
+    """
+    trace = Trace(pdf_file)
+    with trace.span("extract_text_from_pdf") as span:
+        page_texts, span["cached"] = get_page_text_cache().pages_text(pdf_file)
+        span["pages"] = len(page_texts)
+        span["chars"] = sum(len(text) for text in page_texts)
+
+    route = plan_route(page_texts, TEXT_FAST_PATH)
+    with trace.span("pdf_to_images") as span:
+        if route["pages_total"] == 0:
+            # No usable page structure from pypdf; fall back to rendering everything
+            images = pdf_to_images(pdf_file)
+            route["pages_total"] = len(images)
+            route["image_pages"] = list(range(1, len(images) + 1))
+        elif route["image_pages"]:
+            images = pdf_to_images(pdf_file, pages=route["image_pages"])
+        else:
+            images = []
+        span["images"] = len(images)
+        span["image_bytes"] = sum(len(image) for image in images)
+    route["images_sent"] = span["images"]
+    route["image_bytes"] = span["image_bytes"]
+
+    # Keep whatever text is clean enough to help, even on pages that are also sent as images
+    clean_texts = [
+        text if score["garbage_ratio"] <= TEXT_ROUTE_MAX_GARBAGE else ""
+        for text, score in zip(page_texts, route["page_scores"])
     ]
-    
-    return execute_prompt(messages)
-    
-def process_pdf(pdf_file, progress=None):
-    if progress is None:
-        progress = gr.Progress()
-    
-    # Use a temporary directory that automatically cleans up after itself
-    temp_dir = os.path.join("temp", os.path.basename(pdf_file)[:-4])
-    os.makedirs(temp_dir, exist_ok=True)
-    
-    progress(0.1, desc="Extracting images from PDFs...")
-    image_paths = pdf_to_images(pdf_file, temp_dir)
-    invoice_text = extract_text_from_pdf(pdf_file)
-    
-    progress(0.4, desc="Querying RAG to fetch vendor information...")
-    retrieved_vendor_info = query_rag(image_paths)
-    
-    parsing_query = "\n".join([
-        f"You are processing an invoice.",
-        "Using our internal database, we have verified the vendor information, always use canonical name if available. Here is the official data for this vendor (ignore if empty):",
-        f"--- VERIFIED VENDOR DATA ---\n{retrieved_vendor_info}\n--- END VERIFIED VENDOR DATA ---",
-        "The following is text extracted directly from the PDF, which you can use as context to improve accuracy:",
-        f"--- EXTRACTED TEXT ---\n{invoice_text}\n--- END TEXT ---",
-        "Now, using this verified data as the ground truth for the vendor, Analyze the attached invoice image(s) and extract all information as per the system prompt's JSON structure."
+
+    # Cheap enough for every upload: a thumbnail hash per rendered page and one text hash
+    with trace.span("fingerprint"):
+        fingerprint = fingerprint_document(images, route["image_pages"], clean_texts, route["pages_total"])
+    with trace.span("build_context") as span:
+        context = build_context(clean_texts, keep_pages=route["text_pages"])
+        span.update(context["report"])
+    # Only pages also sent as images can be trimmed, but the result records what the text left out
+    route["context"] = {key: context["report"][key] for key in ("sections", "sections_kept", "pages_trimmed", "over_budget")}
+
+    return {
+        "source": pdf_file,
+        "images": images,
+        "invoice_text": context["text"],
+        "page_texts": context["pages"],
+        "route": route,
+        "fingerprint": fingerprint,
+        "trace": trace,
+        "timings": trace.timings(),
+    }
+
+
+def stream_extraction(messages, usage=None, **kwargs):
+    """
+    Streams the extraction call and yields ("partial", data) every time a top-level field or
+    a `line_items` entry closes, then ("final", data). Once the top-level object closes, the
+    rest of the stream is read for up to STREAM_DRAIN_SECONDS so Ollama's final stats (prompt
+    tokens, load time) reach the `usage` span; generation is only cut short after that, or
+    when the caller stops iterating. The time spent parsing (`parse_seconds`) is added too.
+    """
+    parser = IncrementalJSONParser()
+    chunks = []
+    partial = {}
+    parse_seconds = 0.0
+    drain_until = None
+    stream = stream_prompt(messages, usage=usage, **kwargs)
+    try:
+        for chunk in stream:
+            if drain_until is not None:
+                # Trailing output after the object; only waiting for the closing stats
+                if time.perf_counter() > drain_until:
+                    break
+                continue
+            chunks.append(chunk)
+            if parser is None:
+                continue
+            start = time.perf_counter()
+            try:
+                events = parser.feed(chunk)
+            except json.JSONDecodeError:
+                # Malformed output; keep reading and let the full-text parser have a go
+                parser = None
+                continue
+            finally:
+                parse_seconds += time.perf_counter() - start
+            for event in events:
+                if event[0] == "field":
+                    partial[event[1]] = event[2]
+                elif event[0] == "item":
+                    partial.setdefault(event[1], []).append(event[3])
+            if events and not parser.done:
+                yield "partial", dict(partial)
+            if parser.done:
+                drain_until = time.perf_counter() + STREAM_DRAIN_SECONDS
+    finally:
+        stream.close()
+
+    start = time.perf_counter()
+    try:
+        data = parser.result if parser is not None and parser.done else clean_and_parse_json("".join(chunks))
+    finally:
+        if usage is not None:
+            usage["parse_seconds"] = round(parse_seconds + time.perf_counter() - start, 4)
+    yield "final", data
+
+
+def repair_fields(invoice, failures, invoice_text, images, usage=None):
+    """
+    Re-asks the model for just the fields that failed validation, constrained to their
+    schema, instead of redoing the whole extraction. Returns (invoice, repaired, unrepaired).
+    """
+    paths = [failure["path"] for failure in failures]
+    prompt = "\n".join([
+        "Some fields of an invoice extraction could not be parsed. Re-read the invoice and return ONLY a JSON object with corrected values for exactly these fields (current values shown):",
+        json.dumps({failure["path"]: failure["raw"] for failure in failures}, indent=2),
+        "Numbers must be plain JSON numbers without currency symbols or thousands separators, dates must be YYYY-MM-DD, and use null or an empty string when a value is genuinely absent.",
+        f"--- EXTRACTED TEXT ---\n{invoice_text}\n--- END TEXT ---" if invoice_text else "",
     ])
-    
-    messages = [
-        {'role': 'system', 'content': SYSTEM_PROMPT},
-        {'role': 'user', 'content': parsing_query, 'images': image_paths}
-    ]
-    
-    progress(0.7, desc="Parsing the document...")
-    raw_content = execute_prompt(messages)
-    
-    structured_data = clean_and_parse_json(raw_content)
+    message = {'role': 'user', 'content': prompt}
+    # The text layer is usually enough; only fall back to the images when there is none
+    if images and not invoice_text:
+        message['images'] = images
+
+    try:
+        answer = clean_and_parse_json(execute_prompt([message], format=repair_schema(paths), usage=usage))
+    except Exception as e:
+        print(f"Warning: Field repair failed, leaving {paths} empty. Error: {e}")
+        return invoice, [], paths
+
+    candidate = dict(invoice)
+    for path in paths:
+        set_path(candidate, path, answer.get(path))
+    fixed, still_failing = validate_invoice(candidate)
+    unrepaired = [failure["path"] for failure in still_failing]
+    return fixed, [path for path in paths if path not in unrepaired], unrepaired
+
+
+def duplicate_record(match):
+    """What the result says about a near-duplicate match; `reused` when its extraction was taken over."""
+    return {
+        "source": match["source"], "trace_id": match["trace_id"], "similarity": match["similarity"],
+        "signals": match["signals"], "reused": match["confirmed"],
+    }
+
+
+def reuse_duplicate(prepared, match, trace):
+    """Result for a near duplicate of an indexed document: its extraction, this document's pages."""
+    # Nothing went to the model
+    trace.finish(route=(prepared.get("route") or {}).get("mode"), cached=False, duplicate=True, images=0, image_bytes=0)
+    return {
+        **match["result"],
+        "images": prepared["images"],
+        "invoice_text": prepared["invoice_text"],
+        "route": prepared.get("route"),
+        "cached": False,
+        "duplicate_of": duplicate_record(match),
+        "trace_id": trace.trace_id,
+        "timings": trace.timings(),
+    }
+
 
-    return structured_data, image_paths
+def stream_extract_document(prepared, progress=None, dedupe=True):
+    """
+    Model-side stage: resolves the vendor and runs the structured extraction call, yielding
+    ("partial", data) as fields arrive and finally ("result", result). Documents of at least
+    CHUNKED_MIN_PAGES pages are extracted in parallel page windows instead of one call.
+
+    With `dedupe`, a near duplicate of an already extracted document reuses that extraction
+    without any model call; the result's `duplicate_of` names the match. Documents that only
+    look alike (page images match, but there is no text to confirm the amounts) are extracted
+    as usual with the match flagged in `duplicate_of`.
+    """
+    if progress is None:
+        progress = lambda *args, **kwargs: None
+    trace = prepared.get("trace") or Trace(prepared["source"])
+    images = prepared["images"]
+    invoice_text = prepared["invoice_text"]
+
+    index = get_duplicate_index() if dedupe and prepared.get("fingerprint") else None
+    match = None
+    if index is not None:
+        version = extraction_version()
+        with trace.span("dedupe_lookup") as span:
+            try:
+                match = index.find(prepared["fingerprint"], version)
+            except Exception as e:
+                print(f"Warning: Near-duplicate lookup failed, extracting normally. Error: {e}")
+            span["matched"] = match is not None
+            span["reused"] = match is not None and match["confirmed"]
+        if match is not None and match["confirmed"]:
+            progress(1, desc=f"Near duplicate of {match['source']}, reusing its extraction")
+            yield "result", reuse_duplicate(prepared, match, trace)
+            return
+
+    progress(0.4, desc="Resolving vendor against internal database...")
+    with trace.span("query_rag") as span:
+        retrieved_vendor_info = query_rag(images, invoice_text, usage=span)
+
+    route = prepared.get("route") or {}
+    chunked = bool(CHUNKED_MIN_PAGES) and route.get("pages_total", 0) >= CHUNKED_MIN_PAGES
+    image_bytes = sum(len(image) for image in images)
+    full_retry = False
+    chunk_info = None
+
+    if chunked:
+        # Long document: header from the first and last pages, line items per page window in parallel
+        header_text, header_images = window_inputs(prepared, {1, route["pages_total"]})
+        parsing_query = build_parsing_query(retrieved_vendor_info, header_text, with_images=bool(header_images))
+        progress(0.7, desc=f"Parsing {route['pages_total']} pages in parallel windows...")
+        for kind, data in stream_chunked_extraction(prepared, parsing_query, header_images, trace):
+            if kind == "partial":
+                yield "partial", data
+            else:
+                chunk_info = data
+                raw_data = chunk_info.pop("data")
+    else:
+        parsing_query = build_parsing_query(retrieved_vendor_info, invoice_text, with_images=bool(images))
+
+        user_message = {'role': 'user', 'content': parsing_query}
+        if images:
+            user_message['images'] = images
+        messages = [
+            {'role': 'system', 'content': SYSTEM_PROMPT},
+            user_message
+        ]
+
+        progress(0.7, desc="Parsing the document...")
+        extraction_span = None
+        try:
+            with trace.span("execute_prompt", images=len(images), image_bytes=image_bytes) as extraction_span:
+                for kind, data in stream_extraction(messages, usage=extraction_span, format=INVOICE_JSON_SCHEMA):
+                    if kind == "partial":
+                        yield "partial", data
+                    else:
+                        raw_data = data
+        except ValueError:
+            # Nothing parseable came back at all; the one case that still needs the full call again
+            full_retry = True
+            with trace.span("execute_prompt", images=len(images), image_bytes=image_bytes, retry=True) as span:
+                content = execute_prompt(messages, format=INVOICE_JSON_SCHEMA, usage=span)
+            with trace.span("clean_and_parse_json"):
+                raw_data = clean_and_parse_json(content)
+        # Parsing runs interleaved with the stream, so it is reported as a span nested in the call
+        if extraction_span is not None and "parse_seconds" in extraction_span:
+            trace.add_span("clean_and_parse_json", extraction_span.pop("parse_seconds"), parent="execute_prompt")
+
+    with trace.span("validate") as span:
+        structured_data, failures = validate_invoice(raw_data)
+        repaired, unrepaired = [], []
+        if failures:
+            progress(0.9, desc="Repairing fields that failed validation...")
+            structured_data, repaired, unrepaired = repair_fields(structured_data, failures, invoice_text, images, usage=span)
+        record_validation(repaired, unrepaired, full_retry)
+        if chunk_info is not None:
+            structured_data, chunk_info["reconciliation"] = reconcile(structured_data)
+
+    trace.finish(route=route.get("mode"), cached=False, duplicate=False, images=len(images), image_bytes=image_bytes,
+                 repaired=len(repaired), unrepaired=len(unrepaired), full_retry=full_retry, chunked=chunked)
+
+    result = {
+        "data": structured_data,
+        "vendor": retrieved_vendor_info,
+        "images": images,
+        "invoice_text": invoice_text,
+        "route": prepared.get("route"),
+        "validation": {"repaired": repaired, "unrepaired": unrepaired, "full_retry": full_retry},
+        "chunked": chunk_info,
+        "cached": False,
+        "duplicate_of": duplicate_record(match) if match is not None else None,
+        "trace_id": trace.trace_id,
+        "timings": trace.timings(),
+    }
+    if index is not None:
+        try:
+            index.add(prepared["fingerprint"], version, result, source=prepared["source"])
+        except Exception as e:
+            print(f"Warning: Could not add the document to the near-duplicate index. Error: {e}")
+    yield "result", result
+
+
+def extract_document(prepared, progress=None, dedupe=True):
+    """Non-streaming form of stream_extract_document; returns the result dict."""
+    for kind, payload in stream_extract_document(prepared, progress, dedupe):
+        if kind == "result":
+            return payload
+
+
+def extraction_version():
+    """Everything besides the PDF itself that decides what an extraction returns."""
+    return make_cache_key("", MODEL, prompt_fingerprint(), get_vendor_resolver().version)
+
+
+def pipeline_cache_key(pdf_file):
+    return make_cache_key(file_sha256(pdf_file), MODEL, prompt_fingerprint(), get_vendor_resolver().version)
+
+
+def mark_cache_hit(pdf_file, cached):
+    """Flags a result served from the cache and records a (stage-less) trace for it."""
+    cached["cached"] = True
+    cached["trace_id"] = Trace(pdf_file).finish(route=(cached.get("route") or {}).get("mode"), cached=True)["trace_id"]
+    return cached
+
+
+def stream_pipeline(pdf_file, progress=None, use_cache=True):
+    """
+    Runs the full extraction for one PDF, yielding ("partial", data) while the model is still
+    generating and finally ("result", result). The result dict holds the structured `data`,
+    the `vendor` resolution, the encoded page `images` that were sent to the model, the
+    text/vision `route` taken, per-stage `timings`, whether it was `cached` and, for a near
+    duplicate of an earlier document whose extraction was reused, `duplicate_of`.
+    """
+    if progress is None:
+        progress = lambda *args, **kwargs: None
+
+    cache = get_result_cache() if use_cache else None
+    if cache is not None:
+        try:
+            cache_key = pipeline_cache_key(pdf_file)
+            cached = cache.get(cache_key)
+        except Exception as e:
+            # A broken cache should cost a fresh extraction, not the document
+            print(f"Warning: Result cache lookup failed for {pdf_file}. Error: {e}")
+            cache = cached = None
+        if cached is not None:
+            yield "result", mark_cache_hit(pdf_file, cached)
+            return
+
+    progress(0.1, desc="Reading text layer and rendering pages that need it...")
+    prepared = prepare_document(pdf_file)
+    for kind, payload in stream_extract_document(prepared, progress, dedupe=use_cache):
+        if kind == "result" and cache is not None:
+            try:
+                cache.put(cache_key, payload)
+            except Exception as e:
+                print(f"Warning: Could not cache result for {pdf_file}. Error: {e}")
+        yield kind, payload
+
+
+def run_pipeline(pdf_file, progress=None, use_cache=True):
+    """Non-streaming form of stream_pipeline; returns the result dict."""
+    for kind, payload in stream_pipeline(pdf_file, progress, use_cache):
+        if kind == "result":
+            return payload
+
+
+def process_pdf(pdf_file, progress=None):
+    result = run_pipeline(pdf_file, progress)
+    return result["data"], result["images"]
 
 
 if __name__ == "__main__":
+    import sys
     from pprint import pprint 
-    
-    pdf_path = "/home/sumon/workspace/git_repos/receipt-parser/temp/batch1-0001.pdf"
-    pprint(process_pdf(pdf_path))
+
+    # For more than a quick look at one file, use the batch command: python -m src.batch
+    pprint(process_pdf(sys.argv[1]))
     
\ No newline at end of file
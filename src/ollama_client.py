@@ -0,0 +1,421 @@
+import time
+import queue
+import random
+import asyncio
+import threading
+from collections import OrderedDict, deque
+
+from .config import (
+    MODEL,
+    OLLAMA_HOSTS,
+    OLLAMA_MAX_CONCURRENCY,
+    OLLAMA_TIMEOUT,
+    OLLAMA_MAX_RETRIES,
+    OLLAMA_BACKOFF_BASE,
+    OLLAMA_BACKOFF_MAX,
+    OLLAMA_HEALTH_INTERVAL,
+    OLLAMA_UNHEALTHY_AFTER,
+    OLLAMA_MAX_SESSIONS,
+)
+from .tracing import metrics
+
+# Server-side statuses worth retrying: overloaded, restarting or timed out
+TRANSIENT_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+# Recent call durations kept per endpoint for its latency percentiles
+LATENCY_WINDOW = 256
+HEALTH_CHECK_TIMEOUT = 5.0
+
+
+class ModelCallError(RuntimeError):
+    """Raised when a model request fails permanently or exhausts its retries."""
+
+
+def is_transient(error: Exception) -> bool:
+    import httpx
+    import ollama
+
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code in TRANSIENT_STATUS_CODES
+    return isinstance(error, (ConnectionError, httpx.TransportError, asyncio.TimeoutError))
+
+
+def _percentile(values, p: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Endpoint:
+    """
+    One Ollama server: its own pooled connections and cap of `max_concurrency` requests at
+    once, its health, and its load and latency counters. Makes single attempts; retrying
+    and failing over are up to OllamaClient.
+    """
+
+    def __init__(self, host: str, max_concurrency: int = OLLAMA_MAX_CONCURRENCY, timeout: float = OLLAMA_TIMEOUT):
+        self.host = host if "://" in host else f"http://{host}"
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.healthy = True
+        self.failures = 0  # consecutive transient failures
+        self.outstanding = 0  # routed here and not finished, including calls waiting for a slot
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.last_error = None
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        # Created on first use so they bind to the event loop that actually runs the calls
+        self._client = None
+        self._semaphore = None
+
+    def _ensure_started(self):
+        if self._client is None:
+            # The HTTP stack is imported with the first call rather than with the package
+            import httpx
+            import ollama
+
+            self._client = ollama.AsyncClient(
+                host=self.host,
+                timeout=httpx.Timeout(self.timeout, connect=min(10.0, self.timeout)),
+                limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def _succeeded(self, seconds: float):
+        self.requests += 1
+        self.latencies.append(seconds)
+        self.failures = 0
+        if not self.healthy:
+            self.healthy = True
+            print(f"Model endpoint {self.host} is answering again")
+
+    def _failed(self, error: Exception, transient: bool):
+        self.requests += 1
+        self.errors += 1
+        self.last_error = f"{type(error).__name__}: {error}"
+        # A rejected request says nothing about the server; only transient failures count against it
+        if not transient:
+            return
+        self.failures += 1
+        if self.healthy and self.failures >= OLLAMA_UNHEALTHY_AFTER:
+            self.healthy = False
+            print(f"Warning: Model endpoint {self.host} taken out of rotation after {self.failures} failures. Error: {error}")
+
+    async def check_health(self) -> bool:
+        """Probes the server's version endpoint and updates `healthy`."""
+        import httpx
+
+        try:
+            async with httpx.AsyncClient(timeout=HEALTH_CHECK_TIMEOUT) as client:
+                response = await client.get(f"{self.host.rstrip('/')}/api/version")
+                response.raise_for_status()
+        except Exception as e:
+            self.last_error = f"{type(e).__name__}: {e}"
+            if self.healthy:
+                self.healthy = False
+                print(f"Warning: Model endpoint {self.host} failed its health check, taken out of rotation. Error: {e}")
+            return False
+        self.failures = 0
+        if not self.healthy:
+            self.healthy = True
+            print(f"Model endpoint {self.host} passed its health check, back in rotation")
+        return True
+
+    async def chat(self, messages: list, model: str = MODEL, **kwargs):
+        self._ensure_started()
+        self.outstanding += 1
+        try:
+            async with self._semaphore:
+                self.in_flight += 1
+                started = time.perf_counter()
+                try:
+                    response = await asyncio.wait_for(
+                        self._client.chat(model=model, messages=messages, **kwargs), self.timeout
+                    )
+                except Exception as e:
+                    self._failed(e, is_transient(e))
+                    raise
+                finally:
+                    self.in_flight -= 1
+                self._succeeded(time.perf_counter() - started)
+                return response
+        finally:
+            self.outstanding -= 1
+
+    async def chat_stream(self, messages: list, model: str = MODEL, **kwargs):
+        self._ensure_started()
+        self.outstanding += 1
+        try:
+            async with self._semaphore:
+                self.in_flight += 1
+                started = time.perf_counter()
+                stream = None
+                failed = False
+                try:
+                    stream = await asyncio.wait_for(
+                        self._client.chat(model=model, messages=messages, stream=True, **kwargs), self.timeout
+                    )
+                    async for part in stream:
+                        yield part
+                except Exception as e:
+                    failed = True
+                    self._failed(e, is_transient(e))
+                    raise
+                finally:
+                    self.in_flight -= 1
+                    # Also when the caller stopped reading early; that is a finished call too
+                    if not failed:
+                        self._succeeded(time.perf_counter() - started)
+                    if stream is not None:
+                        await stream.aclose()
+        finally:
+            self.outstanding -= 1
+
+    def stats(self) -> dict:
+        latencies = list(self.latencies)
+        return {
+            "host": self.host,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "in_flight": self.in_flight,
+            "queued": max(0, self.outstanding - self.in_flight),
+            "max_concurrency": self.max_concurrency,
+            "requests": self.requests,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "latency_p50": round(_percentile(latencies, 0.5), 4),
+            "latency_p95": round(_percentile(latencies, 0.95), 4),
+            "latency_mean": round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+        }
+
+
+class OllamaClient:
+    """
+    Shared async access to a pool of Ollama servers.
+
+    Each call goes to the healthy endpoint with the fewest outstanding requests. Calls that
+    belong to a chat `session` stay on the endpoint that served the session before, which
+    still holds its prompt prefix in cache, unless that endpoint is out of rotation. Each
+    attempt is bounded by `timeout`. A transient failure is retried straight away on another
+    healthy endpoint when there is one; otherwise it backs off with full-jitter exponential
+    backoff, so many callers backing off at once don't retry in lockstep. Endpoints that keep
+    failing are taken out of rotation until a periodic health probe succeeds.
+    """
+
+    def __init__(self, hosts: list = OLLAMA_HOSTS, max_concurrency: int = OLLAMA_MAX_CONCURRENCY,
+                 timeout: float = OLLAMA_TIMEOUT, max_retries: int = OLLAMA_MAX_RETRIES,
+                 backoff_base: float = OLLAMA_BACKOFF_BASE, backoff_max: float = OLLAMA_BACKOFF_MAX,
+                 health_interval: float = OLLAMA_HEALTH_INTERVAL):
+        self.endpoints = [Endpoint(host, max_concurrency, timeout) for host in hosts]
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.health_interval = health_interval
+        self.failovers = 0
+        # session id -> Endpoint, least recently used first
+        self._sessions = OrderedDict()
+        self._turn = 0
+        self._health_task = None
+
+    def _ensure_started(self):
+        # A lone endpoint gets no probes; with nowhere to fail over to, calls go to it regardless
+        if self._health_task is None and len(self.endpoints) > 1 and self.health_interval > 0:
+            self._health_task = asyncio.get_running_loop().create_task(self._health_loop())
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await asyncio.gather(*(endpoint.check_health() for endpoint in self.endpoints))
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def pick(self, session: str = None, exclude=()) -> Endpoint:
+        """The endpoint for the next attempt. Runs on the client's loop, so needs no locking."""
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude] or self.endpoints
+        # When every endpoint looks down, trying one beats failing outright
+        healthy = [endpoint for endpoint in candidates if endpoint.healthy] or candidates
+
+        pinned = self._sessions.get(session) if session is not None else None
+        if pinned is not None and pinned in healthy:
+            self._sessions.move_to_end(session)
+            return pinned
+
+        # Fewest outstanding requests; ties rotate so idle endpoints share the first calls
+        self._turn += 1
+        start = self._turn % len(healthy)
+        endpoint = min(healthy[start:] + healthy[:start], key=lambda e: e.outstanding)
+        if session is not None:
+            self._sessions[session] = endpoint
+            self._sessions.move_to_end(session)
+            while len(self._sessions) > OLLAMA_MAX_SESSIONS:
+                self._sessions.popitem(last=False)
+        return endpoint
+
+    async def _before_retry(self, endpoint: Endpoint, failed: set, error: Exception, attempt: int):
+        failed.add(endpoint)
+        if any(other.healthy and other not in failed for other in self.endpoints):
+            self.failovers += 1
+            print(f"Warning: Model endpoint {endpoint.host} failed ({error}), failing over")
+            return
+        # Nowhere else to go: back off, then start over from the least loaded endpoint
+        failed.clear()
+        delay = self._backoff(attempt)
+        print(f"Warning: Transient model error ({error}), retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+    async def chat(self, messages: list, model: str = MODEL, session: str = None, **kwargs):
+        """Non-streaming chat completion with retries and failover. Returns Ollama's ChatResponse."""
+        self._ensure_started()
+        failed = set()
+        for attempt in range(self.max_retries + 1):
+            endpoint = self.pick(session, exclude=failed)
+            try:
+                return await endpoint.chat(messages, model=model, **kwargs)
+            except Exception as e:
+                if not is_transient(e):
+                    raise ModelCallError(f"Model request to {endpoint.host} failed: {e}") from e
+                if attempt == self.max_retries:
+                    raise ModelCallError(f"Model request failed after {attempt + 1} attempts: {e}") from e
+                error = e
+            await self._before_retry(endpoint, failed, error, attempt)
+
+    async def chat_stream(self, messages: list, model: str = MODEL, session: str = None, **kwargs):
+        """
+        Streaming chat. Yields ChatResponse parts as they arrive. Transient failures are only
+        retried (or failed over) before the first part, since a partial answer cannot be
+        replayed. Closing the generator closes the HTTP response, which stops generation on
+        the server.
+        """
+        self._ensure_started()
+        failed = set()
+        for attempt in range(self.max_retries + 1):
+            endpoint = self.pick(session, exclude=failed)
+            started = False
+            stream = endpoint.chat_stream(messages, model=model, **kwargs)
+            try:
+                async for part in stream:
+                    started = True
+                    yield part
+                return
+            except Exception as e:
+                if started or not is_transient(e):
+                    raise ModelCallError(f"Model request to {endpoint.host} failed: {e}") from e
+                if attempt == self.max_retries:
+                    raise ModelCallError(f"Model request failed after {attempt + 1} attempts: {e}") from e
+                error = e
+            finally:
+                # Releases the endpoint's slot and response as soon as the caller stops reading
+                await stream.aclose()
+            await self._before_retry(endpoint, failed, error, attempt)
+
+    @property
+    def in_flight(self) -> int:
+        return sum(endpoint.in_flight for endpoint in self.endpoints)
+
+    def stats(self) -> dict:
+        """Per-endpoint health, load (outstanding, in flight, queued) and latency, plus pool totals."""
+        return {
+            "endpoints": [endpoint.stats() for endpoint in self.endpoints],
+            "healthy": sum(endpoint.healthy for endpoint in self.endpoints),
+            "failovers": self.failovers,
+            "sessions": len(self._sessions),
+        }
+
+    def _metrics(self):
+        for endpoint in self.endpoints:
+            stats = endpoint.stats()
+            labels = {"endpoint": endpoint.host}
+            yield "receipt_model_endpoint_healthy", "1 while the endpoint is in rotation", int(stats["healthy"]), labels
+            yield "receipt_model_endpoint_outstanding", "Requests routed to the endpoint and not finished", stats["outstanding"], labels
+            yield "receipt_model_endpoint_queued", "Requests waiting for one of the endpoint's slots", stats["queued"], labels
+            yield "receipt_model_endpoint_requests", "Requests the endpoint has finished, failed ones included", stats["requests"], labels
+            yield "receipt_model_endpoint_errors", "Requests to the endpoint that failed", stats["errors"], labels
+            for quantile in ("0.5", "0.95"):
+                yield ("receipt_model_endpoint_latency_seconds", "Recent request duration on the endpoint",
+                       stats["latency_p50" if quantile == "0.5" else "latency_p95"], {**labels, "quantile": quantile})
+        yield "receipt_model_failovers", "Attempts moved to another endpoint after a failure", self.failovers, {}
+
+
+_loop = None
+_loop_lock = threading.Lock()
+_client = None
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    """Event loop on a daemon thread that every sync caller shares, so they share one client."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="ollama-client", daemon=True).start()
+        return _loop
+
+
+def get_client() -> OllamaClient:
+    global _client
+    with _loop_lock:
+        if _client is None:
+            _client = OllamaClient()
+            metrics.add_collector(_client._metrics)
+        return _client
+
+
+def run_sync(coro):
+    """Runs a coroutine on the shared client loop and blocks for its result."""
+    loop = _background_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coro.close()
+        raise RuntimeError("run_sync() cannot be called from the client's own event loop; await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+async def achat(messages: list, model: str = MODEL, session: str = None, **kwargs):
+    """Awaitable chat for async callers. Runs on the shared loop so limits apply across callers."""
+    future = asyncio.run_coroutine_threadsafe(get_client().chat(messages, model=model, session=session, **kwargs), _background_loop())
+    return await asyncio.wrap_future(future)
+
+
+def chat(messages: list, model: str = MODEL, session: str = None, **kwargs):
+    """
+    Blocking wrapper for existing synchronous callers (Gradio handlers, batch threads). Calls
+    sharing a `session` id go to the same endpoint while it stays healthy.
+    """
+    return run_sync(get_client().chat(messages, model=model, session=session, **kwargs))
+
+
+def stream_chat(messages: list, model: str = MODEL, session: str = None, **kwargs):
+    """
+    Blocking generator over streamed ChatResponse parts for synchronous callers. Closing it
+    early (e.g. once the JSON object is complete) cancels the request on the shared loop.
+    """
+    parts = queue.Queue()
+    finished = object()
+
+    async def pump():
+        try:
+            async for part in get_client().chat_stream(messages, model=model, session=session, **kwargs):
+                parts.put(part)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            parts.put(e)
+        finally:
+            parts.put(finished)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), _background_loop())
+    try:
+        while True:
+            part = parts.get()
+            if part is finished:
+                return
+            if isinstance(part, Exception):
+                raise part
+            yield part
+    finally:
+        future.cancel()
@@ -1,47 +1,150 @@
 import json
-from .config import MOCK_DATABASE
-from .invoice_processor import execute_prompt
+from .invoice_processor import execute_prompt, clean_and_parse_json
+from .config import EMBEDDING_MIN_SCORE, VENDOR_LLM_CANDIDATES
+from .vendor_resolver import get_vendor_resolver
+from .vendor_embeddings import get_vendor_embedding_index
 
+# Lines of document text embedded (in one batch) when the trigram index is not conclusive
+EMBEDDING_QUERY_LINES = 20
+VENDOR_NAME_SCHEMA = {"type": "object", "properties": {"vendor_name": {"type": "string"}}, "required": ["vendor_name"]}
 
-def query_rag(image_paths, query_text=None):
 
-    db_string = json.dumps(MOCK_DATABASE, indent=2)
+def _candidates_for_prompt(candidates):
+    return {c["id"]: {"canonical_name": c["canonical_name"], "matched_name": c["matched_name"]} for c in candidates}
+
+
+def disambiguate_vendor(images, candidates, query_text=None, usage=None):
+    """Asks the model to pick between the few candidates the local index could not separate."""
+
+    db_string = json.dumps(_candidates_for_prompt(candidates), indent=2)
 
     system_prompt = f"""
-    You are a specialized entity resolution system. Your sole task is to analyze a user's query, which may come from text or an image, and find the corresponding official entity in the provided JSON database.
+    You are a specialized entity resolution system. Your sole task is to identify the VENDOR (the party issuing the invoice, not the customer) on the attached document and match it to one of the candidate entities below.
 
-    **Database of Known Entities:**
+    **Candidate Entities:**
     ```json
     {db_string}
     ```
 
-    **Your Instructions:**
-
-    1.  **Analyze the Query**: The user will provide a name or a document. Extract the most likely name of the organization they are referring to.
-    2.  **Search the Database**: Compare the extracted name against the "canonical_name" and "aliases" fields in the database. The match might not be perfect, so find the most plausible entry.
-    3.  **Format the Output**: You MUST respond with a single JSON object.
+    **Format the Output**: You MUST respond with a single JSON object.
 
-        * **If a match is found**, the JSON object should contain:
+        * **If one candidate is the vendor**, the JSON object should contain:
             - "status": "FOUND"
-            - "id": The unique ID of the matched entity (e.g., "111-JKL").
-            - "canonical_name": The official name from the database.
-            - "searched_term": The term you extracted from the user's query.
+            - "id": The unique ID of the matched entity.
+            - "searched_term": The vendor name as written on the document.
 
-        * **If no match is found**, the JSON object should contain:
+        * **If no candidate is the vendor**, the JSON object should contain:
             - "status": "NOT_FOUND"
-            - "searched_term": The term you extracted but could not match.
+            - "searched_term": The vendor name as written on the document.
 
-    **IMPORTANT**: Use ONLY the information in the provided database. Do not use your own knowledge about any companies. Your entire world is the database above.
+    **IMPORTANT**: Use ONLY the candidates above. Do not use your own knowledge about any companies.
     """
 
-    # The user's message is now just the raw input.
-    # The detailed instructions are all in the system prompt.
-    user_content = query_text if query_text else "Please identify the vendor in the attached image."
-    
+    user_content = "Please identify the vendor in the attached image(s) or extracted text among the candidates."
+    if query_text:
+        user_content += f"\n--- EXTRACTED TEXT ---\n{query_text}\n--- END TEXT ---"
+
     messages = [
         {'role': 'system', 'content': system_prompt},
-        {'role': 'user', 'content': user_content, 'images': image_paths}
+        {'role': 'user', 'content': user_content, 'images': images}
     ]
-    
-    return execute_prompt(messages)
-    
\ No newline at end of file
+
+    return clean_and_parse_json(execute_prompt(messages, usage=usage))
+
+
+def read_vendor_name(images, usage=None):
+    """Reads the vendor name off the page images when the PDF has no usable text layer."""
+    messages = [
+        {'role': 'system', 'content': 'Return ONLY a JSON object of the form {"vendor_name": "string"} naming the party that issued the attached invoice (not the customer). Use an empty string if you cannot tell.'},
+        {'role': 'user', 'content': "Who issued this invoice?", 'images': images}
+    ]
+    return clean_and_parse_json(execute_prompt(messages, format=VENDOR_NAME_SCHEMA, usage=usage)).get("vendor_name", "")
+
+
+def retrieve_semantic_candidates(resolver, queries):
+    """Top-k embedding neighbours across all query strings, merged to one score per vendor."""
+    if not queries:
+        return []
+    try:
+        index = get_vendor_embedding_index(resolver)
+        hits = index.search(queries)
+    except Exception as e:
+        print(f"Warning: Embedding retrieval unavailable, using trigram candidates only. Error: {e}")
+        return []
+
+    merged = {}
+    for candidate in (c for per_query in hits for c in per_query):
+        if candidate["score"] < EMBEDDING_MIN_SCORE:
+            continue
+        if candidate["id"] not in merged or candidate["score"] > merged[candidate["id"]]["score"]:
+            candidate["canonical_name"] = resolver.vendors[candidate["id"]].get("canonical_name", "")
+            merged[candidate["id"]] = candidate
+    return list(merged.values())
+
+
+def query_rag(images, query_text=None, usage=None):
+    """
+    Resolves the invoice vendor against the vendor master.
+
+    The local trigram index handles the common case in milliseconds. When it is not
+    conclusive, embedding retrieval adds the semantically closest vendors, and the model is
+    consulted with only those top-k candidates. The name is read off the image by the model
+    only when there is no text to search.
+    """
+    resolver = get_vendor_resolver()
+
+    if query_text and query_text.strip():
+        result = resolver.resolve_text(query_text)
+        queries = [line.strip() for line in query_text.splitlines() if line.strip()][:EMBEDDING_QUERY_LINES]
+    else:
+        try:
+            searched_term = read_vendor_name(images, usage)
+        except Exception as e:
+            # Resolves to NOT_FOUND; the extraction itself can still go ahead
+            print(f"Warning: Could not read the vendor name from the page images. Error: {e}")
+            searched_term = ""
+        result = resolver.resolve(searched_term)
+        queries = [searched_term] if searched_term else []
+
+    if result["status"] == "FOUND":
+        result["resolved_by"] = "index"
+        return result
+
+    merged = {c["id"]: c for c in result["candidates"]}
+    for candidate in retrieve_semantic_candidates(resolver, queries):
+        if candidate["id"] not in merged or candidate["score"] > merged[candidate["id"]]["score"]:
+            merged[candidate["id"]] = candidate
+    candidates = sorted(merged.values(), key=lambda c: c["score"], reverse=True)[:VENDOR_LLM_CANDIDATES]
+
+    if not candidates:
+        result["resolved_by"] = "index"
+        return result
+
+    try:
+        answer = disambiguate_vendor(images, candidates, query_text, usage)
+    except Exception as e:
+        # Only a candidate that clears the threshold and the margin on its own is accepted then
+        print(f"Warning: Vendor disambiguation failed, falling back to the local verdict. Error: {e}")
+        verdict = resolver.decide(candidates, searched_term=result["searched_term"])
+        verdict["resolved_by"] = "index"
+        return verdict
+
+    chosen = next((c for c in candidates if c["id"] == answer.get("id")), None)
+    if answer.get("status") != "FOUND" or chosen is None:
+        return {
+            "status": "NOT_FOUND",
+            "confidence": 0.0,
+            "searched_term": answer.get("searched_term", result["searched_term"]),
+            "candidates": candidates,
+            "resolved_by": "llm",
+        }
+
+    return {
+        "status": "FOUND",
+        "confidence": chosen["score"],
+        "id": chosen["id"],
+        "canonical_name": chosen["canonical_name"],
+        "searched_term": answer.get("searched_term", chosen["searched_term"]),
+        "candidates": candidates,
+        "resolved_by": "llm",
+    }
@@ -0,0 +1,168 @@
+import copy
+import json
+import uuid
+
+from .config import MODEL, REFINEMENT_KEEP_ALIVE, REFINEMENT_MAX_TURNS
+from .schema import validate_invoice, get_path, set_path
+from .main import stream_extraction
+
+REFINEMENT_SYSTEM_PROMPT = """
+You are a helpful assistant refining data extracted from an invoice. The invoice and the
+current extracted JSON are given in the first message; later messages are follow-up
+questions or correction requests from the user.
+
+Always respond with ONLY a JSON object of the form:
+{"answer": "<short reply to the user>", "patch": [<JSON Patch operations>]}
+
+"patch" lists RFC 6902 style operations ("add", "replace" or "remove") against the current
+JSON, e.g. {"op": "replace", "path": "/vendor_name", "value": "Acme Inc."} or
+{"op": "add", "path": "/line_items/-", "value": {"description": "...", "quantity": 1, "unit_price": 9.5}}.
+Only include operations for values that actually change; use an empty list for questions
+that don't change the data. Never repeat the whole JSON.
+"""
+
+PATCH_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "answer": {"type": "string"},
+        "patch": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "op": {"type": "string", "enum": ["add", "replace", "remove"]},
+                    "path": {"type": "string"},
+                    "value": {},
+                },
+                "required": ["op", "path"],
+            },
+        },
+    },
+    "required": ["answer", "patch"],
+}
+
+
+class PatchError(ValueError):
+    pass
+
+
+def _pointer_tokens(path: str) -> list:
+    if not path.startswith("/"):
+        raise PatchError(f"invalid JSON pointer {path!r}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in path[1:].split("/")]
+
+
+def apply_patch(document: dict, operations: list):
+    """
+    Applies JSON Patch add/replace/remove operations to a copy of `document`.
+    Returns (patched, applied, rejected); an operation that doesn't fit the document is
+    rejected on its own without affecting the others.
+    """
+    patched = copy.deepcopy(document)
+    applied, rejected = [], []
+
+    for operation in operations:
+        try:
+            op, tokens = operation.get("op"), _pointer_tokens(operation.get("path", ""))
+            parent = patched
+            for token in tokens[:-1]:
+                parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+            last = tokens[-1]
+
+            if isinstance(parent, list):
+                index = len(parent) if last == "-" else int(last)
+                if op == "add":
+                    parent.insert(index, operation["value"])
+                elif op == "replace":
+                    parent[index] = operation["value"]
+                elif op == "remove":
+                    del parent[index]
+                else:
+                    raise PatchError(f"unsupported op {op!r}")
+            else:
+                if op in ("add", "replace"):
+                    if op == "replace" and last not in parent:
+                        raise PatchError(f"nothing to replace at {operation['path']}")
+                    parent[last] = operation["value"]
+                elif op == "remove":
+                    del parent[last]
+                else:
+                    raise PatchError(f"unsupported op {op!r}")
+            applied.append(operation)
+        except (PatchError, KeyError, IndexError, ValueError, TypeError, AttributeError) as e:
+            rejected.append({"operation": operation, "error": str(e)})
+
+    return patched, applied, rejected
+
+
+def changed_fields(operations: list) -> set:
+    """Top-level invoice fields touched by a list of patch operations."""
+    fields = set()
+    for operation in operations:
+        path = operation.get("path", "")
+        if path.startswith("/"):
+            fields.add(_pointer_tokens(path)[0])
+    return fields
+
+
+class RefinementSession:
+    """
+    One chat refinement conversation over an extracted invoice.
+
+    The page images, document text and starting JSON go into the first turn only; later
+    turns carry just the user's question, and the model answers with a compact patch that
+    is applied locally. The conversation history is reused as-is turn after turn and the
+    model is kept loaded with `keep_alive`, so the server can reuse its cached prompt prefix
+    instead of re-reading the document every turn. Every turn goes to the same model server
+    (the session's `session_id` pins it) for as long as that server stays healthy.
+    """
+
+    def __init__(self, invoice: dict, images: list = None, document_text: str = "", model: str = MODEL):
+        self.session_id = uuid.uuid4().hex
+        self.model = model
+        self.invoice = invoice
+        self.turns = 0
+
+        context = ["--- CURRENT JSON ---", json.dumps(invoice), "--- END CURRENT JSON ---"]
+        if document_text:
+            context += ["--- EXTRACTED TEXT ---", document_text, "--- END TEXT ---"]
+        first = {'role': 'user', 'content': "\n".join(context)}
+        if images:
+            first['images'] = images
+        self.context = [{'role': 'system', 'content': REFINEMENT_SYSTEM_PROMPT}, first]
+        self.history = []
+
+    def ask(self, question: str):
+        """Sends one follow-up turn and applies the returned patch. Returns (answer, applied_ops, rejected_ops)."""
+        messages = self.context + self.history + [{'role': 'user', 'content': question}]
+        response = None
+        try:
+            for kind, data in stream_extraction(messages, model=self.model, format=PATCH_RESPONSE_SCHEMA,
+                                                keep_alive=REFINEMENT_KEEP_ALIVE, session=self.session_id):
+                if kind == "final":
+                    response = data
+        except ValueError as e:
+            print(f"Warning: Could not parse the refinement reply. Error: {e}")
+        if not isinstance(response, dict):
+            # Nothing usable came back; the invoice and the conversation stay as they were
+            return "Sorry, I could not parse the model's reply. Please try again.", [], []
+
+        patched, applied, rejected = apply_patch(self.invoice, response.get("patch") or [])
+        if applied:
+            patched, failures = validate_invoice(patched)
+            if failures:
+                # Keep the previous value of any field the edit made invalid
+                for failure in failures:
+                    set_path(patched, failure["path"], get_path(self.invoice, failure["path"]))
+                    rejected.append({"operation": failure, "error": "failed validation"})
+                patched, _ = validate_invoice(patched)
+            self.invoice = patched
+
+        self.history += [
+            {'role': 'user', 'content': question},
+            {'role': 'assistant', 'content': json.dumps(response)},
+        ]
+        # Bound the history; the document context in the first turn is always kept
+        self.history = self.history[-2 * REFINEMENT_MAX_TURNS:]
+        self.turns += 1
+        return response.get("answer", ""), applied, rejected
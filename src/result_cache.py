@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import threading
+
+from .config import RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES, RENDER_FORMAT
+from .tracing import metrics
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_cache_key(pdf_hash: str, model: str, prompt_hash: str, vendor_version: str) -> str:
+    return hashlib.sha256("|".join([pdf_hash, model, prompt_hash, vendor_version]).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Persistent, content-addressed store of finished extractions.
+
+    Each entry is a directory under `cache_dir` holding `result.json` and the rendered page
+    images. A small SQLite index tracks entry sizes and last access so the least recently
+    used entries are evicted once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: str = RESULT_CACHE_DIR, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, size INTEGER NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(os.path.join(self.cache_dir, "index.db"), timeout=30)
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key: str):
+        """Returns the cached result, including its encoded page `images`, or None."""
+        entry_dir = self._entry_dir(key)
+        result_path = os.path.join(entry_dir, "result.json")
+        # The entry is read under the lock so eviction cannot remove it halfway; another process
+        # still can, and a missing or half-written file is then just a miss
+        with self._lock:
+            with self._connect() as conn:
+                found = conn.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone()
+                if not found:
+                    self.misses += 1
+                    return None
+                try:
+                    with open(result_path, "r", encoding="utf-8") as f:
+                        result = json.load(f)
+                    images = []
+                    for name in result.pop("image_files", []):
+                        with open(os.path.join(entry_dir, name), "rb") as f:
+                            images.append(f.read())
+                except (OSError, ValueError):
+                    self.misses += 1
+                    return None
+                conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+
+        result["images"] = images
+        return result
+
+    def put(self, key: str, result: dict):
+        """Stores `result` (its page `images` are written alongside) and evicts LRU entries."""
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f"{entry_dir}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        image_files = []
+        for i, image in enumerate(result.get("images", [])):
+            name = f"page_{i + 1}.{RENDER_FORMAT.lower()}"
+            with open(os.path.join(tmp_dir, name), "wb") as f:
+                f.write(image)
+            image_files.append(name)
+
+        stored = {k: v for k, v in result.items() if k != "images"}
+        stored["image_files"] = image_files
+        with open(os.path.join(tmp_dir, "result.json"), "w", encoding="utf-8") as f:
+            json.dump(stored, f)
+
+        size = sum(os.path.getsize(os.path.join(tmp_dir, name)) for name in os.listdir(tmp_dir))
+        now = time.time()
+        with self._lock:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, size, created, last_access) VALUES (?, ?, ?, ?)",
+                    (key, size, now, now),
+                )
+            self._evict()
+
+    def _evict(self):
+        with self._connect() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access ASC").fetchall():
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                total -= size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            entries, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+        }
+
+    def _metrics(self):
+        stats = self.stats()
+        yield "receipt_result_cache_hits", "Result cache lookups served from the cache", stats["hits"], {}
+        yield "receipt_result_cache_misses", "Result cache lookups that found nothing", stats["misses"], {}
+        yield "receipt_result_cache_evictions", "Entries evicted to stay under the size limit", stats["evictions"], {}
+        yield "receipt_result_cache_entries", "Extractions in the result cache", stats["entries"], {}
+        yield "receipt_result_cache_bytes", "Size of the result cache", stats["bytes"], {}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache()
+            metrics.add_collector(_cache._metrics)
+        return _cache
@@ -0,0 +1,87 @@
+import re
+import unicodedata
+
+from .config import TEXT_ROUTE_MIN_CHARS, TEXT_ROUTE_MAX_GARBAGE, TEXT_ROUTE_MIN_SCORE
+
+AMOUNT_PATTERN = re.compile(r"\d[\d,]*[.,]\d{2}\b")
+DATE_PATTERN = re.compile(
+    r"\b\d{1,4}[-/.]\d{1,2}[-/.]\d{1,4}\b"
+    r"|\b\d{1,2}\s+(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?,?\s+\d{2,4}\b"
+    r"|\b(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?\s+\d{1,2},?\s+\d{2,4}\b",
+    re.IGNORECASE,
+)
+# pypdf emits "(cid:123)" for glyphs it cannot map back to unicode
+CID_PATTERN = re.compile(r"\(cid:\d+\)")
+
+
+def garbage_ratio(text: str) -> float:
+    """Share of characters that are replacement glyphs, private-use code points or stray controls."""
+    if not text:
+        return 0.0
+    cid_chars = sum(len(m) for m in CID_PATTERN.findall(text))
+    bad = 0
+    for ch in CID_PATTERN.sub("", text):
+        if ch in "\n\r\t":
+            continue
+        category = unicodedata.category(ch)
+        if ch == "\ufffd" or category in ("Co", "Cs", "Cn", "Cc"):
+            bad += 1
+    return (bad + cid_chars) / len(text)
+
+
+def score_page_text(text: str) -> dict:
+    """Scores how usable a page's text layer is as a substitute for its image (0..1)."""
+    text = text or ""
+    visible = [ch for ch in text if not ch.isspace()]
+    chars = len(visible)
+    alnum = sum(ch.isalnum() for ch in visible) / chars if chars else 0.0
+    garbage = garbage_ratio(text)
+    has_amount = bool(AMOUNT_PATTERN.search(text))
+    has_date = bool(DATE_PATTERN.search(text))
+
+    # Without an amount, plenty of clean text cannot reach TEXT_ROUTE_MIN_SCORE: such a page is
+    # often a text header over a scanned or embedded item table that only the image shows
+    score = (
+        0.3 * min(1.0, chars / TEXT_ROUTE_MIN_CHARS)
+        + 0.4 * has_amount
+        + 0.1 * has_date
+        + 0.2 * min(1.0, alnum / 0.6)
+    )
+    if garbage > TEXT_ROUTE_MAX_GARBAGE:
+        score = 0.0
+
+    return {
+        "score": round(score, 3),
+        "chars": chars,
+        "has_amount": has_amount,
+        "has_date": has_date,
+        "garbage_ratio": round(garbage, 4),
+    }
+
+
+def plan_route(page_texts: list, text_fast_path: bool = True) -> dict:
+    """
+    Decides per page whether its text layer is good enough to send as text, or whether the
+    page has to be rasterized and sent as an image. Page numbers are 1-based.
+    """
+    page_scores = [score_page_text(text) for text in page_texts]
+    if text_fast_path:
+        text_pages = [i + 1 for i, s in enumerate(page_scores) if s["score"] >= TEXT_ROUTE_MIN_SCORE]
+    else:
+        text_pages = []
+    image_pages = [i + 1 for i in range(len(page_texts)) if i + 1 not in text_pages]
+
+    if not page_texts or not text_pages:
+        mode = "vision"
+    elif not image_pages:
+        mode = "text"
+    else:
+        mode = "mixed"
+
+    return {
+        "mode": mode,
+        "pages_total": len(page_texts),
+        "text_pages": text_pages,
+        "image_pages": image_pages,
+        "page_scores": page_scores,
+    }
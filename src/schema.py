@@ -0,0 +1,265 @@
+import re
+import json
+import threading
+from datetime import datetime
+from typing import List, Optional, Union
+
+from pydantic import BaseModel, ValidationError, field_validator
+
+# Tried in order; US month-first wins over day-first when a date is ambiguous
+DATE_FORMATS = [
+    "%Y-%m-%d", "%Y/%m/%d", "%Y.%m.%d", "%Y%m%d",
+    "%m/%d/%Y", "%m/%d/%y", "%m-%d-%Y",
+    "%d/%m/%Y", "%d/%m/%y", "%d.%m.%Y", "%d.%m.%y", "%d-%m-%Y",
+    "%d %B %Y", "%d %b %Y", "%B %d, %Y", "%b %d, %Y", "%B %d %Y", "%b %d %Y", "%d-%b-%Y", "%d-%b-%y",
+]
+
+
+def coerce_number(value):
+    """Parses model output such as "$1,234.50", "1.234,50" or "(12.00)" into a float."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError("boolean is not a number")
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str):
+        raise ValueError(f"cannot interpret {value!r} as a number")
+
+    text = value.strip()
+    if not text:
+        return None
+    negative = text.startswith("(") and text.endswith(")") or text.startswith("-") or text.endswith("-")
+    digits = re.sub(r"[^\d.,]", "", text)
+    if not re.search(r"\d", digits):
+        raise ValueError(f"cannot interpret {value!r} as a number")
+
+    if "," in digits and "." in digits:
+        # Whichever separator comes last is the decimal point
+        thousands = "," if digits.rfind(".") > digits.rfind(",") else "."
+        digits = digits.replace(thousands, "").replace(",", ".")
+    elif "," in digits:
+        digits = digits.replace(",", "") if re.fullmatch(r"\d{1,3}(,\d{3})+", digits) else digits.replace(",", ".")
+    elif digits.count(".") > 1:
+        digits = digits.replace(".", "")
+
+    number = float(digits)
+    return -number if negative else number
+
+
+def coerce_date(value):
+    """Normalises a date string to ISO YYYY-MM-DD; empty stays empty."""
+    if value is None:
+        return ""
+    text = re.sub(r"\s+", " ", str(value)).strip().rstrip(".")
+    if not text:
+        return ""
+    text = re.sub(r"(\d)(st|nd|rd|th)\b", r"\1", text)
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date().isoformat()
+        except ValueError:
+            continue
+    raise ValueError(f"unrecognised date {value!r}")
+
+
+class LineItem(BaseModel):
+    description: str = ""
+    quantity: Optional[Union[int, float]] = None
+    unit_price: Optional[float] = None
+
+    @field_validator("description", mode="before")
+    @classmethod
+    def _text(cls, value):
+        return "" if value is None else str(value).strip()
+
+    @field_validator("quantity", mode="before")
+    @classmethod
+    def _quantity(cls, value):
+        number = coerce_number(value)
+        return int(number) if number is not None and number.is_integer() else number
+
+    @field_validator("unit_price", mode="before")
+    @classmethod
+    def _price(cls, value):
+        return coerce_number(value)
+
+
+class Invoice(BaseModel):
+    """The one definition of the extracted invoice; also sent to Ollama to constrain decoding."""
+
+    invoice_number: str = ""
+    invoice_date: str = ""
+    vendor_name: str = ""
+    vendor_id: str = ""
+    vendor_address: str = ""
+    customer_name: str = ""
+    customer_address: str = ""
+    currency: str = ""
+    line_items: List[LineItem] = []
+    subtotal: Optional[float] = None
+    tax: Optional[float] = None
+    total_amount: Optional[float] = None
+
+    @field_validator(
+        "invoice_number", "vendor_name", "vendor_id", "vendor_address",
+        "customer_name", "customer_address", "currency", mode="before",
+    )
+    @classmethod
+    def _text(cls, value):
+        return "" if value is None else str(value).strip()
+
+    @field_validator("invoice_date", mode="before")
+    @classmethod
+    def _date(cls, value):
+        return coerce_date(value)
+
+    @field_validator("subtotal", "tax", "total_amount", mode="before")
+    @classmethod
+    def _amount(cls, value):
+        return coerce_number(value)
+
+
+INVOICE_JSON_SCHEMA = Invoice.model_json_schema()
+
+# Placeholder types shown to the model in the system prompt
+_OUTLINE_TYPES = {str: "string", float: "float", Optional[float]: "float", Optional[Union[int, float]]: "integer"}
+
+
+def schema_outline() -> str:
+    """Renders the Invoice fields as the example JSON structure used in the system prompt."""
+    def outline(model):
+        fields = {}
+        for name, field in model.model_fields.items():
+            if name == "line_items":
+                fields[name] = [outline(LineItem)]
+            else:
+                fields[name] = _OUTLINE_TYPES.get(field.annotation, "string")
+        return fields
+    return json.dumps(outline(Invoice), indent=4)
+
+
+LINE_ITEM_PATH = re.compile(r"line_items\[(\d+)\](?:\.(\w+))?$")
+
+
+def _loc_to_path(loc) -> str:
+    if loc[0] == "line_items" and len(loc) >= 2 and isinstance(loc[1], int):
+        return f"line_items[{loc[1]}]" + (f".{loc[2]}" if len(loc) >= 3 else "")
+    return str(loc[0])
+
+
+def get_path(data: dict, path: str):
+    match = LINE_ITEM_PATH.match(path)
+    if not match:
+        return data.get(path)
+    items = data.get("line_items")
+    index, field = int(match.group(1)), match.group(2)
+    if not isinstance(items, list) or index >= len(items):
+        return None
+    if field is None:
+        return items[index]
+    return items[index].get(field) if isinstance(items[index], dict) else None
+
+
+def set_path(data: dict, path: str, value):
+    """Sets a top-level field or a `line_items[i]` / `line_items[i].field` entry, copying containers it touches."""
+    match = LINE_ITEM_PATH.match(path)
+    if not match:
+        data[path] = value
+        return
+    index, field = int(match.group(1)), match.group(2)
+    items = list(data.get("line_items") or [])
+    while len(items) <= index:
+        items.append({})
+    if field is None:
+        items[index] = value
+    else:
+        item = dict(items[index]) if isinstance(items[index], dict) else {}
+        item[field] = value
+        items[index] = item
+    data["line_items"] = items
+
+
+def path_schema(path: str) -> dict:
+    line_item_schema = INVOICE_JSON_SCHEMA["$defs"]["LineItem"]
+    match = LINE_ITEM_PATH.match(path)
+    if not match:
+        schema = dict(INVOICE_JSON_SCHEMA["properties"][path])
+        if path == "line_items":
+            schema["items"] = line_item_schema
+        return schema
+    field = match.group(2)
+    return line_item_schema if field is None else line_item_schema["properties"][field]
+
+
+def repair_schema(paths: list) -> dict:
+    """JSON schema for an object holding just the given field paths, used for targeted repairs."""
+    return {
+        "type": "object",
+        "properties": {path: path_schema(path) for path in paths},
+        "required": list(paths),
+    }
+
+
+def validate_invoice(raw: dict):
+    """
+    Validates and coerces a raw extraction. Returns (invoice_dict, failures) where each
+    failure is {"path", "raw"} for a field (or `line_items[i].field`) that could not be
+    coerced. Failing values are reset to their defaults so the rest of the invoice is usable.
+    """
+    if not isinstance(raw, dict):
+        raise ValueError("Extraction did not return a JSON object")
+
+    data = {name: raw[name] for name in Invoice.model_fields if name in raw}
+    failures = []
+    while True:
+        try:
+            return Invoice.model_validate(data).model_dump(), failures
+        except ValidationError as e:
+            paths = {_loc_to_path(error["loc"]) for error in e.errors() if error["loc"]}
+            seen = {failure["path"] for failure in failures}
+            if not paths or paths <= seen:
+                raise
+            for path in sorted(paths - seen):
+                failures.append({"path": path, "raw": get_path(raw, path)})
+                if LINE_ITEM_PATH.match(path):
+                    set_path(data, path, None if "." in path else {})
+                else:
+                    data.pop(path, None)
+
+
+_stats = {"documents": 0, "clean": 0, "repairs": 0, "repaired_fields": 0, "unrepaired_fields": 0, "full_retries": 0}
+_stats_lock = threading.Lock()
+
+
+def record_validation(repaired_fields=(), unrepaired_fields=(), full_retry=False):
+    with _stats_lock:
+        _stats["documents"] += 1
+        if full_retry:
+            _stats["full_retries"] += 1
+        if repaired_fields or unrepaired_fields:
+            _stats["repairs"] += 1
+        elif not full_retry:
+            _stats["clean"] += 1
+        _stats["repaired_fields"] += len(repaired_fields)
+        _stats["unrepaired_fields"] += len(unrepaired_fields)
+
+
+def get_validation_stats() -> dict:
+    """How often extractions needed a targeted field repair versus a full retry."""
+    with _stats_lock:
+        stats = dict(_stats)
+    documents = stats["documents"]
+    stats["repair_rate"] = round(stats["repairs"] / documents, 4) if documents else 0.0
+    stats["full_retry_rate"] = round(stats["full_retries"] / documents, 4) if documents else 0.0
+    return stats
+
+
+def validation_metrics():
+    """get_validation_stats as (name, help, value, labels) gauges, for metrics.add_collector."""
+    stats = get_validation_stats()
+    yield "receipt_validation_documents", "Extractions validated", stats["documents"], {}
+    for outcome in ("clean", "repairs", "full_retries"):
+        yield "receipt_validation_outcomes", "Extractions that were valid, needed a field repair or a full retry", stats[outcome], {"outcome": outcome}
+    yield "receipt_validation_repaired_fields", "Fields fixed by a targeted repair", stats["repaired_fields"], {}
+    yield "receipt_validation_unrepaired_fields", "Fields still invalid after repair", stats["unrepaired_fields"], {}
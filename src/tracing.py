@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .config import TRACE_PATH
+
+# Upper bounds (seconds) of the stage latency histogram buckets
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def record_usage(target, response):
+    """
+    Adds the token counts and timings Ollama reports on a finished response to `target`
+    (a span record) under "model". Does nothing when `target` is None.
+    """
+    if target is None:
+        return
+    model = target.setdefault("model", {
+        "calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+        "prompt_eval_seconds": 0.0, "eval_seconds": 0.0, "load_seconds": 0.0,
+    })
+    model["calls"] += 1
+    model["prompt_tokens"] += getattr(response, "prompt_eval_count", None) or 0
+    model["completion_tokens"] += getattr(response, "eval_count", None) or 0
+    # Ollama reports durations in nanoseconds
+    model["prompt_eval_seconds"] = round(model["prompt_eval_seconds"] + (getattr(response, "prompt_eval_duration", None) or 0) / 1e9, 4)
+    model["eval_seconds"] = round(model["eval_seconds"] + (getattr(response, "eval_duration", None) or 0) / 1e9, 4)
+    model["load_seconds"] = round(model["load_seconds"] + (getattr(response, "load_duration", None) or 0) / 1e9, 4)
+    model["tokens_per_second"] = round(model["completion_tokens"] / model["eval_seconds"], 2) if model["eval_seconds"] else 0.0
+
+
+class Trace:
+    """
+    Stage-by-stage record of one document going through the pipeline.
+
+    Spans are plain dicts so a trace started in a worker process (rendering) can be pickled
+    back and continued in the thread that runs the model calls. `finish()` writes the trace as
+    one JSONL line and feeds the Prometheus metrics.
+    """
+
+    def __init__(self, source: str):
+        self.trace_id = uuid.uuid4().hex
+        self.source = source
+        self.started_at = time.time()
+        self.spans = []
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Times the block; yields the span record so callers can attach attributes or model usage."""
+        record = {"name": name, **attributes}
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 4)
+            self.spans.append(record)
+
+    def add_span(self, name: str, seconds: float, **attributes):
+        self.spans.append({"name": name, **attributes, "seconds": round(seconds, 4)})
+
+    def timings(self) -> dict:
+        """Seconds per stage name, summed over repeated spans."""
+        timings = {}
+        for record in self.spans:
+            timings[record["name"]] = round(timings.get(record["name"], 0.0) + record["seconds"], 4)
+        return timings
+
+    def finish(self, **attributes) -> dict:
+        model = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "eval_seconds": 0.0, "load_seconds": 0.0}
+        for record in self.spans:
+            for key in model:
+                model[key] += record.get("model", {}).get(key, 0)
+        model["eval_seconds"] = round(model["eval_seconds"], 4)
+        model["load_seconds"] = round(model["load_seconds"], 4)
+        model["tokens_per_second"] = round(model["completion_tokens"] / model["eval_seconds"], 2) if model["eval_seconds"] else 0.0
+
+        trace = {
+            "trace_id": self.trace_id,
+            "source": self.source,
+            "started_at": self.started_at,
+            "seconds": round(time.time() - self.started_at, 4),
+            **attributes,
+            "model": model,
+            "spans": self.spans,
+        }
+        write_trace(trace)
+        metrics.observe(trace)
+        return trace
+
+
+_trace_lock = threading.Lock()
+
+
+def write_trace(trace: dict, path: str = TRACE_PATH):
+    if not path:
+        return
+    try:
+        with _trace_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(trace) + "\n")
+    except OSError as e:
+        print(f"Warning: Could not write trace to {path}. Error: {e}")
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Metrics:
+    """In-process counters and stage latency histograms, rendered in the Prometheus text format."""
+
+    COUNTERS = {
+        "receipt_documents_total": "Documents finished, by route and cache hit",
+        "receipt_near_duplicates_total": "Documents that reused the extraction of a near duplicate",
+        "receipt_images_sent_total": "Page images sent to the model",
+        "receipt_image_bytes_total": "Encoded page image bytes sent to the model",
+        "receipt_model_calls_total": "Model calls, by stage",
+        "receipt_model_prompt_tokens_total": "Prompt tokens evaluated, by stage",
+        "receipt_model_completion_tokens_total": "Completion tokens generated, by stage",
+        "receipt_model_eval_seconds_total": "Seconds spent generating tokens, by stage",
+        "receipt_model_load_seconds_total": "Seconds spent loading the model (cold starts), by stage",
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def add_collector(self, collect):
+        """Registers a callable yielding (name, help, value, labels) gauges, evaluated at every scrape."""
+        with self._lock:
+            self._collectors.append(collect)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe_stage(self, stage: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.setdefault(stage, {"buckets": [0] * len(STAGE_BUCKETS), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(STAGE_BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def observe(self, trace: dict):
+        self.inc("receipt_documents_total", route=trace.get("route") or "unknown", cached=str(bool(trace.get("cached"))).lower())
+        if trace.get("duplicate"):
+            self.inc("receipt_near_duplicates_total")
+        self.inc("receipt_images_sent_total", trace.get("images", 0))
+        self.inc("receipt_image_bytes_total", trace.get("image_bytes", 0))
+        for record in trace["spans"]:
+            self.observe_stage(record["name"], record["seconds"])
+            model = record.get("model")
+            if model:
+                stage = record["name"]
+                self.inc("receipt_model_calls_total", model["calls"], stage=stage)
+                self.inc("receipt_model_prompt_tokens_total", model["prompt_tokens"], stage=stage)
+                self.inc("receipt_model_completion_tokens_total", model["completion_tokens"], stage=stage)
+                self.inc("receipt_model_eval_seconds_total", model["eval_seconds"], stage=stage)
+                self.inc("receipt_model_load_seconds_total", model["load_seconds"], stage=stage)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {stage: dict(h, buckets=list(h["buckets"])) for stage, h in self._histograms.items()}
+            collectors = list(self._collectors)
+
+        for name, description in self.COUNTERS.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(f"{name}{_labels(dict(labels))} {value:g}")
+
+        lines += ["# HELP receipt_stage_seconds Wall time per pipeline stage", "# TYPE receipt_stage_seconds histogram"]
+        for stage, histogram in sorted(histograms.items()):
+            for bound, count in zip(STAGE_BUCKETS, histogram["buckets"]):
+                lines.append(f"receipt_stage_seconds_bucket{_labels({'stage': stage, 'le': bound})} {count}")
+            lines.append(f"receipt_stage_seconds_bucket{_labels({'stage': stage, 'le': '+Inf'})} {histogram['count']}")
+            lines.append(f"receipt_stage_seconds_sum{_labels({'stage': stage})} {histogram['sum']:.4f}")
+            lines.append(f"receipt_stage_seconds_count{_labels({'stage': stage})} {histogram['count']}")
+
+        gauges = {}
+        for collect in collectors:
+            try:
+                for name, description, value, labels in collect():
+                    gauges.setdefault(name, (description, []))[1].append(f"{name}{_labels(labels)} {value:g}")
+            except Exception as e:
+                print(f"Warning: Metrics collector failed. Error: {e}")
+        for name, (description, samples) in gauges.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge"] + samples
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0"):
+    """Serves /metrics on a daemon thread, alongside whatever else the process runs."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,162 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+from .config import (
+    EMBEDDING_MODEL,
+    EMBEDDING_INDEX_DIR,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_TOP_K,
+    OLLAMA_HOST,
+)
+
+# Rows scored per matmul; bounds peak memory when the matrix is much larger than RAM
+SEARCH_CHUNK_ROWS = 65536
+
+
+def _text_key(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+
+def default_embed_fn(model_name: str = EMBEDDING_MODEL):
+    from llama_index.embeddings.ollama import OllamaEmbedding
+
+    embedder = OllamaEmbedding(model_name=model_name, base_url=OLLAMA_HOST, embed_batch_size=EMBEDDING_BATCH_SIZE)
+    return embedder.get_text_embedding_batch
+
+
+class VendorEmbeddingIndex:
+    """
+    Persisted, memory-mapped embedding matrix over vendor canonical names and aliases.
+
+    `vectors.npy` holds one L2-normalised row per surface form and `entries.json` records
+    which vendor and text each row belongs to, so a vendor change only re-embeds new text.
+    """
+
+    def __init__(self, index_dir: str = EMBEDDING_INDEX_DIR, model_name: str = EMBEDDING_MODEL, embed_fn=None):
+        self.index_dir = index_dir
+        self.model_name = model_name
+        self._embed_fn = embed_fn
+        self.vectors_path = os.path.join(index_dir, "vectors.npy")
+        self.entries_path = os.path.join(index_dir, "entries.json")
+        self.entries = []
+        self.vectors = None
+        self.vendor_version = None
+        self._load()
+
+    def embed(self, texts: list) -> np.ndarray:
+        if self._embed_fn is None:
+            self._embed_fn = default_embed_fn(self.model_name)
+        vectors = []
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            vectors.extend(self._embed_fn(texts[start:start + EMBEDDING_BATCH_SIZE]))
+        return _normalize_rows(np.asarray(vectors, dtype=np.float32))
+
+    def _load(self):
+        if not (os.path.exists(self.vectors_path) and os.path.exists(self.entries_path)):
+            return
+        with open(self.entries_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("model") != self.model_name:
+            return
+        self.entries = meta["entries"]
+        self.vendor_version = meta.get("vendor_version")
+        self.vectors = np.load(self.vectors_path, mmap_mode="r")
+
+    def sync(self, vendors: dict, vendor_version: str = None):
+        """Brings the matrix in line with `vendors`, embedding only names not already indexed."""
+        if vendor_version is not None and vendor_version == self.vendor_version:
+            return
+
+        wanted = []
+        for vendor_id, record in vendors.items():
+            for text in [record.get("canonical_name", "")] + list(record.get("aliases", [])):
+                if text.strip():
+                    wanted.append({"vendor_id": vendor_id, "text": text, "key": _text_key(text)})
+
+        existing = {entry["key"]: row for row, entry in enumerate(self.entries)}
+        missing = sorted({e["text"] for e in wanted if e["key"] not in existing})
+        fresh = dict(zip((_text_key(t) for t in missing), self.embed(missing))) if missing else {}
+
+        if wanted:
+            rows = [fresh[e["key"]] if e["key"] in fresh else self.vectors[existing[e["key"]]] for e in wanted]
+            matrix = np.vstack(rows).astype(np.float32)
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        tmp_vectors = self.vectors_path + ".tmp.npy"
+        tmp_entries = self.entries_path + ".tmp"
+        np.save(tmp_vectors, matrix)
+        with open(tmp_entries, "w", encoding="utf-8") as f:
+            json.dump({"model": self.model_name, "vendor_version": vendor_version, "entries": wanted}, f)
+
+        # Drop our mapping of the old file before replacing it
+        self.vectors = None
+        os.replace(tmp_vectors, self.vectors_path)
+        os.replace(tmp_entries, self.entries_path)
+        self._load()
+
+    def search(self, queries: list, k: int = EMBEDDING_TOP_K) -> list:
+        """
+        Batched top-k cosine search. Returns, for each query, up to `k` candidates (one per
+        vendor) as dicts with `id`, `matched_name`, `score` and `searched_term`.
+        """
+        if not queries or self.vectors is None or len(self.entries) == 0:
+            return [[] for _ in queries]
+
+        query_vectors = self.embed(list(queries))
+        # Over-fetch rows so several aliases of one vendor don't crowd out other vendors
+        fetch = min(len(self.entries), k * 4)
+        best_scores = np.full((len(queries), 0), -1.0, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+
+        for start in range(0, len(self.entries), SEARCH_CHUNK_ROWS):
+            chunk = np.asarray(self.vectors[start:start + SEARCH_CHUNK_ROWS])
+            scores = query_vectors @ chunk.T
+            take = min(fetch, scores.shape[1])
+            top = np.argpartition(-scores, take - 1, axis=1)[:, :take]
+            best_scores = np.hstack([best_scores, np.take_along_axis(scores, top, axis=1)])
+            best_rows = np.hstack([best_rows, top + start])
+            if best_scores.shape[1] > fetch:
+                keep = np.argpartition(-best_scores, fetch - 1, axis=1)[:, :fetch]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+
+        results = []
+        for query, scores, rows in zip(queries, best_scores, best_rows):
+            per_vendor = {}
+            order = np.argsort(-scores)
+            for row, score in zip(rows[order], scores[order]):
+                entry = self.entries[row]
+                if entry["vendor_id"] not in per_vendor:
+                    per_vendor[entry["vendor_id"]] = {
+                        "id": entry["vendor_id"],
+                        "matched_name": entry["text"],
+                        "score": round(float(score), 4),
+                        "searched_term": query,
+                    }
+            results.append(list(per_vendor.values())[:k])
+        return results
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_vendor_embedding_index(resolver) -> VendorEmbeddingIndex:
+    """Returns the shared embedding index, incrementally re-synced to the resolver's vendor set."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = VendorEmbeddingIndex()
+        _index.sync(resolver.vendors, resolver.version)
+        return _index
@@ -0,0 +1,249 @@
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import Counter, defaultdict
+
+from .config import (
+    VENDOR_DB_PATH,
+    VENDOR_MATCH_THRESHOLD,
+    VENDOR_AMBIGUITY_MARGIN,
+    VENDOR_MIN_SCORE,
+    VENDOR_LLM_CANDIDATES,
+    VENDOR_SHORT_ALIAS_CHARS,
+    VENDOR_SHORT_ALIAS_SCORE,
+    VENDOR_MAX_GRAM_POSTINGS,
+)
+
+# Legal-form suffixes that carry no identifying signal ("Stellapps Pvt. Ltd." == "Stellapps")
+LEGAL_SUFFIXES = {
+    "inc", "incorporated", "llc", "llp", "ltd", "limited", "pvt", "private", "corp",
+    "corporation", "co", "company", "gmbh", "plc", "sa", "ag", "bv",
+}
+
+# Only the top of a document usually names the vendor; scanning everything just adds noise.
+MAX_SCAN_LINES = 60
+
+# Words that mark a line as naming the vendor, so a short alias on it can be trusted
+VENDOR_LABELS = {"from", "vendor", "supplier", "seller", "sold", "remit", "payable", "issued", "billed"}
+
+
+# Grams kept for the shortlist when every gram of a query is common
+MIN_SHORTLIST_GRAMS = 3
+
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+
+def normalize_name(name: str) -> str:
+    name = name.lower().replace("&", " and ")
+    name = _NON_ALNUM.sub(" ", name)
+    tokens = [t for t in name.split() if t not in LEGAL_SUFFIXES]
+    return " ".join(tokens)
+
+
+def is_short_alias(surface: str, normalized: str) -> bool:
+    """Acronym-like names ("GT", "K&V", "IBM") that are easily matched by accident."""
+    if len(normalized.replace(" ", "")) <= VENDOR_SHORT_ALIAS_CHARS:
+        return True
+    return len(surface.split()) == 1 and surface.isupper()
+
+
+def trigrams(normalized: str) -> set:
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def dice(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def load_vendors(path: str = VENDOR_DB_PATH) -> dict:
+    """Loads the vendor master as {id: {"canonical_name": str, "aliases": [str]}}."""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Vendor database not found: {path}")
+
+    if path.endswith((".db", ".sqlite", ".sqlite3")):
+        with sqlite3.connect(path) as conn:
+            rows = conn.execute("SELECT id, canonical_name, aliases FROM vendors").fetchall()
+        return {
+            str(vendor_id): {"canonical_name": name, "aliases": json.loads(aliases or "[]")}
+            for vendor_id, name, aliases in rows
+        }
+
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class VendorResolver:
+    def __init__(self, vendors: dict):
+        self.vendors = vendors
+        self.version = hashlib.sha256(json.dumps(vendors, sort_keys=True).encode()).hexdigest()[:16]
+
+        # One entry per surface form (canonical name or alias)
+        self.entries = []
+        self.exact = defaultdict(set)
+        self.index = defaultdict(list)
+        self.short = set()
+
+        index = self.index
+        for vendor_id, record in vendors.items():
+            names = [record.get("canonical_name", "")] + list(record.get("aliases", []))
+            for surface in names:
+                normalized = normalize_name(surface)
+                if not normalized:
+                    continue
+                entry_id = len(self.entries)
+                grams = trigrams(normalized)
+                self.entries.append((vendor_id, surface, normalized, grams))
+                self.exact[normalized].add(vendor_id)
+                if is_short_alias(surface, normalized):
+                    self.short.add(normalized)
+                for gram in grams:
+                    index[gram].append(entry_id)
+
+        self.max_tokens = max((len(e[2].split()) for e in self.entries), default=1)
+
+    def _candidate(self, vendor_id, surface, score, searched_term):
+        return {
+            "id": vendor_id,
+            "canonical_name": self.vendors[vendor_id].get("canonical_name", ""),
+            "matched_name": surface,
+            "score": round(score, 4),
+            "searched_term": searched_term,
+        }
+
+    def _rank(self, scored: dict, limit: int) -> list:
+        ranked = sorted(scored.values(), key=lambda c: c["score"], reverse=True)
+        return ranked[:limit]
+
+    def _shortlist(self, grams: set, limit: int) -> list:
+        """
+        Entry ids sharing the most trigrams with `grams`, counting only grams rare enough to
+        be selective; the common ones are left to the full score.
+        """
+        postings = sorted((self.index[gram] for gram in grams if gram in self.index), key=len)
+        selective = [p for p in postings if len(p) <= VENDOR_MAX_GRAM_POSTINGS] or postings[:MIN_SHORTLIST_GRAMS]
+        shared = Counter()
+        for entry_ids in selective:
+            shared.update(entry_ids)
+        return [entry_id for entry_id, _ in shared.most_common(limit)]
+
+    def search(self, name: str, limit: int = VENDOR_LLM_CANDIDATES) -> list:
+        """Fuzzy-matches a single organisation name against every canonical name and alias."""
+        normalized = normalize_name(name)
+        if not normalized:
+            return []
+
+        scored = {}
+        for vendor_id in self.exact.get(normalized, ()):
+            scored[vendor_id] = self._candidate(vendor_id, name, 1.0, name)
+
+        grams = trigrams(normalized)
+        for entry_id in self._shortlist(grams, limit * 10):
+            vendor_id, surface, _, entry_grams = self.entries[entry_id]
+            score = dice(grams, entry_grams)
+            if vendor_id not in scored or score > scored[vendor_id]["score"]:
+                scored[vendor_id] = self._candidate(vendor_id, surface, score, name)
+
+        return self._rank(scored, limit)
+
+    def search_text(self, text: str, limit: int = VENDOR_LLM_CANDIDATES) -> list:
+        """Finds vendor mentions anywhere in the first lines of free document text."""
+        scored = {}
+        lines = [line.strip() for line in text.splitlines() if line.strip()][:MAX_SCAN_LINES]
+
+        for line in lines:
+            tokens = normalize_name(line).split()
+            if not tokens:
+                continue
+            words = set(re.findall(r"[a-z]+", line.lower()))
+            labelled = bool(words & (VENDOR_LABELS | LEGAL_SUFFIXES))
+
+            # Exact hits on token windows catch short aliases such as "GT" or "K&V", but those
+            # only count in full when the line is about the vendor
+            for size in range(1, min(self.max_tokens, len(tokens)) + 1):
+                for start in range(len(tokens) - size + 1):
+                    window = " ".join(tokens[start:start + size])
+                    score = 1.0
+                    if window in self.short and size < len(tokens) and not labelled:
+                        score = VENDOR_SHORT_ALIAS_SCORE
+                    for vendor_id in self.exact.get(window, ()):
+                        if vendor_id not in scored or score > scored[vendor_id]["score"]:
+                            scored[vendor_id] = self._candidate(vendor_id, window, score, line)
+
+            # Fuzzy: shortlist entries sharing trigrams with the line, then score the best
+            # token window of roughly the entry's length
+            line_grams = trigrams(" ".join(tokens))
+            window_grams = {}
+            for entry_id in self._shortlist(line_grams, limit * 10):
+                vendor_id, surface, normalized, entry_grams = self.entries[entry_id]
+                if len(line_grams & entry_grams) < len(entry_grams) / 2:
+                    continue
+                size = len(normalized.split())
+                best = 0.0
+                for width in range(max(1, size - 1), min(len(tokens), size + 1) + 1):
+                    for start in range(len(tokens) - width + 1):
+                        if (start, width) not in window_grams:
+                            window_grams[start, width] = trigrams(" ".join(tokens[start:start + width]))
+                        best = max(best, dice(window_grams[start, width], entry_grams))
+                if normalized in self.short and not labelled:
+                    best = min(best, VENDOR_SHORT_ALIAS_SCORE)
+                if vendor_id not in scored or best > scored[vendor_id]["score"]:
+                    scored[vendor_id] = self._candidate(vendor_id, surface, best, line)
+
+        return self._rank(scored, limit)
+
+    def decide(self, candidates: list, searched_term: str = "") -> dict:
+        """Turns ranked candidates into a FOUND / NOT_FOUND / AMBIGUOUS verdict."""
+        candidates = [c for c in candidates if c["score"] >= VENDOR_MIN_SCORE]
+        if not candidates:
+            return {"status": "NOT_FOUND", "confidence": 0.0, "searched_term": searched_term, "candidates": []}
+
+        best = candidates[0]
+        runner_up = candidates[1]["score"] if len(candidates) > 1 else 0.0
+        margin = best["score"] - runner_up
+
+        if best["score"] >= VENDOR_MATCH_THRESHOLD and margin >= VENDOR_AMBIGUITY_MARGIN:
+            return {
+                "status": "FOUND",
+                "confidence": best["score"],
+                "margin": round(margin, 4),
+                "id": best["id"],
+                "canonical_name": best["canonical_name"],
+                "searched_term": best["searched_term"],
+                "candidates": candidates,
+            }
+
+        return {
+            "status": "AMBIGUOUS",
+            "confidence": best["score"],
+            "margin": round(margin, 4),
+            "searched_term": searched_term or best["searched_term"],
+            "candidates": candidates,
+        }
+
+    def resolve(self, name: str) -> dict:
+        return self.decide(self.search(name), searched_term=name)
+
+    def resolve_text(self, text: str) -> dict:
+        return self.decide(self.search_text(text))
+
+
+_resolver = None
+_resolver_key = None
+_resolver_lock = threading.Lock()
+
+
+def get_vendor_resolver(path: str = VENDOR_DB_PATH) -> VendorResolver:
+    """Returns a shared resolver, rebuilding the index whenever the vendor store changes on disk."""
+    global _resolver, _resolver_key
+    key = (path, os.path.getmtime(path))
+    with _resolver_lock:
+        if _resolver is None or _resolver_key != key:
+            _resolver = VendorResolver(load_vendors(path))
+            _resolver_key = key
+        return _resolver